@@ -0,0 +1,385 @@
+import asyncio
+import logging
+import time
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus import protocol
+from riaps.interfaces.modbus.commands import CommandSpec
+from riaps.interfaces.modbus.connection_health import is_device_response
+from riaps.interfaces.modbus.ModbusInterface import ModbusInterfaceBase, set_bit
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+from riaps.interfaces.modbus.read_plan import ReadBlock, ReadPlan
+import riaps.interfaces.modbus.TerminalColors as tc
+
+# unit id plus the longest PDU, 253 bytes
+MAX_MBAP_LENGTH = 254
+
+
+class AsyncTcpConnection:
+    """
+    Modbus TCP connection on asyncio streams. Up to max_outstanding requests are in flight
+    at once and responses are matched to their requests by MBAP transaction id, so a late
+    response to a timed out request cannot be mistaken for the answer to the next one.
+    With an AdaptiveTimeout, requests use its timeout and feed it their round trips.
+    """
+
+    def __init__(self, address, port, timeout, max_outstanding=1, logger=None, adaptive_timeout=None):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.adaptive_timeout = adaptive_timeout
+        self.max_outstanding = max(1, max_outstanding)
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+        self._reader = None
+        self._writer = None
+        self._receiver = None
+        self._pending = {}
+        self._transaction_id = 0
+        # created on first use so they belong to the loop that runs the connection
+        self._slots = None
+        self._connect_lock = None
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self):
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+            self._slots = asyncio.Semaphore(self.max_outstanding)
+        async with self._connect_lock:
+            if self.is_connected:
+                return
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.address, self.port), self.timeout
+            )
+            self._receiver = asyncio.ensure_future(self._receive())
+            self.logger.info(
+                f"AsyncTcpConnection | connect | Connected to {self.address}:{self.port}"
+            )
+
+    async def close(self):
+        receiver, self._receiver = self._receiver, None
+        if receiver:
+            receiver.cancel()
+        writer, self._writer = self._writer, None
+        self._reader = None
+        if writer:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        self._fail_pending(ConnectionAbortedError("Connection closed"))
+
+    def _fail_pending(self, ex):
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ex)
+
+    async def _receive(self):
+        reader = self._reader
+        try:
+            while True:
+                header = await reader.readexactly(protocol.MBAP_LENGTH)
+                transaction_id, protocol_id, length, _ = protocol.MBAP.unpack(header)
+                if protocol_id != protocol.MODBUS_PROTOCOL_ID or not 1 <= length <= MAX_MBAP_LENGTH:
+                    # the stream is out of step, nothing after this header can be trusted
+                    raise modbus_exceptions.ModbusInvalidResponseError(f"Invalid MBAP header {header!r}")
+                pdu = await reader.readexactly(length - 1)
+                future = self._pending.pop(transaction_id, None)
+                if future is None or future.done():
+                    self.logger.debug(
+                        f"AsyncTcpConnection | _receive | "
+                        f"Dropped response to transaction {transaction_id}"
+                    )
+                    continue
+                future.set_result(pdu)
+        except asyncio.CancelledError:
+            raise
+        except (asyncio.IncompleteReadError, OSError, modbus_exceptions.ModbusInvalidResponseError) as ex:
+            self.logger.error(
+                f"AsyncTcpConnection | _receive | "
+                f"Connection to {self.address}:{self.port} lost: {ex!r}"
+            )
+            if self._writer:
+                self._writer.close()
+            self._writer = None
+            self._reader = None
+            self._fail_pending(ConnectionResetError(f"Connection lost: {ex!r}"))
+
+    def _next_transaction_id(self):
+        while True:
+            self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+            if self._transaction_id not in self._pending:
+                return self._transaction_id
+
+    async def execute(
+        self,
+        slave,
+        function_code,
+        starting_address,
+        quantity_of_x=0,
+        output_value=0,
+        data_format="",
+        **kwargs,
+    ):
+        """Same arguments and result as modbus_tk's Master.execute."""
+        request = protocol.build_request(
+            function_code,
+            starting_address,
+            quantity_of_x=quantity_of_x,
+            output_value=output_value,
+            data_format=data_format,
+            **kwargs,
+        )
+        await self.connect()
+        async with self._slots:
+            if not self.is_connected:
+                raise ConnectionResetError("Connection lost")
+            transaction_id = self._next_transaction_id()
+            future = asyncio.get_running_loop().create_future()
+            self._pending[transaction_id] = future
+            timeout = self.adaptive_timeout.timeout if self.adaptive_timeout is not None else self.timeout
+            sent = time.perf_counter()
+            self._writer.write(
+                protocol.build_mbap(transaction_id, slave, len(request.pdu)) + request.pdu
+            )
+            try:
+                await self._writer.drain()
+                response_pdu = await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if self.adaptive_timeout is not None:
+                    self.adaptive_timeout.backoff()
+                raise
+            finally:
+                self._pending.pop(transaction_id, None)
+        round_trip = time.perf_counter() - sent
+        try:
+            response = protocol.parse_response(request, response_pdu)
+        except modbus_exceptions.ModbusError as ex:
+            if self.adaptive_timeout is not None and is_device_response(ex):
+                self.adaptive_timeout.observe(round_trip)
+            raise
+        if self.adaptive_timeout is not None:
+            self.adaptive_timeout.observe(round_trip)
+        return response
+
+
+class AsyncModbusInterface(ModbusInterfaceBase):
+    """
+    asyncio version of ModbusInterface for Modbus TCP devices. The configuration and the
+    results are the same as ModbusInterface, but every method that talks to the device is
+    a coroutine, so one event loop can drive any number of devices:
+
+        devices = [AsyncModbusInterface(path) for path in paths]
+        results = await asyncio.gather(*(device.read_plan(plan) for ...))
+
+    Set TCP: Max_Outstanding_Requests in the device configuration to pipeline requests on
+    the connection when the device supports it. It shares the configuration and decoding of
+    ModbusInterface (ModbusInterfaceBase), not its connection pool, health monitor, request
+    queue or batched reads and writes.
+    """
+
+    def __init__(self, path_to_file, logger=None, debug_mode=False):
+        self._load_configuration(path_to_file, logger, debug_mode)
+
+        if self.device_config["Protocol"] != "TCP":
+            msg = (
+                f"AsyncModbusInterface | __init__ | "
+                f"{self.device_config['Protocol']} protocol not implemented"
+            )
+            self.logger.error(f"{tc.Red}{msg}{tc.RESET}")
+            raise ValueError(msg)
+
+        comm_config = self.device_config["TCP"]
+        self.online = {"status": False, "error": "Not connected"}
+        self._bit_write_lock = None
+        self.master = AsyncTcpConnection(
+            comm_config["Address"],
+            comm_config["Port"],
+            timeout=ModbusSystem.Timeouts.TCPComm / 1000.0,
+            max_outstanding=comm_config.get(
+                "Max_Outstanding_Requests", ModbusSystem.Async.MaxOutstandingRequests
+            ),
+            logger=self.logger,
+            adaptive_timeout=self.adaptive_timeout,
+        )
+
+    def is_connected(self):
+        return self.master.is_connected
+
+    async def is_online(self):
+        """Connect to the device if needed and return the same status dict as ModbusInterface."""
+        try:
+            await self.master.connect()
+            self.online = {"status": True, "error": None}
+        except (OSError, asyncio.TimeoutError) as ex:
+            error_message = (
+                f"Connection to {self.master.address}:{self.master.port} failed: {ex!r}"
+            )
+            self.logger.error(error_message)
+            self.online = {"status": False, "error": error_message}
+        return self.online
+
+    async def connect(self):
+        return await self.is_online()
+
+    async def execute_modbus_command(self, command_name: str, value_to_write=0):
+        return await self.execute_command_spec(self.commands[command_name], value_to_write)
+
+    async def execute_command_spec(self, spec: CommandSpec, value_to_write=0):
+        # temporary hack
+        if spec.function_code == cst.WRITE_SINGLE_REGISTER:
+            value_to_write = value_to_write[0]
+
+        return await self._execute(
+            spec.name,
+            self.slave_id,
+            spec.function_code,
+            spec.start,
+            spec.length,
+            value_to_write,
+            spec.data_format,
+        )
+
+    async def _execute(
+        self,
+        command_name,
+        slave_id,
+        function_code,
+        starting_address,
+        length,
+        value_to_write=0,
+        data_fmt="",
+    ):
+        start = time.perf_counter()
+        try:
+            response = await self.master.execute(
+                slave_id,
+                function_code,
+                starting_address,
+                quantity_of_x=length,
+                output_value=value_to_write,
+                data_format=data_fmt,
+            )
+        except asyncio.TimeoutError as ex:
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            self.logger.error(f"AsyncModbusInterface | {command_name} | Timeout")
+            return {"command": command_name, "errors": ex}
+        except (OSError, asyncio.IncompleteReadError) as ex:
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            self.online = {"status": False, "error": f"{ex!r}"}
+            self.logger.error(f"AsyncModbusInterface | {command_name} | error={ex!r}")
+            return {"command": command_name, "errors": ex}
+        except Exception as ex:
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            self.logger.error(f"AsyncModbusInterface | {command_name} | Exception: {ex}")
+            return {"command": command_name, "errors": ex}
+
+        self.metrics.record(command_name, function_code, length, time.perf_counter() - start)
+        self.online = {"status": True, "error": None}
+        result = {"command": command_name, "response": list(response)}
+        if self.debug_mode:
+            self.logger.debug(
+                f"{tc.White}AsyncModbusInterface | parameter: {command_name} "
+                f"response: {result}{tc.RESET}"
+            )
+        return result
+
+    async def read_modbus(self, parameter: str, force_full_register_read=False):
+        spec = self.read_commands.get(parameter)
+        if spec is None:
+            raise KeyError(f"{parameter}_READ")
+        result = await self.execute_command_spec(spec)
+        if result.get("errors"):
+            return result
+        result = self.scale_spec_response(
+            result["response"], spec, force_full_register_read
+        )
+        if self.debug_mode:
+            self.logger.info(
+                f"AsyncModbusInterface | read_modbus | Modbus result: {result}"
+            )
+        return result
+
+    async def read_block(self, block: ReadBlock):
+        return await self._execute(
+            block.name, block.slave_id, block.function_code, block.start, block.length
+        )
+
+    async def read_plan(self, plan: ReadPlan, force_full_register_read=False):
+        """All transactions of the plan are issued at once, see ModbusInterface.read_plan."""
+        results = [None] * len(plan.parameters)
+
+        blocks = list(plan.blocks)
+        block_results = await asyncio.gather(
+            *(self.read_block(block) for block in blocks)
+        )
+        for block, block_result in zip(blocks, block_results):
+            decoded = self.decode_block(block, block_result, force_full_register_read)
+            if decoded is None:
+                plan.split(block)
+                continue
+            for index, result in decoded:
+                results[index] = result
+
+        singles = list(plan.singles)
+        single_results = await asyncio.gather(
+            *(self.read_modbus(parameter, force_full_register_read) for _, parameter in singles)
+        )
+        for (index, _), result in zip(singles, single_results):
+            results[index] = result
+
+        if self.debug_mode:
+            self.logger.info(
+                f"AsyncModbusInterface | read_plan | Modbus results: {results}"
+            )
+        return results
+
+    async def write_modbus(self, parameter: str, values: list):
+        spec = self.write_commands.get(parameter)
+        if spec is None:
+            raise KeyError(f"{parameter}_WRITE")
+
+        if spec.bit_position is not None:
+            return await self.write_bit(spec, values[0])
+
+        values_to_write = self.encode_write_values(spec, values)
+        result = await self.execute_command_spec(spec, value_to_write=values_to_write)
+        return self.write_result(spec, values, result)
+
+    async def write_bit(self, spec: CommandSpec, bit_value):
+        """
+        Read the register of a bit parameter, set the bit and write it back. No other bit
+        write of this interface touches a register in between, see ModbusInterface.write_bits.
+        """
+        if self._bit_write_lock is None:
+            # created on first use so it belongs to the loop that runs the interface
+            self._bit_write_lock = asyncio.Lock()
+        async with self._bit_write_lock:
+            current = await self._execute(
+                spec.name, self.slave_id, cst.READ_HOLDING_REGISTERS, spec.start, 1
+            )
+            if current.get("errors"):
+                return self.write_result(spec, [bit_value], current)
+            value = set_bit(current["response"][0], spec.bit_position, bit_value)
+            result = self.write_result(
+                spec, [value], await self.execute_command_spec(spec, value_to_write=[value])
+            )
+        return self.bit_result(spec, bit_value, result)
+
+    async def close(self):
+        await self.master.close()
+        self.online = {"status": False, "error": "Not connected"}
+        self.logger.info(f"Closed Modbus connection for {self.device_name}.")
@@ -2,7 +2,10 @@ import yaml
 from riaps.run.comp import Component
 
 import riaps.interfaces.modbus.config as config
+from riaps.interfaces.modbus.ModbusIOLoop import ModbusIOLoop
 from riaps.interfaces.modbus.ModbusMasterThread import ModbusMaster
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+from riaps.interfaces.modbus.startup import start_interfaces
 import riaps.interfaces.modbus.TerminalColors as tc
 
 
@@ -11,6 +14,11 @@ class ModbusDeviceComponent(Component):
         super().__init__()
 
         self.device_config_paths, self.global_debug_mode = config.load_config_paths(path_to_device_list)
+        device_list = config.load_device_list(path_to_device_list)
+        # IO_Loops: N serves all devices from N ModbusIOLoop threads instead of a ModbusMaster per device
+        self.io_loops = device_list.get("IO_Loops", ModbusSystem.IOLoop.Loops)
+        self.activation_deadline = device_list.get("Activation_Deadline_Seconds",
+                                                   ModbusSystem.Startup.DeadlineSeconds)
         self.device_threads = {}
 
     # riaps:keep_modbus_evt_port:begin
@@ -33,12 +41,19 @@ class ModbusDeviceComponent(Component):
     # riaps:keep_impl:begin
     def handleActivate(self):
         self.logger.info("handleActivate")
+        # probe and connect all devices at once, the ones not online by the deadline start polling when they are
+        modbus_interfaces = start_interfaces(self.device_config_paths, self.logger, self.activation_deadline)
+        if self.io_loops:
+            self.start_io_loops(modbus_interfaces)
+            self.logger.info("handleActivate complete")
+            return
         for device_name in self.device_config_paths:
             device_config_path = self.device_config_paths[device_name]
             device_thread = ModbusMaster(path_to_config_file=device_config_path,
                                          logger=self.logger,
                                          command_port=self.modbus_command_port,
-                                         event_port=self.modbus_event_port
+                                         event_port=self.modbus_event_port,
+                                         modbus_interface=modbus_interfaces[device_name]
                                          )
             self.device_threads[device_name] = device_thread
             device_thread.start()
@@ -46,6 +61,22 @@ class ModbusDeviceComponent(Component):
             # self.modbus_command_port.activate()
         self.logger.info("handleActivate complete")
 
+    def start_io_loops(self, modbus_interfaces=None):
+        device_names = list(self.device_config_paths)
+        for loop_index in range(min(self.io_loops, len(device_names))):
+            loop_devices = {device_name: self.device_config_paths[device_name]
+                            for device_name in device_names[loop_index::self.io_loops]}
+            io_loop = ModbusIOLoop(device_config_paths=loop_devices,
+                                   logger=self.logger,
+                                   command_port=self.modbus_command_port,
+                                   event_port=self.modbus_event_port,
+                                   modbus_interfaces=modbus_interfaces
+                                   )
+            for device_name in loop_devices:
+                # send_modbus routes a device's commands to the plug of its loop
+                self.device_threads[device_name] = io_loop
+            io_loop.start()
+
     def send_modbus(self, msg):
         self.logger.info(f"{tc.Cyan}"
                          f"ModbusDeviceComponent | send_modbus | send riaps msg to modbus: {msg}"
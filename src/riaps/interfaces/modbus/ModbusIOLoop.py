@@ -0,0 +1,98 @@
+import logging
+import math
+import threading
+import zmq
+
+from riaps.interfaces.modbus.ModbusMasterThread import ModbusMaster
+from riaps.interfaces.modbus.poll_scheduler import PollScheduler
+
+
+class ModbusIOLoop(threading.Thread):
+    """
+    One thread that serves several devices: the poll groups of every device share one
+    deadline scheduler and the commands for all of them arrive on one command port plug.
+    It replaces the two threads (command and polling) that a ModbusMaster starts per device.
+    A device that is slow to answer delays the other devices of the same loop, so spread
+    slow devices over several loops.
+    """
+
+    def __init__(self, device_config_paths, logger=None, command_port=None, event_port=None, modbus_interfaces=None):
+        super().__init__(daemon=True)
+
+        local_logger = logging.getLogger(__name__)
+        if local_logger.handlers:
+            self.logger = local_logger
+        elif logger:
+            self.logger = logger
+        else:
+            self.logger = local_logger
+
+        self.port_poller = zmq.Poller()
+        self.command_port_plug = None
+        self.event_port_plug = None
+        if command_port:
+            self.command_port_plug = command_port.setupPlug(self)
+            self.port_poller.register(self.command_port_plug, zmq.POLLIN)
+        if event_port:
+            self.event_port_plug = event_port.setupPlug(self)
+
+        self.devices = {}
+        for device_name, device_config_path in device_config_paths.items():
+            device = ModbusMaster(path_to_config_file=device_config_path,
+                                  logger=self.logger,
+                                  start_polling=False,
+                                  modbus_interface=(modbus_interfaces or {}).get(device_name))
+            device.event_port_plug = self.event_port_plug
+            self.devices[device_name] = device
+
+        self.stop_event = threading.Event()
+
+    def handle_command(self, msg):
+        device = self.devices.get(msg["to_device"])
+        if device is None:
+            return {"device_name": msg["to_device"],
+                    "operation": msg.get("operation"),
+                    "parameters": msg.get("parameters"),
+                    "values": [],
+                    "return_status": [f"{msg['to_device']} is not served by this loop"],
+                    "msgcounter": msg.get("msgcounter")}
+        return device.handle_command(msg)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for a command and handle it."""
+        if not self.command_port_plug:
+            self.stop_event.wait(timeout)
+            return
+        ports_with_events = dict(self.port_poller.poll(math.ceil(timeout * 1000)))
+        if self.command_port_plug in ports_with_events:
+            msg = self.command_port_plug.recv_pyobj()
+            self.logger.info(f"ModbusIOLoop | run | receive message on command port: {msg}")
+            self.command_port_plug.send_pyobj(self.handle_command(msg))
+
+    def run(self):
+        owners = {}
+        for device in self.devices.values():
+            for group in device.scheduled_groups():
+                owners[group] = device
+        scheduler = PollScheduler(list(owners))
+
+        while not self.stop_event.is_set():
+            timeout = scheduler.time_to_next_deadline()
+            self.wait(1.0 if timeout is None else min(1.0, timeout))
+
+            batches = {}
+            for group in scheduler.pop_due():
+                device = owners[group]
+                if device not in batches:
+                    batches[device] = device.new_batch()
+                device.run_group(scheduler, group, batches[device])
+            for device, batch in batches.items():
+                if batch is not None:
+                    device.publish_batch(batch)
+
+        for device in self.devices.values():
+            device.close_sample_log()
+            device.modbus_interface.close()
+
+    def stop(self):
+        self.stop_event.set()
@@ -2,20 +2,44 @@ import datetime as dt
 import logging
 import socket
 
-from modbus_tk import modbus_rtu
 from modbus_tk import modbus_tcp
 from modbus_tk import exceptions as modbus_exceptions
 import modbus_tk.defines as cst
 import serial
 import socket
+import struct
 import sys
+import threading
+import time
 import yaml
 
 from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
-from riaps.interfaces.modbus.config import load_config_file, validate_configuration
+from riaps.interfaces.modbus.adaptive_timeout import AdaptiveTimeout, is_timeout
+from riaps.interfaces.modbus.commands import CommandSpec, compile_command_table
+from riaps.interfaces.modbus.config import parse_config, validate_configuration
+from riaps.interfaces.modbus.config_cache import ConfigCache
+from riaps.interfaces.modbus.connection_health import ConnectionHealth, is_device_response
+from riaps.interfaces.modbus.connection_pool import PooledMaster, RtuMaster, get_connection_pool, last_round_trip
+from riaps.interfaces.modbus.lean_tcp import LeanTcpMaster
+from riaps.interfaces.modbus.metrics import DeviceMetrics
+from riaps.interfaces.modbus.read_plan import ReadBlock, ReadPlan, compile_read_plan
+from riaps.interfaces.modbus.register_cache import RegisterCache
+from riaps.interfaces.modbus.request_queue import RequestQueue
+from riaps.interfaces.modbus.traffic import TrafficRecorder
 import riaps.interfaces.modbus.TerminalColors as tc
 
 
+# registers that fit in one WRITE_MULTIPLE_REGISTERS request
+MAX_WRITE_REGISTERS = 123
+
+READ_FUNCTIONS = (
+    cst.READ_COILS,
+    cst.READ_DISCRETE_INPUTS,
+    cst.READ_HOLDING_REGISTERS,
+    cst.READ_INPUT_REGISTERS,
+)
+
+
 # get the value of an individual bit in a value from typing import List
 def get_bit(value, bit_position):
     """Gets a bit in the data 'value' at position index specified by 'bit'
@@ -33,33 +57,64 @@ def set_bit(value, bit_position, bit_value):
     return value
 
 
-class ModbusInterface:
-    def __init__(self, path_to_file, logger=None, debug_mode=False, auto_start=True):
+class ModbusInterfaceBase:
+    """
+    Configuration loading, result scaling and block decoding shared by ModbusInterface and
+    AsyncModbusInterface. Nothing in it talks to the device.
+    """
 
+    def _load_configuration(self, path_to_file, logger=None, debug_mode=False):
         local_logger = logging.getLogger(__name__)
         if logger:
             self.logger = logger
         else:
             self.logger = local_logger
 
-        self.device_config = load_config_file(path_to_file)
-        config_valid = validate_configuration(self.device_config)
-        if config_valid["return_code"] != 0:
-            msg = f"ModbusInterface | __init__ | Configuration error: {config_valid['msg']}"
-            self.logger.error(f"{tc.Red}{msg}{tc.RESET}")
-            raise ValueError(msg)
+        with open(path_to_file, "rb") as file:
+            source = file.read()
+        config_cache = ConfigCache(logger=self.logger) if ModbusSystem.ConfigCache.Enabled else None
+        compiled = config_cache.load(path_to_file, source) if config_cache else None
+        if compiled is not None:
+            # validated and compiled when it was cached
+            self.device_config, self.commands = compiled
+        else:
+            self.device_config = parse_config(source)
+            config_valid = validate_configuration(self.device_config)
+            if config_valid["return_code"] != 0:
+                msg = f"ModbusInterface | __init__ | Configuration error: {config_valid['msg']}"
+                self.logger.error(f"{tc.Red}{msg}{tc.RESET}")
+                raise ValueError(msg)
 
-        self.online = self.is_online()
+            try:
+                self.commands = compile_command_table(self.device_config)
+            except (AttributeError, KeyError, struct.error) as ex:
+                msg = f"ModbusInterface | __init__ | Command configuration error: {ex!r}"
+                self.logger.error(f"{tc.Red}{msg}{tc.RESET}")
+                raise ValueError(msg)
+            if config_cache:
+                config_cache.store(path_to_file, source, self.device_config, self.commands)
+        self.read_commands = self.commands.reads
+        self.write_commands = self.commands.writes
 
         self.device_name = self.device_config["Name"]
+        self.slave_id = self.device_config["SlaveID"]
         self.debug_mode = (
             debug_mode if debug_mode else self.device_config.get("debugMode", False)
         )
+        self.metrics = DeviceMetrics(self.device_name, self.device_config["Protocol"])
+        self.register_cache = RegisterCache()
+        self.adaptive_timeout = self._setup_adaptive_timeout(self.device_config)
 
-        if auto_start and self.online["status"] is True:
-            self.master = self.setup_master(self.device_config)
+    def _setup_adaptive_timeout(self, device_config):
+        if not device_config.get("Adaptive_Timeout", ModbusSystem.Timeouts.Adaptive):
+            return None
+        if device_config["Protocol"] == "TCP":
+            floor, ceiling = ModbusSystem.Timeouts.AdaptiveFloorTCP, ModbusSystem.Timeouts.TCPComm
         else:
-            self.master = None
+            floor, ceiling = ModbusSystem.Timeouts.AdaptiveFloorTTYS, ModbusSystem.Timeouts.TTYSComm
+        floor = device_config.get("Timeout_Floor_Milliseconds", floor)
+        ceiling = device_config.get("Timeout_Ceiling_Milliseconds", ceiling)
+        return AdaptiveTimeout(floor / 1000.0, ceiling / 1000.0)
 
     def get_fault_description(self, fault_code):
         """Get the fault description from the fault lookup table."""
@@ -79,13 +134,330 @@ class ModbusInterface:
         description = fault_lookup[fault_code]["description"]
         return description, handler, max_retries
 
+    def get_metrics(self):
+        """Latency histograms and counters per command, for the device and per poll interval."""
+        metrics = self.metrics.get_stats()
+        metrics["register_cache"] = self.register_cache.get_stats()
+        if self.adaptive_timeout is not None:
+            metrics["timeout"] = self.adaptive_timeout.as_dict()
+        return metrics
+
+    def scale_response(
+        self, response, command_name: str, force_full_register_read=False
+    ):
+        return self.scale_spec_response(
+            response, self.commands[command_name], force_full_register_read
+        )
+
+    def scale_spec_response(
+        self, response, spec: CommandSpec, force_full_register_read=False
+    ):
+
+        command_name = spec.name
+        bit_position = spec.bit_position
+        scale_factor = spec.scale_factor
+        units = spec.units
+        values = []
+        errors = []  # TODO: add errors as they come up
+
+        for value in response:
+            if scale_factor:
+                values.append(value * scale_factor)
+            elif force_full_register_read:
+                values.append(value)
+            elif bit_position is not None:
+                bit_value = get_bit(value, bit_position=bit_position)
+                values.append(bit_value)
+                self.logger.info(
+                    f"{tc.Red}"
+                    f"{command_name}\n"
+                    f"response: {response}\n"
+                    f"scale_factor: {scale_factor}\n"
+                    f"force_full_register_read: {force_full_register_read}\n"
+                    f"bit_position: {bit_position}\n"
+                    f"bit_value: {bit_value}"
+                    f"{tc.RESET}"
+                )
+            else:
+                values.append(value)
+
+        results = {
+            "device_name": self.device_name,
+            "command": command_name,
+            "values": values,
+            "units": units,
+        }
+
+        # If there are errors, add them to the result.
+        # The ModbusMasterThread will check if there are errors, and if there are not then it will send a return
+        # status of OK
+        if errors:
+            results["errors"] = errors
+
+        return results
+
+    def compile_read_plan(self, parameters, max_gap=None, max_length=None):
+        """Compile the *_READ commands of parameters into block reads, see read_plan.py"""
+        if max_gap is None:
+            max_gap = self.device_config.get("Poll_Max_Register_Gap", ModbusSystem.ReadPlan.MaxRegisterGap)
+        if max_length is None:
+            max_length = self.device_config.get("Poll_Max_Block_Registers", ModbusSystem.ReadPlan.MaxBlockRegisters)
+        plan = compile_read_plan(
+            self.read_commands, self.slave_id, parameters, max_gap=max_gap, max_length=max_length
+        )
+        self.logger.debug(f"ModbusInterface | compile_read_plan | {plan}")
+        return plan
+
+    def decode_block(self, block: ReadBlock, block_result, force_full_register_read=False):
+        """
+        Slice and scale the members of a block read. Returns a list of (index, result) or
+        None when the members have to be read one by one instead.
+        """
+        errors = block_result.get("errors")
+        if errors:
+            if isinstance(errors, modbus_exceptions.ModbusError):
+                # The slave rejected the block (e.g. a gap register is not mapped),
+                # read the members one by one so the valid ones still get through.
+                self.logger.warning(
+                    f"{tc.Yellow}"
+                    f"ModbusInterface | decode_block | {block} failed: {errors}, "
+                    f"reading its parameters one by one from now on"
+                    f"{tc.RESET}"
+                )
+                return None
+            return [
+                (index, {"command": f"{parameter}_READ", "errors": errors})
+                for index, parameter, _ in block.members
+            ]
+
+        registers = block_result["response"]
+        self.register_cache.update(
+            block.slave_id, block.function_code, block.start, registers
+        )
+        results = []
+        for index, parameter, offset in block.members:
+            spec = self.read_commands[parameter]
+            try:
+                response = spec.decode(registers[offset : offset + spec.length])
+            except struct.error as ex:
+                self.logger.error(
+                    f"ModbusInterface | decode_block | {spec.name} decode error: {ex}"
+                )
+                results.append((index, {"command": spec.name, "errors": ex}))
+                continue
+            results.append(
+                (index, self.scale_spec_response(response, spec, force_full_register_read))
+            )
+        return results
+
+    def bit_result(self, spec: CommandSpec, bit_value, result):
+        if result.get("errors"):
+            return {"command": spec.name, "errors": result["errors"]}
+        return {
+            "device_name": self.device_name,
+            "command": spec.name,
+            "values": [bit_value],
+            "units": spec.units,
+        }
+
+    def cache_registers(self, spec: CommandSpec, values):
+        """Update the register cache with values read or written by spec, in its data_format."""
+        try:
+            registers = spec.encode(values)
+        except (struct.error, TypeError, ValueError):
+            self.register_cache.invalidate(
+                self.slave_id, spec.function_code, spec.start, spec.length
+            )
+            return
+        self.register_cache.update(self.slave_id, spec.function_code, spec.start, registers)
+
+    def encode_write_values(self, spec: CommandSpec, values, current_registry_value=None):
+        """Convert the engineering values of a *_WRITE command into register values."""
+        bit_position = spec.bit_position
+        scale_factor = spec.scale_factor
+
+        values_to_write = []
+        if bit_position is not None:
+            bit_value = values[0]
+            value = set_bit(current_registry_value[0], bit_position, bit_value)
+            self.logger.debug(
+                f"ModbusInterface | write_modbus | value after setting bit: {value}"
+            )
+            values_to_write.append(value)
+        elif scale_factor:
+            for value in values:
+                scaled_value = value / scale_factor
+                # TODO: There are likely some cases that this implementation does not cover.
+                #  for example, if data_format is defined as >H. This was not handled in the
+                #  prior implementation either.
+                if spec.integer_write:
+                    # Why cast this as an int?
+                    # Because the division above causes it to be a float
+                    # and if data_format is not specified the modbus_tk library will
+                    # set it to either shorts (e.g,.  data_format = ">" + (quantity_of_x * "H"))
+                    # or unsigned characters, so we make sure
+                    # the input is an int before sending it.
+                    scaled_value = int(scaled_value)
+                values_to_write.append(scaled_value)
+        else:
+            values_to_write = values
+        return values_to_write
+
+    def write_result(self, spec: CommandSpec, values, result):
+        """Check the response to a *_WRITE command and build the write_modbus result."""
+        command_name = spec.name
+        starting_address = spec.start
+        units = spec.units
+        #  https://ozeki.hu/p_5883-mobdbus-function-code-16-write-multiple-holding-registers.html
+
+        # In response to a successful WRITE command the modbus returns
+        # 1: The starting address of the parameters
+        # 2: The number of registers written.
+        if result.get("errors"):
+            self.logger.error(
+                f"{tc.Red}"
+                f"ModbusInterface | write_modbus | "
+                f"{result['errors']}"
+                f"{tc.RESET}"
+            )
+            return result
+
+        response = result["response"]
+        self.logger.debug(
+            f"ModbusInterface | write_modbus | Response to writing value: {response}"
+        )
+        if len(response) != 2:
+            self.logger.warning(
+                f"{tc.Red}"
+                f"ModbusInterface | write_modbus | "
+                f"If this happens update code."
+                f"Response wrong length: {response}"
+                f"{tc.RESET}"
+            )
+            error = f"Response wrong length"
+            result = {
+                "command": command_name,
+                "values": [],
+                "units": units,
+                "errors": error,
+            }
+            return result
+        if response[0] != starting_address:
+            self.logger.warning(
+                f"{tc.Red}"
+                f"ModbusInterface | write_modbus | "
+                f"If this happens update code."
+                f"Parameter mismatch: {response}"
+                f"{tc.RESET}"
+            )
+            error = f"Modbus Parameter mismatch"
+            result = {
+                "command": command_name,
+                "values": [],
+                "units": units,
+                "errors": error,
+            }
+            return result
+
+        # Since a WRITE command does not return the written value, we insert the written value
+        # manually into the response, and as a result we do not need to scale it.
+        # result = self.scale_response([response[1]], command_name, force_full_register_read=True)
+        # result = self.scale_response(values, command_name, force_full_register_read=True)
+        result = {
+            "device_name": self.device_name,
+            "command": command_name,
+            "values": values,
+            "units": units,
+        }
+
+        if self.debug_mode:
+            self.logger.info(f"Modbus result: {result}")
+        return result
+
+
+class ModbusInterface(ModbusInterfaceBase):
+    def __init__(self, path_to_file, logger=None, debug_mode=False, auto_start=True):
+        """With auto_start=False the device is not probed or connected until start() is called."""
+        self._load_configuration(path_to_file, logger, debug_mode)
+        self.request_queue = None
+        self.mask_write = self.device_config.get("Mask_Write", ModbusSystem.BitWrites.MaskWrite)
+        self.traffic_recorder = None
+        self.started = threading.Event()
+        self._bit_write_lock = threading.Lock()
+        self._read_plans = {}
+
+        self.online = {"status": False, "error": "Not started"}
+        self.master = None
+        # the connection itself failed, not just a request, see probe
+        self._link_failed = False
+        self.health = ConnectionHealth(
+            self.device_name,
+            probe=self.probe,
+            on_reconnect=self._reconnect,
+            logger=self.logger,
+        )
+
+        if auto_start:
+            self.start()
+
+    def start(self, online=None):
+        """
+        Probe the device and set up its master. An unreachable device, or one whose master
+        could not be set up, is left to the health monitor, which brings it online in the
+        background once it answers. online is the result of a probe of the same endpoint
+        that already ran, see startup.start_interfaces.
+        """
+        try:
+            self.online = online if online is not None else self.is_online()
+            if self.online["status"] is True:
+                try:
+                    self.master = self.setup_master(self.device_config)
+                except Exception as ex:
+                    self.logger.error(f"ModbusInterface | start | {self.device_name}: {ex!r}")
+                    self.online = {"status": False, "error": f"{ex}"}
+            if self.online["status"] is not True:
+                # come online in the background once the device is reachable
+                self.health.mark_down(self.online["error"])
+        finally:
+            self.started.set()
+        return self.online
+
+    def endpoint(self):
+        """The TCP endpoint (address, port) or serial device the device is reached through."""
+        protocol = self.device_config.get("Protocol")
+        if protocol == "TCP":
+            tcp = self.device_config.get("TCP", {})
+            return tcp.get("Address"), tcp.get("Port")
+        if protocol in ["Serial", "RS232"]:
+            return self.device_config.get("Serial", {}).get("device")
+        return self.device_name
+
+    def _apply_timeout(self):
+        timeout = self.adaptive_timeout.timeout
+        if timeout != self.master.get_timeout():
+            if self.device_config["Protocol"] == "TCP" or isinstance(self.master, PooledMaster):
+                self.master.set_timeout(timeout)
+            else:
+                self.master.set_timeout(timeout, use_sw_timeout=True)
+
+    def _record_round_trip(self, start, error=None):
+        """Update the adaptive timeout with the request sent at start, a timeout backs it off."""
+        if error is None or is_device_response(error):
+            # a shared connection knows how long the request held it, without the wait for it
+            round_trip = last_round_trip() if isinstance(self.master, PooledMaster) else None
+            self.adaptive_timeout.observe(round_trip if round_trip is not None else time.perf_counter() - start)
+        elif is_timeout(error):
+            self.adaptive_timeout.backoff()
+
     def is_connected(self):
         return self.master._is_opened
 
-    def is_online(self):
+    def is_online(self, use_pool=True):
         """
         Check if the Modbus device is online.
         Returns a dictionary with 'status' (True/False) and 'error' (None or error message).
+        With use_pool, a device whose TCP endpoint or serial bus is already connected in the
+        connection pool is reported online without opening a probe connection.
         """
         if self.device_config["Protocol"] == "TCP":
             try:
@@ -96,6 +468,10 @@ class ModbusInterface:
                 self.logger.error(error_message)
                 return {"status": False, "error": error_message}
 
+            if use_pool and get_connection_pool().is_connected(addr, port):
+                # Do not spend one of the gateway's few connections on a probe
+                return {"status": True, "error": None}
+
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(1)
             try:
@@ -119,6 +495,9 @@ class ModbusInterface:
         elif self.device_config["Protocol"] in ["Serial", "RS232"]:
             try:
                 comm_config = self.device_config["Serial"]
+                if use_pool and get_connection_pool().is_connected(comm_config["device"]):
+                    # The bus is already open, another probe would only disturb it
+                    return {"status": True, "error": None}
                 serial_connection = serial.Serial(
                     port=comm_config["device"],
                     baudrate=comm_config["baudrate"],
@@ -157,6 +536,78 @@ class ModbusInterface:
             self.logger.error(error_message)
             return {"status": False, "error": error_message}
 
+    def probe(self):
+        """
+        The health monitor's check whether a down device answers again: one read of this
+        slave, so a gateway that accepts connections for a slave it cannot reach does not
+        pass it. A gateway exception counts as no answer, any other exception response as
+        an answer, see is_device_response. A connection that failed is reopened first, one
+        that is only shared with a slave that did not answer is left alone.
+        """
+        if self.master is None:
+            try:
+                self.setup_master(self.device_config)
+            except Exception as ex:
+                return {"status": False, "error": f"{ex!r}"}
+            if self.master is None:
+                return {"status": False, "error": "No Modbus master"}
+        elif self._link_failed:
+            if isinstance(self.master, PooledMaster):
+                self.master.reset()
+            else:
+                # modbus_tk reopens the connection on the next execute
+                self.master.close()
+        self._link_failed = False
+
+        spec = next(
+            (spec for spec in self.read_commands.values() if spec.function_code in READ_FUNCTIONS), None
+        )
+        if spec is None:
+            return self.is_online(use_pool=False)
+        if self.adaptive_timeout is not None:
+            self._apply_timeout()
+        try:
+            self.master.execute(self.slave_id, spec.function_code, spec.start, quantity_of_x=spec.length)
+        except Exception as ex:
+            if is_device_response(ex):
+                return {"status": True, "error": None}
+            self._record_link_failure(ex)
+            return {"status": False, "error": f"{ex!r}"}
+        return {"status": True, "error": None}
+
+    def _reconnect(self):
+        """Called from the health monitor's background thread once the device passed the probe."""
+        self.online = {"status": True, "error": None}
+
+    def _record_link_failure(self, ex):
+        if isinstance(ex, OSError) and not is_timeout(ex):
+            self._link_failed = True
+
+    def _record_failure(self, ex):
+        self._record_link_failure(ex)
+        self.health.record_failure(ex)
+        if self.health.is_down:
+            self.online = {"status": False, "error": self.health.last_error}
+
+    def get_health(self):
+        return self.health.get_stats()
+
+    def get_metrics(self):
+        metrics = super().get_metrics()
+        if self.request_queue is not None:
+            metrics["request_queue"] = self.request_queue.get_stats()
+        return metrics
+
+    def enable_request_queue(self):
+        """
+        Execute every transaction of the device on one request queue, so that requests from
+        the command port (see connection_pool.request_priority) go ahead of queued polls and
+        identical queued reads are merged.
+        """
+        if self.request_queue is None:
+            self.request_queue = RequestQueue(self.device_name, logger=self.logger)
+        return self.request_queue
+
     def setup_master(self, device_config):
         protocol = device_config["Protocol"]
         comm_config = device_config[protocol]
@@ -171,16 +622,36 @@ class ModbusInterface:
             return None
         master.set_verbose(ModbusSystem.Debugging.Verbose)
         self.master = master
+        record_file = device_config.get("Traffic_Record_File")
+        if record_file and self.traffic_recorder is None:
+            # a PooledMaster executes on the modbus_tk master of its shared connection
+            wire_master = master.connection.master if isinstance(master, PooledMaster) else master
+            if isinstance(wire_master, LeanTcpMaster):
+                self.logger.warning(
+                    f"ModbusInterface | setup_master | {self.device_name}: the lean TCP transport is not recorded, "
+                    f"set Lean_Transport: False to record its traffic"
+                )
+            self.traffic_recorder = TrafficRecorder(record_file, wire_master, slave_id=self.slave_id)
         return master
 
     def setup_tcp_master(self, comm_config):
         addr = comm_config["Address"]
         port = comm_config["Port"]
-        master = modbus_tcp.TcpMaster(addr, port)
+        lean = comm_config.get("Lean_Transport", ModbusSystem.Transport.LeanTCP)
+        if comm_config.get("Shared", ModbusSystem.ConnectionPool.Enabled):
+            # Devices behind the same gateway share (and take turns on) one socket
+            master = get_connection_pool().acquire_tcp(addr, port, lean=lean)
+        elif lean:
+            master = LeanTcpMaster(addr, port)
+        else:
+            master = modbus_tcp.TcpMaster(addr, port)
         master.set_timeout((ModbusSystem.Timeouts.TCPComm / 1000.0))
         return master
 
     def setup_rtu_master(self, comm_config):
+        if comm_config.get("Shared", ModbusSystem.ConnectionPool.Enabled):
+            # Slaves on the same RS-485 bus share the serial port and take turns on it
+            return get_connection_pool().acquire_rtu(comm_config)
         serial_connection = serial.Serial(
             port=comm_config["device"],
             baudrate=comm_config["baudrate"],
@@ -189,47 +660,103 @@ class ModbusInterface:
             stopbits=comm_config["stopbits"],
             xonxoff=comm_config["xonxoff"],
         )
-        master = modbus_rtu.RtuMaster(serial_connection)
+        master = RtuMaster(serial_connection)
         master.set_timeout(
             (ModbusSystem.Timeouts.TTYSComm / 1000.0), use_sw_timeout=True
         )
         return master
 
     def execute_modbus_command(self, command_name: str, value_to_write=0):
+        return self.execute_command_spec(self.commands[command_name], value_to_write)
+
+    def execute_command_spec(self, spec: CommandSpec, value_to_write=0):
+
+        if not self.health.allow_request():
+            return {"command": spec.name, "errors": self.health.down_error()}
 
         if not self.master:
             result = {
-                "command": command_name,
+                "command": spec.name,
                 "errors": "No Modbus master",
             }
             return result
 
-        command_config = self.device_config[command_name]
-        function_code = command_config["function"]
-        starting_address = command_config["start"]
-        length = command_config["length"]
-        data_fmt = command_config.get("data_format", "")
-
         # temporary hack
-        if getattr(cst, function_code) == cst.WRITE_SINGLE_REGISTER:
+        if spec.function_code == cst.WRITE_SINGLE_REGISTER:
             value_to_write = value_to_write[0]
 
+        return self._execute(
+            spec.name,
+            self.slave_id,
+            spec.function_code,
+            spec.start,
+            spec.length,
+            value_to_write,
+            spec.data_format,
+        )
+
+    def _execute(
+        self,
+        command_name,
+        slave_id,
+        function_code,
+        starting_address,
+        length,
+        value_to_write=0,
+        data_fmt="",
+    ):
+        if self.request_queue is not None and not self.request_queue.in_worker():
+            merge_key = None
+            if function_code in READ_FUNCTIONS:
+                merge_key = (slave_id, function_code, starting_address, length, data_fmt)
+            return self.request_queue.call(
+                self._execute,
+                command_name,
+                slave_id,
+                function_code,
+                starting_address,
+                length,
+                value_to_write,
+                data_fmt,
+                merge_key=merge_key,
+                stopped_result={"command": command_name, "errors": "Request queue stopped"},
+            )
+
+        masks = {}
+        if function_code == cst.MASK_WRITE_REGISTER:
+            # value_to_write is the (and_mask, or_mask) pair
+            masks = {"and_mask": value_to_write[0], "or_mask": value_to_write[1]}
+            value_to_write = 0
+
+        if self.adaptive_timeout is not None and self.master is not None:
+            self._apply_timeout()
+        start = time.perf_counter()
         try:
             response: tuple = self.master.execute(
-                self.device_config["SlaveID"],
-                getattr(cst, function_code),
+                slave_id,
+                function_code,
                 starting_address,
                 quantity_of_x=length,
                 output_value=value_to_write,
                 data_format=data_fmt,
+                **masks,
             )
             result = {"command": command_name, "response": list(response)}
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start
+            )
+            if self.adaptive_timeout is not None:
+                self._record_round_trip(start)
+            self.health.record_success()
         except ConnectionRefusedError as ex:
             result = {
                 "command": command_name,
                 "errors": ex,
             }
-            self.online = self.is_online()
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            self._record_failure(ex)
             self.logger.error(f"error={ex}")
             return result
         except ConnectionResetError as ex:
@@ -237,7 +764,10 @@ class ModbusInterface:
                 "command": command_name,
                 "errors": ex,
             }
-            self.online = self.is_online()
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            self._record_failure(ex)
             self.logger.error(f"ConnectionResetError error={ex}")
             return result
 
@@ -246,7 +776,12 @@ class ModbusInterface:
                 "command": command_name,
                 "errors": ex,
             }
-            self.online = self.is_online()
+            self.metrics.record(
+                command_name, function_code, length, time.perf_counter() - start, ex
+            )
+            if self.adaptive_timeout is not None:
+                self._record_round_trip(start, ex)
+            self._record_failure(ex)
             self.logger.error(f"Exception: {ex}")
             return result
         # TODO: catching socket.timeout doesn't work.
@@ -276,62 +811,29 @@ class ModbusInterface:
                         )
             return result
 
-    def scale_response(
-        self, response, command_name: str, force_full_register_read=False
-    ):
-
-        command_config = self.device_config[command_name]
-        bit_position = command_config.get("bit_position")
-        scale_factor = self.device_config[command_name].get("scale_factor")
-        units = self.device_config[command_name].get("units")
-        values = []
-        errors = []  # TODO: add errors as they come up
-
-        for value in response:
-            if scale_factor:
-                values.append(value * scale_factor)
-            elif force_full_register_read:
-                values.append(value)
-            elif bit_position is not None:
-                bit_value = get_bit(value, bit_position=bit_position)
-                values.append(bit_value)
-                self.logger.info(
-                    f"{tc.Red}"
-                    f"{command_name}\n"
-                    f"response: {response}\n"
-                    f"scale_factor: {scale_factor}\n"
-                    f"force_full_register_read: {force_full_register_read}\n"
-                    f"bit_position: {bit_position}\n"
-                    f"bit_value: {bit_value}"
-                    f"{tc.RESET}"
+    def read_modbus(self, parameter: str, force_full_register_read=False, max_age=None):
+        """
+        Read a parameter. With max_age (in seconds) the value is taken from the register
+        cache when every register was read (or written) less than max_age seconds ago.
+        """
+        spec = self.read_commands.get(parameter)
+        if spec is None:
+            raise KeyError(f"{parameter}_READ")
+        if max_age is not None:
+            registers = self.register_cache.get(
+                self.slave_id, spec.function_code, spec.start, spec.length, max_age
+            )
+            if registers is not None:
+                return self.scale_spec_response(
+                    spec.decode(registers), spec, force_full_register_read
                 )
-            else:
-                values.append(value)
-
-        results = {
-            "device_name": self.device_name,
-            "command": command_name,
-            "values": values,
-            "units": units,
-        }
-
-        # If there are errors, add them to the result.
-        # The ModbusMasterThread will check if there are errors, and if there are not then it will send a return
-        # status of OK
-        if errors:
-            results["errors"] = errors
-
-        return results
-
-    def read_modbus(self, parameter: str, force_full_register_read=False):
-
-        command_name = f"{parameter}_READ"
-        result: list = self.execute_modbus_command(command_name)
+        result: list = self.execute_command_spec(spec)
         self.logger.debug(f"result: {result}")
         if result.get("errors"):
             return result
-        result = self.scale_response(
-            result["response"], command_name, force_full_register_read
+        self.cache_registers(spec, result["response"])
+        result = self.scale_spec_response(
+            result["response"], spec, force_full_register_read
         )
 
         if self.debug_mode:
@@ -339,123 +841,318 @@ class ModbusInterface:
 
         return result
 
-    def write_modbus(self, parameter: str, values: list):
+    def read_block(self, block: ReadBlock):
+        """Read all registers covered by block in a single transaction."""
+        if not self.health.allow_request():
+            return {"command": block.name, "errors": self.health.down_error()}
+        if not self.master:
+            return {"command": block.name, "errors": "No Modbus master"}
+        return self._execute(
+            block.name, block.slave_id, block.function_code, block.start, block.length
+        )
 
-        command_name = f"{parameter}_WRITE"
-        command_config = self.device_config[command_name]
+    def read_plan(self, plan: ReadPlan, force_full_register_read=False):
+        """
+        Execute a compiled read plan and return one result per parameter, in the order
+        the parameters were given to compile_read_plan. The results are identical to
+        the ones returned by read_modbus.
+        """
+        results = [None] * len(plan.parameters)
 
-        starting_address = self.device_config[command_name].get("start")
-        register_length = self.device_config[command_name].get("length")
-        data_format = self.device_config[command_name].get("data_format", "")
-        scale_factor = self.device_config[command_name].get("scale_factor")
-        units = self.device_config[command_name].get("units", "")
+        for block in list(plan.blocks):
+            block_results = self.decode_block(
+                block, self.read_block(block), force_full_register_read
+            )
+            if block_results is None:
+                # the plan is kept by its poll group or read_many, do not retry the block
+                plan.split(block)
+                continue
+            for index, result in block_results:
+                results[index] = result
 
-        bit_position = command_config.get("bit_position")
+        for index, parameter in plan.singles:
+            results[index] = self.read_modbus(parameter, force_full_register_read)
 
-        values_to_write = []
-        if bit_position:
-            # Get Current registry values:
-            current_registry_value = self.read_modbus(
-                parameter, force_full_register_read=True
-            )["values"]
-            self.logger.debug(
-                f"ModbusInterface | write_modbus | Read current_registry_value before write: {current_registry_value}"
-            )
+        if self.debug_mode:
+            self.logger.info(f"ModbusInterface | read_plan | Modbus results: {results}")
 
-            bit_value = values[0]
-            value = set_bit(current_registry_value[0], bit_position, bit_value)
-            self.logger.debug(
-                f"ModbusInterface | write_modbus | value after setting bit: {value}"
+        return results
+
+    def read_many(self, parameters, force_full_register_read=False, max_age=None):
+        """
+        Read several parameters with as few transactions as possible (see read_plan) and
+        return {parameter: result}. Each result is the one read_modbus would return, or
+        carries the error of that parameter.
+        """
+        results = {}
+        to_read = []
+        for parameter in parameters:
+            if parameter in results or parameter in to_read:
+                continue
+            if parameter not in self.read_commands:
+                results[parameter] = {
+                    "command": f"{parameter}_READ",
+                    "errors": f"{parameter}_READ is not defined",
+                }
+            elif max_age is not None:
+                # answered from the register cache or read as part of the plan
+                spec = self.read_commands[parameter]
+                registers = self.register_cache.get(
+                    self.slave_id, spec.function_code, spec.start, spec.length, max_age
+                )
+                if registers is None:
+                    to_read.append(parameter)
+                else:
+                    results[parameter] = self.scale_spec_response(
+                        spec.decode(registers), spec, force_full_register_read
+                    )
+            else:
+                to_read.append(parameter)
+
+        if to_read:
+            plan = self._read_plans.get(tuple(to_read))
+            if plan is None:
+                if len(self._read_plans) >= ModbusSystem.ReadPlan.CachedPlans:
+                    self._read_plans.clear()
+                plan = self._read_plans[tuple(to_read)] = self.compile_read_plan(to_read)
+            for parameter, result in zip(
+                to_read, self.read_plan(plan, force_full_register_read)
+            ):
+                results[parameter] = result
+        return {parameter: results[parameter] for parameter in parameters}
+
+    def write_many(self, assignments):
+        """
+        Write several parameters ([(parameter, values)], or {parameter: values}) in the order
+        given, with as few transactions as possible, and return one write_modbus result per
+        entry. Bit writes that follow each other and address the same register are applied
+        together (see write_bits), and WRITE_MULTIPLE_REGISTERS writes that follow each other
+        and address consecutive registers are merged into one write.
+        """
+        if isinstance(assignments, dict):
+            assignments = assignments.items()
+        results = []
+        run = []  # [(spec, values, encoded registers or None for a bit)] written together
+        for parameter, values in assignments:
+            spec = self.write_commands.get(parameter)
+            entry = result = None
+            if spec is None:
+                result = {"command": f"{parameter}_WRITE", "errors": f"{parameter}_WRITE is not defined"}
+            elif spec.bit_position is not None:
+                entry = (spec, values, None)
+            elif spec.function_code == cst.WRITE_MULTIPLE_REGISTERS:
+                try:
+                    entry = (spec, values, spec.encode(self.encode_write_values(spec, values)))
+                except (struct.error, TypeError, ValueError) as ex:
+                    result = {"command": spec.name, "errors": ex}
+
+            if run and (entry is None or not self.joins_run(run, entry)):
+                results.extend(self.write_run(run))
+                run = []
+            if entry is not None:
+                run.append(entry)
+            elif result is None:
+                results.append(self.write_modbus(parameter, values))
+            else:
+                results.append(result)
+        results.extend(self.write_run(run))
+        return results
+
+    @staticmethod
+    def joins_run(run, entry):
+        """
+        Whether entry can be written together with the run before it: bits of the same
+        register, each set once, or registers that continue the run's WRITE_MULTIPLE_REGISTERS.
+        """
+        spec, _, encoded = entry
+        last, _, last_encoded = run[-1]
+        if spec.bit_position is not None or last.bit_position is not None:
+            return (
+                spec.bit_position is not None
+                and last.bit_position is not None
+                and spec.start == last.start
+                and all(run_spec is not spec for run_spec, _, _ in run)
             )
-            values_to_write.append(value)
-        elif scale_factor:
-            for value in values:
-                scaled_value = value / scale_factor
-                # TODO: There are likely some cases that this implementation does not cover.
-                #  for example, if data_format is defined as >H. This was not handled in the
-                #  prior implementation either.
-                if data_format == "" or data_format in [">H", ">h", ">I", ">i"]:
-                    # Why cast this as an int?
-                    # Because the division above causes it to be a float
-                    # and if data_format is not specified the modbus_tk library will
-                    # set it to either shorts (e.g,.  data_format = ">" + (quantity_of_x * "H"))
-                    # or unsigned characters, so we make sure
-                    # the input is an int before sending it.
-                    scaled_value = int(scaled_value)
-                values_to_write.append(scaled_value)
-        else:
-            values_to_write = values
+        end = last.start + len(last_encoded)
+        return spec.start == end and end + len(encoded) - run[0][0].start <= MAX_WRITE_REGISTERS
 
-        result: list = self.execute_modbus_command(
-            command_name, value_to_write=values_to_write
-        )
-        #  https://ozeki.hu/p_5883-mobdbus-function-code-16-write-multiple-holding-registers.html
+    def write_run(self, run):
+        """Write a run of write_many entries that joins_run accepted, returns one result per entry."""
+        if not run:
+            return []
+        if run[0][0].bit_position is not None:
+            return [
+                result
+                for _, result in self.write_register_bits([(spec, values[0]) for spec, values, _ in run])
+            ]
+        return self.write_block(run)
+
+    def write_block(self, block):
+        """
+        Write a run of adjacent registers ([(spec, values, encoded registers)]) with one
+        WRITE_MULTIPLE_REGISTERS, returns one result per entry.
+        """
+        first = block[0][0]
+        if len(block) == 1:
+            spec, values, encoded = block[0]
+            return [self.write_modbus(spec.parameter, values)]
+
+        words = [word for _, _, encoded in block for word in encoded]
+        name = "+".join(spec.name for spec, _, _ in block)
+        if not self.health.allow_request():
+            result = {"command": name, "errors": self.health.down_error()}
+        elif not self.master:
+            result = {"command": name, "errors": "No Modbus master"}
+        else:
+            result = self._execute(
+                name,
+                self.slave_id,
+                cst.WRITE_MULTIPLE_REGISTERS,
+                first.start,
+                len(words),
+                words,
+            )
+            if not result.get("errors") and result["response"] != [first.start, len(words)]:
+                result = {"command": name, "errors": f"Unexpected response {result['response']}"}
 
-        # In response to a successful WRITE command the modbus returns
-        # 1: The starting address of the parameters
-        # 2: The number of registers written.
         if result.get("errors"):
             self.logger.error(
-                f"{tc.Red}"
-                f"ModbusInterface | write_modbus | "
-                f"{result['errors']}"
-                f"{tc.RESET}"
+                f"{tc.Red}ModbusInterface | write_many | {name}: {result['errors']}{tc.RESET}"
             )
-            return result
+            self.register_cache.invalidate(
+                self.slave_id, cst.WRITE_MULTIPLE_REGISTERS, first.start, len(words)
+            )
+            return [{"command": spec.name, "errors": result["errors"]} for spec, _, _ in block]
 
-        response = result["response"]
-        self.logger.debug(
-            f"ModbusInterface | write_modbus | Response to writing value: {response}"
+        self.register_cache.update(
+            self.slave_id, cst.WRITE_MULTIPLE_REGISTERS, first.start, words
         )
-        if len(response) != 2:
-            self.logger.warning(
-                f"{tc.Red}"
-                f"ModbusInterface | write_modbus | "
-                f"If this happens update code."
-                f"Response wrong length: {response}"
-                f"{tc.RESET}"
-            )
-            error = f"Response wrong length"
-            result = {
-                "command": command_name,
-                "values": [],
-                "units": units,
-                "errors": error,
-            }
-            return result
-        if response[0] != starting_address:
-            self.logger.warning(
-                f"{tc.Red}"
-                f"ModbusInterface | write_modbus | "
-                f"If this happens update code."
-                f"Parameter mismatch: {response}"
-                f"{tc.RESET}"
-            )
-            error = f"Modbus Parameter mismatch"
-            result = {
-                "command": command_name,
-                "values": [],
-                "units": units,
-                "errors": error,
+        return [
+            {
+                "device_name": self.device_name,
+                "command": spec.name,
+                "values": values,
+                "units": spec.units,
             }
-            return result
+            for spec, values, _ in block
+        ]
 
-        # Since a WRITE command does not return the written value, we insert the written value
-        # manually into the response, and as a result we do not need to scale it.
-        # result = self.scale_response([response[1]], command_name, force_full_register_read=True)
-        # result = self.scale_response(values, command_name, force_full_register_read=True)
-        result = {
-            "device_name": self.device_name,
-            "command": command_name,
-            "values": values,
-            "units": units,
-        }
+    def write_modbus(self, parameter: str, values: list):
 
-        if self.debug_mode:
-            self.logger.info(f"Modbus result: {result}")
+        spec = self.write_commands.get(parameter)
+        if spec is None:
+            raise KeyError(f"{parameter}_WRITE")
+
+        if spec.bit_position is not None:
+            return self.write_bits({parameter: values[0]})[0]
+
+        values_to_write = self.encode_write_values(spec, values)
+        result: list = self.execute_command_spec(
+            spec, value_to_write=values_to_write
+        )
+        result = self.write_result(spec, values, result)
+        if result.get("errors"):
+            # the registers may or may not have been written
+            self.register_cache.invalidate(
+                self.slave_id, spec.function_code, spec.start, spec.length
+            )
+        else:
+            self.cache_registers(spec, values_to_write)
         return result
 
+    def write_bits(self, assignments: dict):
+        """
+        Write several bit parameters ({parameter: 0 or 1}) and return one write_modbus result
+        per parameter, in order. The bits that share a register are applied together: with
+        one FC22 mask write when the device configuration sets Mask_Write, otherwise with
+        one read and one write of the register, during which no other bit write of this
+        interface can touch it.
+        """
+        registers = {}
+        for parameter, bit_value in assignments.items():
+            spec = self.write_commands.get(parameter)
+            if spec is None:
+                raise KeyError(f"{parameter}_WRITE")
+            if spec.bit_position is None:
+                raise ValueError(f"{spec.name} has no bit_position")
+            registers.setdefault(spec.start, []).append((spec, bit_value))
+
+        results = {}
+        for start, bits in registers.items():
+            for spec, result in self.write_register_bits(bits):
+                results[spec.parameter] = result
+        return [results[parameter] for parameter in assignments]
+
+    def write_register_bits(self, bits):
+        """Apply [(spec, bit value)] that address the same register, see write_bits."""
+        spec = bits[0][0]
+        if not self.health.allow_request():
+            error = {"command": spec.name, "errors": self.health.down_error()}
+            return [(bit_spec, dict(error, command=bit_spec.name)) for bit_spec, _ in bits]
+        if not self.master:
+            error = {"command": spec.name, "errors": "No Modbus master"}
+            return [(bit_spec, dict(error, command=bit_spec.name)) for bit_spec, _ in bits]
+
+        if self.mask_write:
+            mask = set_mask = 0
+            for bit_spec, bit_value in bits:
+                mask |= 1 << bit_spec.bit_position
+                if bit_value:
+                    set_mask |= 1 << bit_spec.bit_position
+            result = self._execute(
+                spec.name,
+                self.slave_id,
+                cst.MASK_WRITE_REGISTER,
+                spec.start,
+                1,
+                (0xFFFF ^ mask, set_mask),
+            )
+            # the other bits of the register are not known
+            self.register_cache.invalidate(self.slave_id, spec.function_code, spec.start, 1)
+            if result.get("errors"):
+                self.logger.error(
+                    f"{tc.Red}ModbusInterface | write_bits | {result['errors']}{tc.RESET}"
+                )
+            return [
+                (bit_spec, self.bit_result(bit_spec, bit_value, result))
+                for bit_spec, bit_value in bits
+            ]
+
+        with self._bit_write_lock:
+            current = self._execute(
+                spec.name, self.slave_id, cst.READ_HOLDING_REGISTERS, spec.start, 1
+            )
+            if current.get("errors"):
+                return [
+                    (bit_spec, self.bit_result(bit_spec, bit_value, current))
+                    for bit_spec, bit_value in bits
+                ]
+            value = current["response"][0]
+            for bit_spec, bit_value in bits:
+                value = set_bit(value, bit_spec.bit_position, bit_value)
+            self.logger.debug(
+                f"ModbusInterface | write_bits | register {spec.start}: "
+                f"{current['response'][0]:#06x} -> {value:#06x}"
+            )
+            result = self.write_result(
+                spec, [value], self.execute_command_spec(spec, value_to_write=[value])
+            )
+            if result.get("errors"):
+                self.register_cache.invalidate(self.slave_id, spec.function_code, spec.start, 1)
+            else:
+                self.register_cache.update(self.slave_id, spec.function_code, spec.start, [value])
+        return [
+            (bit_spec, self.bit_result(bit_spec, bit_value, result))
+            for bit_spec, bit_value in bits
+        ]
+
     def close(self):
+        self.health.stop()
+        if self.request_queue is not None:
+            self.request_queue.stop()
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.close()
+            self.traffic_recorder = None
         if self.master:
             self.master.close()
             self.master = None
@@ -1,12 +1,30 @@
+import itertools
 import logging
+import pathlib
+import struct
 import threading
+import time
 import zmq
 
+from riaps.interfaces.modbus.connection_pool import Priority, request_priority
+from riaps.interfaces.modbus.deadband import load_deadband_filters
+from riaps.interfaces.modbus.events import PollBatch
 from riaps.interfaces.modbus.ModbusInterface import ModbusInterface
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+from riaps.interfaces.modbus.poll_scheduler import PollGroup, PollScheduler, load_poll_groups
+from riaps.interfaces.modbus.sample_log import SampleLog
+from riaps.interfaces.modbus.timeseries import load_history_buffers
 
 
 class ModbusMaster(threading.Thread):
-    def __init__(self, path_to_config_file, logger=None, command_port=None, event_port=None):
+    def __init__(self, path_to_config_file, logger=None, command_port=None, event_port=None, start_polling=True,
+                 modbus_interface=None):
+        """
+        With start_polling=False no polling thread is started and the device is driven by a
+        ModbusIOLoop through handle_command, scheduled_groups and run_group instead.
+        modbus_interface is used instead of a new ModbusInterface for path_to_config_file,
+        e.g. one that startup.start_interfaces is still bringing online.
+        """
         super().__init__()
 
         local_logger = logging.getLogger(__name__)
@@ -27,12 +45,37 @@ class ModbusMaster(threading.Thread):
             self.event_port_plug = event_port.setupPlug(self)
         #     self.port_poller.register(self.event_port_plug, zmq.POLLIN)
 
-        self.modbus_interface = ModbusInterface(path_to_file=path_to_config_file, logger=self.logger)
+        if modbus_interface is None:
+            modbus_interface = ModbusInterface(path_to_file=path_to_config_file, logger=self.logger)
+        self.modbus_interface = modbus_interface
         self.device_config = self.modbus_interface.device_config
 
+        if start_polling and self.device_config.get("Request_Queue", ModbusSystem.RequestQueue.Enabled):
+            # the command and polling threads share the device, commands go first
+            self.modbus_interface.enable_request_queue()
+
+        self.deadband_filters = load_deadband_filters(self.device_config)
+        self.batch_events = self.device_config.get("Poll_Batch_Events", ModbusSystem.Reporting.BatchEvents)
+        self.metrics_interval = self.device_config.get("Metrics_Publish_Seconds", ModbusSystem.Metrics.PublishSeconds)
+
+        self.history = load_history_buffers(self.device_config, ModbusSystem.History.Samples)
+        self.sample_log = None
+        sample_log_directory = self.device_config.get("Sample_Log_Directory")
+        if sample_log_directory:
+            self.sample_log = SampleLog(
+                pathlib.Path(sample_log_directory) / self.modbus_interface.device_name,
+                segment_records=self.device_config.get("Sample_Log_Segment_Records",
+                                                       ModbusSystem.SampleLog.SegmentRecords),
+                max_segments=self.device_config.get("Sample_Log_Segments", ModbusSystem.SampleLog.MaxSegments),
+            )
+
+        self.metrics_group = None
+
         self.stop_polling = threading.Event()
-        self.polling_thread = threading.Thread(target=self.poller)
-        self.polling_thread.start()
+        self.polling_thread = None
+        if start_polling:
+            self.polling_thread = threading.Thread(target=self.poller)
+            self.polling_thread.start()
 
     def run(self):
         if not self.command_port_plug:
@@ -44,59 +87,198 @@ class ModbusMaster(threading.Thread):
                 continue
             msg = self.command_port_plug.recv_pyobj()
             self.logger.info(f"ModbusMasterThread | run | receive message on command port: {msg}")
+            self.command_port_plug.send_pyobj(self.handle_command(msg))
 
-            # read message and read modbus
-            operation = msg["operation"]
-            parameters = msg["parameters"]
-            param_values = msg["values"]
-            modbus_response_values = {"device_name": msg["to_device"],
-                                      "operation": operation,
-                                      "parameters": parameters,
-                                      "values": [],
-                                      "return_status": [],
-                                      "msgcounter": msg["msgcounter"]}
-            
-            for (parameter, values) in zip(parameters, param_values):
-                if operation == "READ":
-                    modbus_result = self.modbus_interface.read_modbus(parameter=parameter)
-                elif operation == "WRITE":
-                    # TODO: FIX THIS. EITHER SEND LIST OF LISTS OR PUT IN LIST
-                    modbus_result = self.modbus_interface.write_modbus(parameter=parameter, values=values)
-                else:
-                    # TODO: test this code.
-                    #  also consider updating the other instances of this data structure
-                    #  to use the return_status for the error messages instead of units or
-                    #  whatever is being used currently.
-                    modbus_result = {"device_name": msg["to_device"],
-                                     "parameter": f"{parameter}",
-                                     "operation": f"{operation}",
-                                     "values": None,
-                                     "units": None,
-                                     "errors": f"{parameter}_{operation} is not defined"
-                                     }
-                if not modbus_result:
-                    self.logger.warn(f"ModbusMasterThread | run | {operation} | modbus is unresponsive")
-                modbus_response_values["values"].append(modbus_result["values"])
-                modbus_response_values["return_status"].append(modbus_result.get("errors", "OK"))
-
-            self.command_port_plug.send_pyobj(modbus_response_values)
+    def handle_command(self, msg):
+        """Execute a message received on the command port and return the response to send back."""
+        # read message and read modbus
+        operation = msg["operation"]
+        parameters = msg["parameters"]
+        param_values = msg["values"]
+        modbus_response_values = {"device_name": msg["to_device"],
+                                  "operation": operation,
+                                  "parameters": parameters,
+                                  "values": [],
+                                  "return_status": [],
+                                  "msgcounter": msg["msgcounter"]}
 
-    def poller(self) -> None:
-        poll_interval = self.device_config.get("Poll_Interval_Seconds")
+        modbus_results = []
+        if operation == "READ":
+            with request_priority(Priority.COMMAND):
+                read_results = self.modbus_interface.read_many(parameters, max_age=msg.get("max_age"))
+            modbus_results = [read_results.get(parameter) for parameter in parameters]
+        elif operation == "WRITE":
+            # TODO: FIX THIS. EITHER SEND LIST OF LISTS OR PUT IN LIST
+            with request_priority(Priority.COMMAND):
+                modbus_results = self.modbus_interface.write_many(list(zip(parameters, param_values)))
+
+        for parameter, modbus_result in itertools.zip_longest(parameters, modbus_results):
+            if modbus_result is None:
+                # TODO: test this code.
+                #  also consider updating the other instances of this data structure
+                #  to use the return_status for the error messages instead of units or
+                #  whatever is being used currently.
+                modbus_result = {"device_name": msg["to_device"],
+                                 "parameter": f"{parameter}",
+                                 "operation": f"{operation}",
+                                 "values": None,
+                                 "units": None,
+                                 "errors": f"{parameter}_{operation} is not defined"
+                                 }
+            modbus_response_values["values"].append(modbus_result.get("values"))
+            modbus_response_values["return_status"].append(modbus_result.get("errors", "OK"))
+
+        return modbus_response_values
+
+    def setup_poll_groups(self):
+        poll_groups = []
+        coalesce = self.device_config.get("Poll_Coalesce_Reads", ModbusSystem.ReadPlan.Coalesce)
+        for group in load_poll_groups(self.device_config):
+            if not group.interval or group.interval <= 0:
+                self.logger.warn(f"No poll interval configured for {group.parameters}, they will not be polled")
+                continue
+            if coalesce:
+                group.read_plan = self.modbus_interface.compile_read_plan(group.parameters)
+            poll_groups.append(group)
+        return poll_groups
+
+    def poll_group(self, group):
+        if group.read_plan:
+            return self.modbus_interface.read_plan(group.read_plan)
+        modbus_results = []
+        for parameter in group.parameters:
+            self.logger.debug(f"poll parameter: {parameter}")
+            modbus_results.append(self.modbus_interface.read_modbus(parameter=parameter))
+        return modbus_results
+
+    def record_history(self, group, modbus_results):
+        timestamp = time.time()
+        for parameter, modbus_result in zip(group.parameters, modbus_results):
+            ring_buffer = self.history.get(parameter)
+            if ring_buffer is None or modbus_result.get("errors") or not modbus_result.get("values"):
+                continue
+            try:
+                ring_buffer.append(timestamp, modbus_result["values"])
+            except (TypeError, ValueError) as ex:
+                self.logger.warn(f"ModbusMasterThread | record_history | {parameter}: {ex}")
+
+    def log_samples(self, group, modbus_results):
+        timestamp = time.time()
+        interface = self.modbus_interface
+        for parameter, modbus_result in zip(group.parameters, modbus_results):
+            if modbus_result.get("errors"):
+                self.sample_log.append(timestamp, parameter, error=True)
+                continue
+            spec = interface.read_commands.get(parameter)
+            registers = None
+            if spec is not None:
+                registers = interface.register_cache.peek(interface.slave_id, spec.function_code,
+                                                          spec.start, spec.length)
+            try:
+                self.sample_log.append(timestamp, parameter, modbus_result.get("values"), registers or ())
+            except (TypeError, ValueError, struct.error) as ex:
+                self.logger.warn(f"ModbusMasterThread | log_samples | {parameter}: {ex}")
+
+    def close_sample_log(self):
+        if self.sample_log is not None:
+            self.sample_log.close()
+
+    def get_history(self, parameter, samples=None, since=None):
+        """
+        (timestamps, values) views of the polled history of parameter, see RingBuffer.window.
+        None if no history is kept for it.
+        """
+        ring_buffer = self.history.get(parameter)
+        if ring_buffer is None:
+            return None
+        return ring_buffer.window(samples=samples, since=since)
+
+    def publish(self, group, modbus_results, batch=None):
+        if self.history:
+            self.record_history(group, modbus_results)
+        if self.sample_log is not None:
+            self.log_samples(group, modbus_results)
+        if not self.event_port_plug:
+            return
+        now = time.monotonic()
+        for parameter, modbus_result in zip(group.parameters, modbus_results):
+            deadband_filter = self.deadband_filters.get(parameter)
+            if deadband_filter and not deadband_filter.should_report(modbus_result, now):
+                continue
+            if batch is not None:
+                batch.add(parameter, modbus_result)
+            else:
+                self.event_port_plug.send_pyobj(modbus_result)
+
+    def publish_batch(self, batch):
+        if self.event_port_plug and batch:
+            self.event_port_plug.send_pyobj(batch.as_message())
+
+    def publish_metrics(self):
+        if self.event_port_plug:
+            self.event_port_plug.send_pyobj({"device_name": self.modbus_interface.device_name,
+                                             "command": "METRICS",
+                                             "values": self.modbus_interface.get_metrics()})
+
+    def report_overrun(self, group, missed):
+        overrun = {"device_name": self.modbus_interface.device_name,
+                   "command": "POLL_OVERRUN",
+                   "parameters": group.parameters,
+                   "values": [group.last_duration],
+                   "units": "s",
+                   "errors": ModbusSystem.Errors.PollTimerOverrun}
+        self.logger.warn(f"ModbusMasterThread | poller | Poll of {group.parameters} took {group.last_duration:.3f} s, "
+                         f"longer than its {group.interval} s interval, {missed} poll(s) skipped")
+        if self.event_port_plug:
+            self.event_port_plug.send_pyobj(overrun)
+
+    def scheduled_groups(self):
+        """The poll groups of the device, plus a group that publishes the metrics if configured."""
         parameters_to_poll = self.device_config.get("poll")
 
         if not parameters_to_poll:
             self.logger.warn("No parameters configured to poll")
-            return
+            return []
 
         self.logger.debug(f"parameters_to_poll: {parameters_to_poll}")
-        while not self.stop_polling.wait(timeout=poll_interval):
-            for parameter in parameters_to_poll:
-                self.logger.debug(f"poll parameter: {parameter}")
-                modbus_result = self.modbus_interface.read_modbus(parameter=parameter)
-                if self.event_port_plug:
-                    self.event_port_plug.send_pyobj(modbus_result)
-
+        poll_groups = self.setup_poll_groups()
+        if poll_groups and self.metrics_interval and self.metrics_interval > 0:
+            self.metrics_group = PollGroup(self.metrics_interval, [])
+            poll_groups.append(self.metrics_group)
+        return poll_groups
 
+    def new_batch(self):
+        return PollBatch(self.modbus_interface.device_name) if self.batch_events else None
 
+    def run_group(self, scheduler, group, batch=None):
+        """Poll and publish a group popped from the scheduler, then schedule its next cycle."""
+        if group is self.metrics_group:
+            self.publish_metrics()
+            scheduler.reschedule(group)
+            return
+        if not self.modbus_interface.started.is_set():
+            # the device is still being probed and connected
+            scheduler.reschedule(group)
+            return
+        start = time.monotonic()
+        modbus_results = self.poll_group(group)
+        self.publish(group, modbus_results, batch)
+        finished = time.monotonic()
+        group.last_duration = finished - start
+        missed = scheduler.reschedule(group, finished)
+        self.modbus_interface.metrics.record_poll(group.interval, group.last_duration, missed)
+        if missed:
+            self.report_overrun(group, missed)
 
+    def poller(self) -> None:
+        poll_groups = self.scheduled_groups()
+        if not poll_groups:
+            return
+        scheduler = PollScheduler(poll_groups)
+        while not self.stop_polling.wait(timeout=scheduler.time_to_next_deadline()):
+            batch = self.new_batch()
+            for group in scheduler.pop_due():
+                self.run_group(scheduler, group, batch)
+            if batch is not None:
+                self.publish_batch(batch)
+        self.close_sample_log()
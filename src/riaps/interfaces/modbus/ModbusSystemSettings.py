@@ -5,6 +5,10 @@ class ModbusSystem:
     class Timeouts:
         TCPComm = 2000      # milliseconds
         TTYSComm = 100      # milliseconds
+        Adaptive = True     # per-device timeouts from measured round trips, TCPComm/TTYSComm are the ceilings
+        AdaptiveFloorTCP = 250  # milliseconds
+        AdaptiveFloorTTYS = 50  # milliseconds
+        RTUFrameGapChars = 3.5  # silent interval between two RTU frames on a shared bus, in characters
         RetriesTCP = -1        
         RetriesTTYS = -1     
     class Errors:
@@ -20,5 +24,43 @@ class ModbusSystem:
     class DataRanges:
         MAX_FLT32 = 3.402e38
         MIN_FLT32 = 1.401e-45
+    class ReadPlan:
+        Coalesce = True         # merge the poll list into block reads
+        MaxBlockRegisters = 125 # Modbus PDU limit for READ_HOLDING/INPUT_REGISTERS
+        MaxRegisterGap = 0      # unused registers allowed between two merged reads
+        CachedPlans = 64        # read plans read_many keeps for parameter lists it has seen
+    class Reporting:
+        IntegritySeconds = 60   # deadband filtered parameters are sent at least this often
+        BatchEvents = False     # send one columnar message per poll cycle instead of one per parameter
+    class Startup:
+        DeadlineSeconds = 5.0   # activation waits at most this long for the devices to come online
+        MaxWorkers = 32         # devices probed and connected at the same time
+    class ConfigCache:
+        Enabled = True          # keep validated, compiled device configurations to skip YAML parsing on restart
+        Directory = None        # None for $XDG_CACHE_HOME (~/.cache)/riaps-modbus-config
+    class History:
+        Samples = 0             # ring buffer capacity per polled parameter, 0 keeps no history
+    class SampleLog:
+        SegmentRecords = 65536  # records per memory-mapped segment file of the sample log (32 bytes each)
+        MaxSegments = 16        # segments kept, the oldest is deleted when a new one is started
+    class BitWrites:
+        MaskWrite = False       # write bit parameters with FC22 Mask Write Register, if the device supports it
+    class Health:
+        FailureThreshold = 3    # consecutive failed requests before a device is considered down
+        BackoffInitialSeconds = 1.0
+        BackoffMaxSeconds = 60.0
+    class Metrics:
+        SignificantBits = 4     # latency histogram resolution, relative error below 2**(1 - SignificantBits)
+        PublishSeconds = 0      # period of the METRICS message on the event port, 0 to disable
+    class RequestQueue:
+        Enabled = True          # commands and polls of a ModbusMaster go through one prioritized queue
+    class IOLoop:
+        Loops = 0               # number of ModbusIOLoop threads serving all devices, 0 for a ModbusMaster per device
+    class ConnectionPool:
+        Enabled = True          # share one socket between the devices behind the same TCP endpoint
+    class Transport:
+        LeanTCP = False         # TCP devices use LeanTcpMaster (preallocated frames, no modbus_tk logging or hooks)
+    class Async:
+        MaxOutstandingRequests = 1  # pipelined requests per connection, raise if the device supports it
         
            
@@ -0,0 +1,65 @@
+import asyncio
+import socket
+import threading
+
+from modbus_tk import exceptions as modbus_exceptions
+
+
+class ResponseTimeout(modbus_exceptions.ModbusInvalidResponseError):
+    """A serial slave sent nothing within the timeout, see connection_pool.RtuMaster."""
+
+
+def is_timeout(error):
+    """Whether a failed request got no response in time."""
+    return isinstance(error, (socket.timeout, TimeoutError, asyncio.TimeoutError, ResponseTimeout))
+
+
+class AdaptiveTimeout:
+    """
+    Response timeout of one device, estimated from its measured round-trip times the way
+    TCP estimates its retransmission timeout (RFC 6298): a smoothed round trip plus k times
+    its mean deviation, kept between floor and ceiling. A timeout doubles it, the next
+    measured round trip brings it back to the estimate. It starts at the ceiling.
+    """
+
+    def __init__(self, floor, ceiling, k=4.0, alpha=0.125, beta=0.25):
+        self.floor = min(floor, ceiling)
+        self.ceiling = ceiling
+        self.k = k
+        self.alpha = alpha
+        self.beta = beta
+        self.timeout = ceiling
+        self.smoothed = None
+        self.deviation = None
+        self.samples = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def observe(self, round_trip):
+        with self._lock:
+            if self.smoothed is None:
+                self.smoothed = round_trip
+                self.deviation = round_trip / 2
+            else:
+                self.deviation += self.beta * (abs(self.smoothed - round_trip) - self.deviation)
+                self.smoothed += self.alpha * (round_trip - self.smoothed)
+            self.samples += 1
+            self.timeout = min(max(self.smoothed + self.k * self.deviation, self.floor), self.ceiling)
+
+    def backoff(self):
+        with self._lock:
+            self.timeouts += 1
+            self.timeout = min(2 * self.timeout, self.ceiling)
+
+    def as_dict(self):
+        """Times in milliseconds."""
+        with self._lock:
+            return {
+                "timeout": 1000 * self.timeout,
+                "smoothed_round_trip": None if self.smoothed is None else 1000 * self.smoothed,
+                "round_trip_deviation": None if self.deviation is None else 1000 * self.deviation,
+                "floor": 1000 * self.floor,
+                "ceiling": 1000 * self.ceiling,
+                "samples": self.samples,
+                "timeouts": self.timeouts,
+            }
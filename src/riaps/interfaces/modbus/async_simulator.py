@@ -0,0 +1,381 @@
+"""
+Modbus TCP simulator serving many devices on one asyncio event loop, for load testing the
+master side. Every device configuration YAML in a directory becomes a slave id on the
+TCP port of its configuration, with registers covering the commands it defines:
+
+    python -m riaps.interfaces.modbus.async_simulator example/Minimal/cfg --address 127.0.0.1 --port-offset 5000
+"""
+import argparse
+import array
+import asyncio
+import logging
+import pathlib
+import struct
+import threading
+import time
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus.commands import compile_command_table
+from riaps.interfaces.modbus.config import load_config_file
+from riaps.interfaces.modbus.metrics import LatencyHistogram
+from riaps.interfaces.modbus.playback import PlaybackEngine
+from riaps.interfaces.modbus.protocol import MBAP, MBAP_LENGTH, build_mbap
+from riaps.interfaces.modbus.register_cache import TABLES
+
+GATEWAY_TARGET_FAILED_TO_RESPOND = 0x0B
+BIT_TABLES = ("coils", "discrete_inputs")
+
+
+class SimulatedDevice:
+    """The register tables of one slave, sized to the highest address its commands use."""
+
+    def __init__(self, name, slave_id, sizes):
+        self.name = name
+        self.slave_id = slave_id
+        self.tables = {
+            table: bytearray(size) if table in BIT_TABLES else array.array("H", bytes(2 * size))
+            for table, size in sizes.items()
+        }
+
+    @classmethod
+    def from_config(cls, device_config):
+        sizes = {}
+        for spec in compile_command_table(device_config).commands.values():
+            table = TABLES.get(spec.function_code)
+            if table is None:
+                continue
+            sizes[table] = max(sizes.get(table, 0), spec.start + spec.length)
+        return cls(device_config.get("Name"), device_config["SlaveID"], sizes)
+
+    def _table(self, name, start, count):
+        table = self.tables.get(name)
+        if table is None or count < 1 or start + count > len(table):
+            raise modbus_exceptions.ModbusError(cst.ILLEGAL_DATA_ADDRESS)
+        return table
+
+    def write_registers(self, function_code, start, registers):
+        """Set the registers read by function_code, e.g. from a PlaybackEngine."""
+        self.set_values(TABLES[function_code], start, registers)
+
+    def get_values(self, table, start, count):
+        return list(self._table(table, start, count)[start:start + count])
+
+    def set_values(self, table, start, values):
+        self._table(table, start, len(values))[start:start + len(values)] = (
+            bytearray(1 if value else 0 for value in values)
+            if table in BIT_TABLES
+            else array.array("H", values)
+        )
+
+    def handle(self, pdu):
+        """The response PDU of a request PDU, an exception response if it cannot be served."""
+        function_code = pdu[0]
+        try:
+            handler = HANDLERS.get(function_code)
+            if handler is None:
+                raise modbus_exceptions.ModbusError(cst.ILLEGAL_FUNCTION)
+            return handler(self, pdu)
+        except modbus_exceptions.ModbusError as ex:
+            return struct.pack(">BB", function_code | 0x80, ex.get_exception_code())
+        except (struct.error, IndexError, ValueError, OverflowError):
+            return struct.pack(">BB", function_code | 0x80, cst.ILLEGAL_DATA_VALUE)
+
+    def read_bits(self, pdu):
+        start, count = struct.unpack_from(">HH", pdu, 1)
+        bits = self.get_values(TABLES[pdu[0]], start, count)
+        packed = bytearray((count + 7) // 8)
+        for i, bit in enumerate(bits):
+            if bit:
+                packed[i // 8] |= 1 << (i % 8)
+        return struct.pack(">BB", pdu[0], len(packed)) + bytes(packed)
+
+    def read_registers(self, pdu):
+        start, count = struct.unpack_from(">HH", pdu, 1)
+        table = self._table(TABLES[pdu[0]], start, count)
+        return struct.pack(f">BB{count}H", pdu[0], 2 * count, *table[start:start + count])
+
+    def write_single_coil(self, pdu):
+        address, value = struct.unpack_from(">HH", pdu, 1)
+        if value not in (0, 0xFF00):
+            raise modbus_exceptions.ModbusError(cst.ILLEGAL_DATA_VALUE)
+        self.set_values("coils", address, [value])
+        return bytes(pdu[:5])
+
+    def write_single_register(self, pdu):
+        address, value = struct.unpack_from(">HH", pdu, 1)
+        self.set_values("holding_registers", address, [value])
+        return bytes(pdu[:5])
+
+    def write_multiple_coils(self, pdu):
+        start, count, _ = struct.unpack_from(">HHB", pdu, 1)
+        data = pdu[6:]
+        self.set_values("coils", start, [(data[i // 8] >> (i % 8)) & 1 for i in range(count)])
+        return bytes(pdu[:5])
+
+    def write_multiple_registers(self, pdu):
+        start, count, _ = struct.unpack_from(">HHB", pdu, 1)
+        self.set_values("holding_registers", start, struct.unpack_from(f">{count}H", pdu, 6))
+        return bytes(pdu[:5])
+
+    def mask_write_register(self, pdu):
+        address, and_mask, or_mask = struct.unpack_from(">HHH", pdu, 1)
+        (value,) = self.get_values("holding_registers", address, 1)
+        self.set_values("holding_registers", address, [(value & and_mask) | (or_mask & ~and_mask & 0xFFFF)])
+        return bytes(pdu[:7])
+
+    def read_write_multiple_registers(self, pdu):
+        read_start, read_count, write_start, write_count, _ = struct.unpack_from(">HHHHB", pdu, 1)
+        # the write is performed before the read
+        self.set_values("holding_registers", write_start, struct.unpack_from(f">{write_count}H", pdu, 10))
+        table = self._table("holding_registers", read_start, read_count)
+        return struct.pack(
+            f">BB{read_count}H", pdu[0], 2 * read_count, *table[read_start:read_start + read_count]
+        )
+
+
+HANDLERS = {
+    cst.READ_COILS: SimulatedDevice.read_bits,
+    cst.READ_DISCRETE_INPUTS: SimulatedDevice.read_bits,
+    cst.READ_HOLDING_REGISTERS: SimulatedDevice.read_registers,
+    cst.READ_INPUT_REGISTERS: SimulatedDevice.read_registers,
+    cst.WRITE_SINGLE_COIL: SimulatedDevice.write_single_coil,
+    cst.WRITE_SINGLE_REGISTER: SimulatedDevice.write_single_register,
+    cst.WRITE_MULTIPLE_COILS: SimulatedDevice.write_multiple_coils,
+    cst.WRITE_MULTIPLE_REGISTERS: SimulatedDevice.write_multiple_registers,
+    cst.MASK_WRITE_REGISTER: SimulatedDevice.mask_write_register,
+    cst.READ_WRITE_MULTIPLE_REGISTERS: SimulatedDevice.read_write_multiple_registers,
+}
+
+
+class AsyncSimulator:
+    """
+    Serves SimulatedDevices on any number of TCP endpoints from one event loop. Each
+    endpoint acts as a gateway: requests are routed by unit id to the device with that
+    slave id, unknown unit ids get a gateway exception response.
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.endpoints = {}
+        self.servers = []
+        self.connections = 0
+        self.open_connections = 0
+        self.requests = 0
+        self.exceptions = 0
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.latency = LatencyHistogram()
+        self.playback = None
+        self.started = None
+        self._loop = None
+        self._thread = None
+        # {_serve task: stream writer} of the open connections
+        self._connection_writers = {}
+
+    def add_device(self, address, port, device):
+        devices = self.endpoints.setdefault((address, port), {})
+        if device.slave_id in devices:
+            self.logger.warning(
+                f"AsyncSimulator | add_device | {device.name} skipped, slave id {device.slave_id} "
+                f"is already served on {address}:{port} by {devices[device.slave_id].name}"
+            )
+            return None
+        devices[device.slave_id] = device
+        return device
+
+    @classmethod
+    def from_config_directory(cls, directory, address=None, port_offset=0, playback_rate=10.0, logger=None):
+        """
+        A simulator for every TCP device configuration in directory. address overrides the
+        configured addresses, e.g. to serve all devices on localhost, and port_offset is
+        added to the configured ports. The playback sections of the configurations are
+        played playback_rate times per second.
+        """
+        simulator = cls(logger)
+        simulator.playback = PlaybackEngine(rate=playback_rate, logger=simulator.logger)
+        for path in sorted(pathlib.Path(directory).glob("*.yaml")):
+            device_config = load_config_file(path)
+            if not isinstance(device_config, dict) or device_config.get("Protocol") != "TCP" \
+                    or "SlaveID" not in device_config:
+                continue
+            device_config.setdefault("Name", path.stem)
+            tcp_config = device_config["TCP"]
+            device = simulator.add_device(
+                address or tcp_config["Address"],
+                tcp_config["Port"] + port_offset,
+                SimulatedDevice.from_config(device_config),
+            )
+            if device is not None and device_config.get("playback"):
+                simulator.playback.add_device(device_config, device.write_registers, base_directory=path.parent)
+        return simulator
+
+    def devices(self):
+        for devices in self.endpoints.values():
+            yield from devices.values()
+
+    async def start(self):
+        self.started = time.monotonic()
+        if self.playback is not None and self.playback.channels:
+            self.playback.start()
+        for (address, port), devices in self.endpoints.items():
+            server = await asyncio.start_server(
+                lambda reader, writer, devices=devices: self._serve(reader, writer, devices),
+                address,
+                port,
+                backlog=1024,
+            )
+            self.servers.append(server)
+        self.logger.info(
+            f"AsyncSimulator | start | serving {sum(map(len, self.endpoints.values()))} devices "
+            f"on {len(self.endpoints)} endpoints"
+        )
+
+    async def _serve(self, reader, writer, devices):
+        task = asyncio.current_task()
+        self._connection_writers[task] = writer
+        self.connections += 1
+        self.open_connections += 1
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_LENGTH)
+                transaction_id, _, length, unit_id = MBAP.unpack(header)
+                if length < 2:
+                    break
+                pdu = await reader.readexactly(length - 1)
+                received = time.perf_counter()
+                device = devices.get(unit_id)
+                if device is None:
+                    response = struct.pack(">BB", pdu[0] | 0x80, GATEWAY_TARGET_FAILED_TO_RESPOND)
+                else:
+                    response = device.handle(pdu)
+                if response[0] & 0x80:
+                    self.exceptions += 1
+                self.requests += 1
+                self.bytes_received += MBAP_LENGTH + len(pdu)
+                self.bytes_sent += MBAP_LENGTH + len(response)
+                self.latency.record(time.perf_counter() - received)
+                writer.write(build_mbap(transaction_id, unit_id, len(response)) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.open_connections -= 1
+            self._connection_writers.pop(task, None)
+            writer.close()
+
+    async def stop_servers(self):
+        """Stop listening and close the connections that are still open."""
+        if self.playback is not None:
+            self.playback.stop()
+        for server in self.servers:
+            server.close()
+        # closing a connection ends its _serve task at the next read, cancelling it instead
+        # makes the streams callback of Python 3.11 log the CancelledError
+        for writer in self._connection_writers.values():
+            writer.close()
+        tasks = list(self._connection_writers)
+        if tasks:
+            _, stuck = await asyncio.wait(tasks, timeout=1.0)
+            for task in stuck:
+                task.cancel()
+            await asyncio.gather(*stuck, return_exceptions=True)
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+
+    def start_in_thread(self, timeout=10.0):
+        """
+        Run the simulator on an event loop in a background thread, returns once it is listening.
+        Raises what start raised, e.g. OSError for a port in use, or TimeoutError if it is not
+        listening after timeout seconds.
+        """
+        ready = threading.Event()
+        errors = []
+        self._loop = asyncio.new_event_loop()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.start())
+            except BaseException as ex:
+                errors.append(ex)
+                self._loop.run_until_complete(self.stop_servers())
+                self._loop.close()
+                return
+            finally:
+                ready.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop_servers())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, name="AsyncSimulator", daemon=True)
+        self._thread.start()
+        if not ready.wait(timeout):
+            # stopping the loop fails the pending start
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._loop = None
+            raise TimeoutError(f"AsyncSimulator not listening after {timeout} s")
+        if errors:
+            self._thread.join()
+            self._loop = None
+            raise errors[0]
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop = None
+
+    def get_stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        return {
+            "devices": sum(map(len, self.endpoints.values())),
+            "endpoints": len(self.endpoints),
+            "connections": self.connections,
+            "open_connections": self.open_connections,
+            "requests": self.requests,
+            "exception_responses": self.exceptions,
+            "requests_per_s": self.requests / elapsed if elapsed else None,
+            "bytes_received": self.bytes_received,
+            "bytes_sent": self.bytes_sent,
+            "latency": self.latency.as_dict(),
+            "playback": {
+                "channels": len(self.playback.channels),
+                "ticks": self.playback.ticks,
+                "overruns": self.playback.overruns,
+            } if self.playback is not None else None,
+        }
+
+
+async def serve(simulator, stats_seconds):
+    await simulator.start()
+    while True:
+        await asyncio.sleep(stats_seconds)
+        simulator.logger.info(f"AsyncSimulator | stats | {simulator.get_stats()}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("config_directory", help="directory of device configuration YAML files")
+    parser.add_argument("--address", help="serve all devices on this address instead of the configured ones")
+    parser.add_argument("--port-offset", type=int, default=0, help="added to the configured ports")
+    parser.add_argument("--playback-rate", type=float, default=10.0, help="updates per second of the playback signals")
+    parser.add_argument("--stats-seconds", type=float, default=10.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    simulator = AsyncSimulator.from_config_directory(
+        args.config_directory, address=args.address, port_offset=args.port_offset,
+        playback_rate=args.playback_rate,
+    )
+    try:
+        asyncio.run(serve(simulator, args.stats_seconds))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import struct
+
+import modbus_tk.defines as cst
+
+# data formats for which modbus_tk expects integers when writing scaled values
+INTEGER_WRITE_FORMATS = ("", ">H", ">h", ">I", ">i")
+# how modbus_tk packs a register value without data_format, by its sign
+REGISTER = struct.Struct(">H")
+SIGNED_REGISTER = struct.Struct(">h")
+
+
+class CommandSpec:
+    """A *_READ or *_WRITE entry of the device configuration, resolved once at startup."""
+
+    __slots__ = (
+        "name",
+        "parameter",
+        "function_code",
+        "start",
+        "length",
+        "data_format",
+        "codec",
+        "register_codec",
+        "scale_factor",
+        "bit_position",
+        "units",
+        "integer_write",
+    )
+
+    def __init__(self, name, parameter, command_config):
+        self.name = name
+        self.parameter = parameter
+        self.function_code = getattr(cst, command_config["function"])
+        self.start = command_config["start"]
+        self.length = command_config["length"]
+        self.data_format = command_config.get("data_format") or ""
+        self.codec = struct.Struct(self.data_format) if self.data_format else None
+        self.register_codec = struct.Struct(f">{self.length}H")
+        self.scale_factor = command_config.get("scale_factor")
+        self.bit_position = command_config.get("bit_position")
+        self.units = command_config.get("units")
+        self.integer_write = self.data_format in INTEGER_WRITE_FORMATS
+
+    def decode(self, registers):
+        """Decode the raw 16 bit registers of this command with its data_format."""
+        if self.codec is None:
+            return list(registers)
+        return list(self.codec.unpack(self.register_codec.pack(*registers)))
+
+    def encode(self, values):
+        """
+        The 16 bit registers that hold values in this command's data_format, the inverse of
+        decode. Raises struct.error for values modbus_tk would not write either: without
+        data_format, integers from -32768 to 65535.
+        """
+        if self.codec is None:
+            for value in values:
+                (REGISTER if value >= 0 else SIGNED_REGISTER).pack(value)
+            return [value & 0xFFFF for value in values]
+        return list(self.register_codec.unpack(self.codec.pack(*values)))
+
+    def __getstate__(self):
+        # struct.Struct cannot be pickled, the codecs are rebuilt from the formats
+        return {
+            slot: getattr(self, slot)
+            for slot in self.__slots__
+            if slot not in ("codec", "register_codec")
+        }
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.codec = struct.Struct(self.data_format) if self.data_format else None
+        self.register_codec = struct.Struct(f">{self.length}H")
+
+    def __repr__(self):
+        return (
+            f"CommandSpec({self.name}, function={self.function_code}, "
+            f"start={self.start}, length={self.length}, data_format='{self.data_format}')"
+        )
+
+
+class CommandTable:
+    """All commands of a device, indexed by command name and by parameter."""
+
+    def __init__(self, device_config):
+        self.commands = {}
+        self.reads = {}
+        self.writes = {}
+        for name, command_config in device_config.items():
+            if not isinstance(command_config, dict) or "function" not in command_config:
+                continue
+            if name.endswith("_READ"):
+                parameter = name[: -len("_READ")]
+                table = self.reads
+            elif name.endswith("_WRITE"):
+                parameter = name[: -len("_WRITE")]
+                table = self.writes
+            else:
+                parameter = name
+                table = None
+            spec = CommandSpec(name, parameter, command_config)
+            self.commands[name] = spec
+            if table is not None:
+                table[parameter] = spec
+
+    def __getitem__(self, command_name):
+        return self.commands[command_name]
+
+    def __contains__(self, command_name):
+        return command_name in self.commands
+
+    def __len__(self):
+        return len(self.commands)
+
+
+def compile_command_table(device_config):
+    return CommandTable(device_config)
@@ -1,10 +1,18 @@
 import yaml
 
+# libyaml's loader is several times faster than the pure Python one, use it when available
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
 
-def load_config_paths(path_to_device_list):
 
+def load_device_list(path_to_device_list):
     with open(path_to_device_list, "r") as file:
-        device_list = yaml.safe_load(file)
+        device_list = yaml.load(file, Loader=SafeLoader)
+    return device_list
+
+
+def load_config_paths(path_to_device_list):
+
+    device_list = load_device_list(path_to_device_list)
 
     global_debug_mode = device_list.get("GlobalDebugMode")
     path_to_configs = device_list["path_to_config_files"]
@@ -17,10 +25,15 @@ def load_config_paths(path_to_device_list):
 
 def load_config_file(path_to_file):
     with open(path_to_file, "r") as file:  # Intentionally do not handle exception
-        device_config = yaml.safe_load(file)
+        device_config = yaml.load(file, Loader=SafeLoader)
     return device_config
 
 
+def parse_config(source):
+    """The device configuration in source, the bytes of a YAML file."""
+    return yaml.load(source, Loader=SafeLoader)
+
+
 def load_config_files(device_config_paths):
     device_configs = {}
     for device_name in device_config_paths:
@@ -0,0 +1,121 @@
+import functools
+import hashlib
+import logging
+import os
+import pathlib
+import pickle
+import tempfile
+from importlib import metadata
+
+from riaps.interfaces.modbus import commands as commands_module
+from riaps.interfaces.modbus import config as config_module
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+
+PACKAGE = "riaps-interfaces-modbus"
+# bump when the cache entry layout changes
+CACHE_FORMAT = 2
+
+
+def library_version():
+    try:
+        return metadata.version(PACKAGE)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+
+@functools.lru_cache(maxsize=None)
+def schema_digest():
+    """
+    sha256 of the modules that validate and compile a configuration, whose classes are
+    pickled into the entries. The library version does not change with every edit to them.
+    """
+    digest = hashlib.sha256()
+    for module in (config_module, commands_module):
+        try:
+            digest.update(pathlib.Path(module.__file__).read_bytes())
+        except (OSError, TypeError):
+            digest.update(module.__name__.encode())
+    return digest.hexdigest()
+
+
+def cache_directory():
+    if ModbusSystem.ConfigCache.Directory:
+        return pathlib.Path(ModbusSystem.ConfigCache.Directory)
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "riaps-modbus-config"
+
+
+def cache_key(source):
+    """sha256 of the configuration file contents, the library version, the schema_digest and the cache format."""
+    digest = hashlib.sha256(source)
+    digest.update(f"|{library_version()}|{schema_digest()}|{CACHE_FORMAT}|{pickle.HIGHEST_PROTOCOL}".encode())
+    return digest.hexdigest()
+
+
+def path_tag(source_path):
+    """Names the entries of one configuration file, so that store can remove its older ones."""
+    return hashlib.sha256(str(pathlib.Path(source_path).resolve()).encode()).hexdigest()[:16]
+
+
+class ConfigCache:
+    """
+    Device configurations that were parsed, validated and compiled into a CommandTable,
+    pickled in directory under the path of their file and the cache_key of its contents.
+    An unchanged file is loaded from it without parsing or validating it again; any change
+    to the file, to the code that compiles it or a new library version gives a new key.
+    Storing an entry removes the older entries of the same file.
+    """
+
+    def __init__(self, directory=None, logger=None):
+        self.directory = pathlib.Path(directory) if directory else cache_directory()
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+    def path(self, source_path, key):
+        return self.directory / f"{path_tag(source_path)}-{key}.pickle"
+
+    def is_private(self):
+        """Entries are unpickled, so only a directory no other user can write to is used."""
+        try:
+            status = self.directory.stat()
+        except OSError:
+            return False
+        return status.st_uid == os.getuid() and not status.st_mode & 0o022
+
+    def load(self, source_path, source):
+        """(device_config, commands) compiled from source, the contents of source_path, None if it is not cached."""
+        if not self.is_private():
+            return None
+        try:
+            with open(self.path(source_path, cache_key(source)), "rb") as file:
+                entry = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            # a torn or incompatible entry is rebuilt
+            self.logger.warning(f"ConfigCache | load | ignoring unreadable cache entry: {ex!r}")
+            return None
+        return entry["device_config"], entry["commands"]
+
+    def store(self, source_path, source, device_config, commands):
+        try:
+            self.directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            if not self.is_private():
+                self.logger.warning(f"ConfigCache | store | {self.directory} is writable by other users, not caching")
+                return
+            entry = pickle.dumps(
+                {"device_config": device_config, "commands": commands},
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            with tempfile.NamedTemporaryFile("wb", dir=self.directory, delete=False) as file:
+                file.write(entry)
+            path = self.path(source_path, cache_key(source))
+            os.replace(file.name, path)
+        except (OSError, pickle.PicklingError, TypeError, AttributeError) as ex:
+            self.logger.warning(f"ConfigCache | store | could not cache the configuration: {ex!r}")
+            return
+        for old in self.directory.glob(f"{path_tag(source_path)}-*.pickle"):
+            if old != path:
+                try:
+                    old.unlink()
+                except OSError:
+                    pass  # removed by another process
@@ -0,0 +1,199 @@
+import logging
+import random
+import threading
+import time
+
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+import riaps.interfaces.modbus.TerminalColors as tc
+
+
+# exception codes a gateway answers with on behalf of a slave it cannot reach
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_FAILED_TO_RESPOND = 0x0B
+GATEWAY_EXCEPTIONS = (GATEWAY_PATH_UNAVAILABLE, GATEWAY_TARGET_FAILED_TO_RESPOND)
+
+
+class ConnectionState:
+    CONNECTED = "connected"
+    DEGRADED = "degraded"
+    DOWN = "down"
+
+
+def is_device_response(error):
+    """
+    A Modbus exception response means the device answered, so the link is healthy, unless
+    it is a gateway's answer for a slave behind it that it cannot reach.
+    """
+    return (
+        isinstance(error, modbus_exceptions.ModbusError)
+        and error.get_exception_code() not in GATEWAY_EXCEPTIONS
+    )
+
+
+class ConnectionHealth:
+    """
+    Passive health tracking for one device connection.
+
+    connected --failure--> degraded --failure_threshold consecutive failures--> down
+    degraded --success--> connected
+    down --background probe succeeds--> connected
+
+    While the connection is down requests fail fast and a background thread probes the
+    device with exponential backoff instead of the request path blocking on it. The backoff
+    only starts over once a request succeeds, so a device that keeps passing the probe and
+    failing again is probed less and less often.
+    """
+
+    def __init__(
+        self,
+        name,
+        probe,
+        on_reconnect=None,
+        failure_threshold=None,
+        backoff_initial=None,
+        backoff_max=None,
+        logger=None,
+    ):
+        self.name = name
+        self.probe = probe
+        self.on_reconnect = on_reconnect
+        self.failure_threshold = (
+            failure_threshold
+            if failure_threshold is not None
+            else ModbusSystem.Health.FailureThreshold
+        )
+        self.backoff_initial = (
+            backoff_initial
+            if backoff_initial is not None
+            else ModbusSystem.Health.BackoffInitialSeconds
+        )
+        self.backoff_max = (
+            backoff_max if backoff_max is not None else ModbusSystem.Health.BackoffMaxSeconds
+        )
+        self.logger = logger if logger else logging.getLogger(__name__)
+
+        self.state = ConnectionState.CONNECTED
+        self.last_error = None
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.successes = 0
+        self.fast_failures = 0
+        self.reconnect_attempts = 0
+        self.next_attempt = None
+        self.backoff = self.backoff_initial
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reconnect_thread = None
+
+    @property
+    def is_down(self):
+        return self.state == ConnectionState.DOWN
+
+    def allow_request(self):
+        if self.state != ConnectionState.DOWN:
+            return True
+        self.fast_failures += 1
+        return False
+
+    def down_error(self):
+        retry_in = max(0.0, (self.next_attempt or time.monotonic()) - time.monotonic())
+        return (
+            f"{self.name} is down ({self.last_error}), "
+            f"next reconnect attempt in {retry_in:.1f} s"
+        )
+
+    def record_success(self):
+        self.successes += 1
+        if (
+            self.state == ConnectionState.CONNECTED
+            and not self.consecutive_failures
+            and self.backoff == self.backoff_initial
+        ):
+            return
+        with self._lock:
+            self.consecutive_failures = 0
+            self.backoff = self.backoff_initial
+            if self.state == ConnectionState.DEGRADED:
+                self.state = ConnectionState.CONNECTED
+                self.logger.info(f"ConnectionHealth | {self.name} | connected")
+
+    def record_failure(self, error):
+        if is_device_response(error):
+            self.record_success()
+            return
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{error!r}"
+            if self.state == ConnectionState.DOWN:
+                return
+            if self.consecutive_failures >= self.failure_threshold:
+                self._set_down()
+            elif self.state == ConnectionState.CONNECTED:
+                self.state = ConnectionState.DEGRADED
+                self.logger.warning(
+                    f"{tc.Yellow}ConnectionHealth | {self.name} | degraded: {error!r}{tc.RESET}"
+                )
+
+    def mark_down(self, error):
+        with self._lock:
+            self.last_error = f"{error}"
+            if self.state != ConnectionState.DOWN:
+                self._set_down()
+
+    def _set_down(self):
+        self.state = ConnectionState.DOWN
+        self.next_attempt = time.monotonic() + self.backoff
+        self.logger.error(
+            f"{tc.Red}ConnectionHealth | {self.name} | down: {self.last_error}{tc.RESET}"
+        )
+        if self._stop.is_set():
+            return
+        if self._reconnect_thread is None or not self._reconnect_thread.is_alive():
+            self._reconnect_thread = threading.Thread(
+                target=self._reconnect, name=f"{self.name}-reconnect", daemon=True
+            )
+            self._reconnect_thread.start()
+
+    def _reconnect(self):
+        while not self._stop.wait(timeout=max(0.0, self.next_attempt - time.monotonic())):
+            self.reconnect_attempts += 1
+            online = self.probe()
+            if online["status"] is True:
+                try:
+                    if self.on_reconnect:
+                        self.on_reconnect()
+                except Exception as ex:
+                    online = {"status": False, "error": f"{ex!r}"}
+            if online["status"] is True:
+                with self._lock:
+                    self.state = ConnectionState.CONNECTED
+                    self.consecutive_failures = 0
+                    # a passed probe is not a successful request, the backoff is kept
+                    self.backoff = min(self.backoff * 2, self.backoff_max)
+                    self.next_attempt = None
+                self.logger.info(f"ConnectionHealth | {self.name} | reconnected")
+                return
+            with self._lock:
+                self.last_error = online["error"]
+                self.backoff = min(self.backoff * 2, self.backoff_max)
+                # jitter keeps devices that went down together from reconnecting in lockstep
+                self.next_attempt = time.monotonic() + self.backoff * random.uniform(0.9, 1.1)
+
+    def stop(self):
+        self._stop.set()
+
+    def get_stats(self):
+        return {
+            "state": self.state,
+            "last_error": self.last_error,
+            "consecutive_failures": self.consecutive_failures,
+            "failures": self.failures,
+            "successes": self.successes,
+            "fast_failures": self.fast_failures,
+            "reconnect_attempts": self.reconnect_attempts,
+            "backoff": self.backoff,
+        }
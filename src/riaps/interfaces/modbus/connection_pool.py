@@ -0,0 +1,356 @@
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from modbus_tk import modbus_rtu
+from modbus_tk import modbus_tcp
+from modbus_tk import utils as modbus_utils
+import serial
+
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+from riaps.interfaces.modbus.adaptive_timeout import ResponseTimeout
+from riaps.interfaces.modbus.lean_tcp import LeanTcpMaster
+
+
+class Priority:
+    COMMAND = 0  # requests from the command port
+    POLL = 1  # background polls, the default
+
+
+_request_context = threading.local()
+
+
+@contextlib.contextmanager
+def request_priority(priority):
+    """Requests made by this thread inside the block wait for a shared connection with priority."""
+    previous = getattr(_request_context, "priority", Priority.POLL)
+    _request_context.priority = priority
+    try:
+        yield
+    finally:
+        _request_context.priority = previous
+
+
+def current_priority():
+    return getattr(_request_context, "priority", Priority.POLL)
+
+
+def last_round_trip():
+    """Seconds the last request of this thread held its shared connection, without the wait for it."""
+    return getattr(_request_context, "round_trip", None)
+
+
+class RtuMaster(modbus_rtu.RtuMaster):
+    """
+    modbus_tk's RtuMaster, but a slave that sends nothing raises ResponseTimeout instead of
+    an invalid response of length 0.
+    """
+
+    def _recv(self, expected_length=-1):
+        response = super()._recv(expected_length)
+        if not response:
+            raise ResponseTimeout(f"No response within {self._serial.timeout} s")
+        return response
+
+
+class FairLock:
+    """
+    Mutex shared by the slaves behind one endpoint. Waiters are queued per slave and the
+    lock is handed to the waiting slaves round robin, so a slave with a long queue of
+    requests cannot starve the others. Waiters with a higher priority (a lower number)
+    are served before any waiter with a lower priority.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._locked = False
+        self._granted = None
+        self._queues = {}
+        self._turns = {}
+
+    def acquire(self, key=None, priority=Priority.POLL):
+        with self._condition:
+            if not self._locked:
+                self._locked = True
+                return
+            ticket = object()
+            queue = self._queues.get((priority, key))
+            if queue is None:
+                queue = self._queues[(priority, key)] = collections.deque()
+                self._turns.setdefault(priority, collections.deque()).append(key)
+            queue.append(ticket)
+            while self._granted is not ticket:
+                self._condition.wait()
+            self._granted = None
+
+    def release(self):
+        with self._condition:
+            if not self._turns:
+                self._locked = False
+                return
+            priority = min(self._turns)
+            turns = self._turns[priority]
+            key = turns.popleft()
+            queue = self._queues[(priority, key)]
+            self._granted = queue.popleft()
+            if queue:
+                turns.append(key)
+            else:
+                del self._queues[(priority, key)]
+                if not turns:
+                    del self._turns[priority]
+            self._condition.notify_all()
+
+    @property
+    def waiting(self):
+        with self._condition:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+class SlaveStats:
+    __slots__ = ("requests", "errors", "wait_time", "max_wait_time", "busy_time")
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.busy_time = 0.0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "wait_time": self.wait_time,
+            "max_wait_time": self.max_wait_time,
+            "mean_wait_time": self.wait_time / self.requests if self.requests else 0.0,
+            "busy_time": self.busy_time,
+        }
+
+
+class SharedConnection:
+    """
+    One modbus_tk master shared by every interface that talks to the same endpoint, a TCP
+    (address, port) or a serial device. On a serial bus frame_gap is the silent interval
+    the Modbus RTU spec requires between two frames.
+    """
+
+    def __init__(self, endpoint, master, frame_gap=0.0, timeout_options=None, settings=None):
+        self.endpoint = endpoint
+        self.master = master
+        self.settings = settings
+        self.frame_gap = frame_gap
+        self.timeout_options = timeout_options or {}
+        self.lock = FairLock()
+        self.handles = 0
+        self.created = time.time()
+        self.last_frame_end = 0.0
+        self.slave_stats = collections.defaultdict(SlaveStats)
+
+    @property
+    def name(self):
+        if isinstance(self.endpoint, tuple):
+            return f"{self.endpoint[0]}:{self.endpoint[1]}"
+        return self.endpoint
+
+    def execute(self, slave, function_code, *args, timeout=None, **kwargs):
+        wait_start = time.perf_counter()
+        self.lock.acquire(slave, current_priority())
+        start = time.perf_counter()
+        stats = self.slave_stats[slave]
+        try:
+            if self.frame_gap:
+                silence = self.last_frame_end + self.frame_gap - time.perf_counter()
+                if silence > 0:
+                    time.sleep(silence)
+            if timeout is not None and timeout != self.master.get_timeout():
+                self.master.set_timeout(timeout, **self.timeout_options)
+            # the fair lock already serializes the endpoint, skip modbus_tk's global lock
+            return self.master.execute(
+                slave, function_code, *args, threadsafe=False, **kwargs
+            )
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            end = time.perf_counter()
+            wait_time = start - wait_start
+            stats.requests += 1
+            stats.wait_time += wait_time
+            stats.max_wait_time = max(stats.max_wait_time, wait_time)
+            stats.busy_time += end - start
+            _request_context.round_trip = end - start
+            self.last_frame_end = end
+            self.lock.release()
+
+    def get_stats(self):
+        return {
+            "endpoint": self.name,
+            "handles": self.handles,
+            "waiting": self.lock.waiting,
+            "is_opened": self.master._is_opened,
+            "slaves": {
+                slave: stats.as_dict() for slave, stats in self.slave_stats.items()
+            },
+        }
+
+
+class PooledMaster:
+    """
+    The master handed to a ModbusInterface by the pool. It behaves like a modbus_tk master
+    but executes on the shared connection and only closes it when the last handle closes.
+    """
+
+    def __init__(self, pool, connection):
+        self._pool = pool
+        self._connection = connection
+        self._timeout = connection.master.get_timeout()
+        self.closed = False
+
+    @property
+    def _is_opened(self):
+        return self._connection.master._is_opened
+
+    @property
+    def connection(self):
+        return self._connection
+
+    def execute(self, slave, function_code, *args, **kwargs):
+        kwargs.pop("threadsafe", None)
+        return self._connection.execute(
+            slave, function_code, *args, timeout=self._timeout, **kwargs
+        )
+
+    def set_timeout(self, timeout_in_sec, **kwargs):
+        # other options, e.g. use_sw_timeout of an RTU master, are fixed by the pool
+        self._timeout = timeout_in_sec
+
+    def get_timeout(self):
+        return self._timeout
+
+    def set_verbose(self, verbose):
+        self._connection.master.set_verbose(verbose)
+
+    def open(self):
+        self._connection.master.open()
+
+    def reset(self):
+        """Drop the shared socket, it is reopened by the next request."""
+        self._connection.lock.acquire()
+        try:
+            self._connection.master.close()
+        finally:
+            self._connection.lock.release()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._pool.release(self)
+
+
+class ConnectionPool:
+    """
+    Process wide pool of Modbus connections, TCP connections keyed by (address, port) and
+    serial (RS-485 multidrop) buses keyed by device.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._connections = {}
+        self.connections_opened = 0
+        self.connections_closed = 0
+
+    def acquire_tcp(self, address, port, lean=False):
+        endpoint = (address, port)
+        settings = {"lean": lean}
+        with self._lock:
+            connection = self._connections.get(endpoint)
+            if connection is None:
+                master = LeanTcpMaster(address, port) if lean else modbus_tcp.TcpMaster(address, port)
+                master.set_timeout(ModbusSystem.Timeouts.TCPComm / 1000.0)
+                connection = SharedConnection(endpoint, master, settings=settings)
+                self._connections[endpoint] = connection
+                self.connections_opened += 1
+                self.logger.info(f"ConnectionPool | acquire_tcp | New connection to {address}:{port}")
+            elif connection.settings != settings:
+                raise ValueError(
+                    f"TCP endpoint {address}:{port} is already open with {connection.settings}, not {settings}"
+                )
+            connection.handles += 1
+            return PooledMaster(self, connection)
+
+    def acquire_rtu(self, comm_config):
+        device = comm_config["device"]
+        settings = {
+            "baudrate": comm_config["baudrate"],
+            "bytesize": comm_config["bytesize"],
+            "parity": comm_config["parity"],
+            "stopbits": comm_config["stopbits"],
+            "xonxoff": comm_config["xonxoff"],
+        }
+        with self._lock:
+            connection = self._connections.get(device)
+            if connection is None:
+                serial_connection = serial.serial_for_url(device, **settings)
+                master = RtuMaster(serial_connection)
+                master.set_timeout(ModbusSystem.Timeouts.TTYSComm / 1000.0, use_sw_timeout=True)
+                connection = SharedConnection(
+                    device,
+                    master,
+                    frame_gap=ModbusSystem.Timeouts.RTUFrameGapChars
+                    * modbus_utils.calculate_rtu_inter_char(settings["baudrate"]),
+                    timeout_options={"use_sw_timeout": True},
+                    settings=settings,
+                )
+                self._connections[device] = connection
+                self.connections_opened += 1
+                self.logger.info(f"ConnectionPool | acquire_rtu | Opened serial bus {device}")
+            elif connection.settings != settings:
+                raise ValueError(
+                    f"Serial bus {device} is already open with {connection.settings}, not {settings}"
+                )
+            connection.handles += 1
+            return PooledMaster(self, connection)
+
+    def release(self, handle: PooledMaster):
+        connection = handle.connection
+        with self._lock:
+            connection.handles -= 1
+            if connection.handles > 0:
+                return
+            self._connections.pop(connection.endpoint, None)
+            self.connections_closed += 1
+        connection.lock.acquire()
+        try:
+            connection.master.close()
+        finally:
+            connection.lock.release()
+        self.logger.info(f"ConnectionPool | release | Closed connection to {connection.name}")
+
+    def is_connected(self, address, port=None):
+        """Whether the pool has an open connection to a TCP endpoint, or to a serial device without port."""
+        endpoint = address if port is None else (address, port)
+        with self._lock:
+            connection = self._connections.get(endpoint)
+        return bool(connection and connection.master._is_opened)
+
+    def get_stats(self):
+        with self._lock:
+            connections = list(self._connections.values())
+            stats = {
+                "connections": len(connections),
+                "connections_opened": self.connections_opened,
+                "connections_closed": self.connections_closed,
+            }
+        stats["endpoints"] = [connection.get_stats() for connection in connections]
+        return stats
+
+
+_connection_pool = ConnectionPool()
+
+
+def get_connection_pool():
+    return _connection_pool
@@ -0,0 +1,120 @@
+import time
+
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+
+FILTER_SETTINGS = ("deadband", "deadband_percent", "on_change", "min", "max")
+
+
+class DeadbandFilter:
+    """
+    Report by exception for one polled parameter. A poll result is reported when
+    - it is the first result, an error, or the first good result after an error
+    - a value moved more than deadband (absolute) or deadband_percent (of the last
+      reported value) away from the last reported value
+    - on_change is set and a value changed at all (e.g. status words)
+    - a value is outside [min, max], or just came back inside
+    - nothing was reported for integrity_period seconds
+    """
+
+    def __init__(
+        self,
+        deadband=None,
+        deadband_percent=None,
+        on_change=False,
+        minimum=None,
+        maximum=None,
+        integrity_period=None,
+    ):
+        self.deadband = deadband
+        self.deadband_percent = deadband_percent
+        self.on_change = on_change
+        self.minimum = minimum
+        self.maximum = maximum
+        self.integrity_period = integrity_period
+
+        self.last_values = None
+        self.last_report = None
+        self.last_error = False
+        self.in_range = True
+        self.reported = 0
+        self.suppressed = 0
+
+    def _out_of_range(self, values):
+        for value in values:
+            if self.minimum is not None and value < self.minimum:
+                return True
+            if self.maximum is not None and value > self.maximum:
+                return True
+        return False
+
+    def _changed(self, values):
+        if len(values) != len(self.last_values):
+            return True
+        for value, last in zip(values, self.last_values):
+            delta = abs(value - last)
+            if self.on_change and delta != 0:
+                return True
+            if self.deadband is not None and delta > self.deadband:
+                return True
+            if self.deadband_percent is not None:
+                if last == 0:
+                    if delta != 0:
+                        return True
+                elif delta > abs(last) * self.deadband_percent / 100.0:
+                    return True
+        return False
+
+    def should_report(self, result, now=None):
+        now = time.monotonic() if now is None else now
+        if result.get("errors"):
+            self.last_error = True
+            report = True
+        else:
+            values = result.get("values") or []
+            out_of_range = self._out_of_range(values)
+            report = (
+                self.last_values is None
+                or self.last_error
+                or out_of_range
+                or not self.in_range
+                or self._changed(values)
+                or (
+                    self.integrity_period is not None
+                    and now - self.last_report >= self.integrity_period
+                )
+            )
+            self.in_range = not out_of_range
+            self.last_error = False
+            if report:
+                self.last_values = list(values)
+
+        if report:
+            self.last_report = now
+            self.reported += 1
+        else:
+            self.suppressed += 1
+        return report
+
+
+def load_deadband_filters(device_config):
+    """Deadband filters for the parameters of a poll mapping that configure one, by parameter."""
+    poll_config = device_config.get("poll")
+    if not isinstance(poll_config, dict):
+        return {}
+
+    default_integrity_period = device_config.get(
+        "Poll_Integrity_Seconds", ModbusSystem.Reporting.IntegritySeconds
+    )
+    filters = {}
+    for parameter, settings in poll_config.items():
+        if not settings or not any(key in settings for key in FILTER_SETTINGS):
+            continue
+        filters[parameter] = DeadbandFilter(
+            deadband=settings.get("deadband"),
+            deadband_percent=settings.get("deadband_percent"),
+            on_change=settings.get("on_change", False),
+            minimum=settings.get("min"),
+            maximum=settings.get("max"),
+            integrity_period=settings.get("integrity_period", default_integrity_period),
+        )
+    return filters
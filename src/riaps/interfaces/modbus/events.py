@@ -0,0 +1,52 @@
+import time
+
+
+class PollBatch:
+    """
+    The results of one poll cycle as a single event port message. The layout is columnar:
+    parameter names, units and commands are sent once per cycle and values[i] belongs to
+    parameters[i], so subscribers get a consistent snapshot of the cycle in one message.
+    """
+
+    def __init__(self, device_name):
+        self.device_name = device_name
+        self.parameters = []
+        self.commands = []
+        self.values = []
+        self.units = []
+        self.errors = []
+        self.timestamp = time.time()
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def add(self, parameter, modbus_result):
+        self.parameters.append(parameter)
+        self.commands.append(modbus_result.get("command"))
+        self.values.append(modbus_result.get("values"))
+        self.units.append(modbus_result.get("units"))
+        self.errors.append(modbus_result.get("errors", "OK"))
+
+    def as_message(self):
+        return {"device_name": self.device_name,
+                "command": "POLL",
+                "timestamp": self.timestamp,
+                "parameters": self.parameters,
+                "commands": self.commands,
+                "values": self.values,
+                "units": self.units,
+                "return_status": self.errors}
+
+
+def unbatch(message):
+    """Split a batched poll message back into the per parameter messages of the unbatched mode."""
+    for command, values, units, status in zip(
+        message["commands"], message["values"], message["units"], message["return_status"]
+    ):
+        modbus_result = {"device_name": message["device_name"],
+                         "command": command,
+                         "values": values,
+                         "units": units}
+        if status != "OK":
+            modbus_result["errors"] = status
+        yield modbus_result
@@ -0,0 +1,207 @@
+import socket
+import struct
+import threading
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus import protocol
+from riaps.interfaces.modbus.protocol import MBAP, MBAP_LENGTH, MODBUS_PROTOCOL_ID
+
+MAX_ADU_LENGTH = 260
+# MBAP + function code + address + quantity (or value)
+READ_FRAME = struct.Struct(">HHHBBHH")
+# MBAP + function code + address + quantity + byte count
+WRITE_MULTIPLE_FRAME = struct.Struct(">HHHBBHHB")
+# MBAP + function code + read address + read quantity + write address + write quantity + byte count
+READ_WRITE_FRAME = struct.Struct(">HHHBBHHHHB")
+
+
+class LeanTcpMaster:
+    """
+    Modbus TCP master with the interface of modbus_tk's TcpMaster, for ModbusInterface and
+    the connection pool. Requests of function codes 3, 4, 6, 16 and 23 are packed straight
+    into a preallocated frame and responses are read with recv_into into another one, the
+    other function codes go through protocol.build_request. It does no logging and calls
+    no modbus_tk hooks, so a TrafficRecorder does not see its traffic.
+    """
+
+    def __init__(self, host="127.0.0.1", port=502, timeout_in_sec=5.0):
+        self._host = host
+        self._port = port
+        self._timeout = timeout_in_sec
+        self._sock = None
+        self._is_opened = False
+        self._lock = threading.Lock()
+        self._transaction_id = 0
+        self._request = bytearray(MAX_ADU_LENGTH)
+        self._response = bytearray(MAX_ADU_LENGTH)
+        self._response_view = memoryview(self._response)
+        self._codecs = {}
+
+    def set_verbose(self, verbose):
+        pass  # never logs frames
+
+    def get_timeout(self):
+        return self._timeout
+
+    def set_timeout(self, timeout_in_sec, **kwargs):
+        self._timeout = timeout_in_sec
+        if self._sock is not None:
+            self._sock.settimeout(timeout_in_sec)
+
+    def open(self):
+        if self._is_opened:
+            return
+        sock = socket.create_connection((self._host, self._port), timeout=self._timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", 10), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+        sock.settimeout(self._timeout)
+        self._sock = sock
+        self._is_opened = True
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._is_opened = False
+
+    def _codec(self, data_format):
+        codec = self._codecs.get(data_format)
+        if codec is None:
+            codec = self._codecs[data_format] = struct.Struct(data_format)
+        return codec
+
+    def execute(
+        self,
+        slave,
+        function_code,
+        starting_address,
+        quantity_of_x=0,
+        output_value=0,
+        data_format="",
+        expected_length=-1,
+        write_starting_address_fc23=0,
+        number_file=None,
+        pdu="",
+        returns_raw=False,
+        and_mask=-1,
+        or_mask=-1,
+        threadsafe=True,
+    ):
+        """Same arguments and results as modbus_tk.modbus.Master.execute, without its file record and raw PDU options."""
+        if threadsafe:
+            with self._lock:
+                return self._execute(slave, function_code, starting_address, quantity_of_x, output_value,
+                                     data_format, write_starting_address_fc23, and_mask, or_mask)
+        return self._execute(slave, function_code, starting_address, quantity_of_x, output_value,
+                             data_format, write_starting_address_fc23, and_mask, or_mask)
+
+    def _execute(self, slave, function_code, starting_address, quantity_of_x, output_value,
+                 data_format, write_starting_address_fc23, and_mask, or_mask):
+        if not self._is_opened:
+            self.open()
+        self._transaction_id = transaction_id = (self._transaction_id + 1) & 0xFFFF
+        request = self._request
+        generic = None
+
+        if function_code in (cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS):
+            READ_FRAME.pack_into(request, 0, transaction_id, MODBUS_PROTOCOL_ID, 6, slave,
+                                 function_code, starting_address, quantity_of_x)
+            size = READ_FRAME.size
+        elif function_code == cst.WRITE_SINGLE_REGISTER and not data_format:
+            READ_FRAME.pack_into(request, 0, transaction_id, MODBUS_PROTOCOL_ID, 6, slave,
+                                 function_code, starting_address, output_value & 0xFFFF)
+            size = READ_FRAME.size
+        elif function_code == cst.WRITE_MULTIPLE_REGISTERS:
+            offset = WRITE_MULTIPLE_FRAME.size
+            if output_value and data_format:
+                codec = self._codec(data_format)
+                codec.pack_into(request, offset, *output_value)
+                data_size = codec.size
+            else:
+                # two's complement of negative values, what packing them as >h gives
+                data_size = 2 * len(output_value)
+                self._codec(f">{len(output_value)}H").pack_into(
+                    request, offset, *[value & 0xFFFF for value in output_value]
+                )
+            WRITE_MULTIPLE_FRAME.pack_into(request, 0, transaction_id, MODBUS_PROTOCOL_ID, 7 + data_size,
+                                           slave, function_code, starting_address, data_size // 2, data_size)
+            size = offset + data_size
+        elif function_code == cst.READ_WRITE_MULTIPLE_REGISTERS:
+            offset = READ_WRITE_FRAME.size
+            data_size = 2 * len(output_value)
+            self._codec(f">{len(output_value)}H").pack_into(
+                request, offset, *[value & 0xFFFF for value in output_value]
+            )
+            READ_WRITE_FRAME.pack_into(request, 0, transaction_id, MODBUS_PROTOCOL_ID, 11 + data_size,
+                                       slave, function_code, starting_address, quantity_of_x,
+                                       write_starting_address_fc23, len(output_value), data_size)
+            size = offset + data_size
+        else:
+            generic = protocol.build_request(function_code, starting_address, quantity_of_x, output_value,
+                                             data_format, write_starting_address_fc23, and_mask, or_mask)
+            pdu = generic.pdu
+            MBAP.pack_into(request, 0, transaction_id, MODBUS_PROTOCOL_ID, len(pdu) + 1, slave)
+            request[MBAP_LENGTH:MBAP_LENGTH + len(pdu)] = pdu
+            size = MBAP_LENGTH + len(pdu)
+
+        try:
+            self._sock.sendall(memoryview(request)[:size])
+            pdu_length = self._receive(transaction_id)
+        except (OSError, modbus_exceptions.ModbusInvalidResponseError):
+            # the stream is out of step after a timeout or a bad frame, start over on the next request
+            self.close()
+            raise
+
+        response = self._response
+        return_code = response[MBAP_LENGTH]
+        if return_code > 0x80:
+            raise modbus_exceptions.ModbusError(response[MBAP_LENGTH + 1])
+        if generic is not None:
+            return protocol.parse_response(generic, bytes(response[MBAP_LENGTH:MBAP_LENGTH + pdu_length]))
+        if return_code != function_code:
+            raise modbus_exceptions.ModbusInvalidResponseError(
+                f"Response function code {return_code} does not match the request {function_code}"
+            )
+
+        if function_code in (cst.WRITE_SINGLE_REGISTER, cst.WRITE_MULTIPLE_REGISTERS):
+            # the echoed address, and value or quantity
+            return READ_FRAME.unpack_from(response, 0)[5:]
+        byte_count = response[MBAP_LENGTH + 1]
+        if byte_count != pdu_length - 2:
+            raise modbus_exceptions.ModbusInvalidResponseError(
+                f"Byte count is {byte_count} while actual number of bytes is {pdu_length - 2}. "
+            )
+        codec = self._codec(data_format or f">{byte_count // 2}H")
+        # struct.error on a data_format of another size, as modbus_tk
+        return codec.unpack(self._response_view[MBAP_LENGTH + 2:MBAP_LENGTH + 2 + byte_count])
+
+    def _receive(self, transaction_id):
+        """Read the response to transaction_id into the response frame, returns its PDU length."""
+        while True:
+            self._receive_exactly(0, MBAP_LENGTH)
+            response_id, protocol_id, length, _ = MBAP.unpack_from(self._response, 0)
+            if protocol_id != MODBUS_PROTOCOL_ID or not 2 <= length <= MAX_ADU_LENGTH - MBAP_LENGTH + 1:
+                raise modbus_exceptions.ModbusInvalidResponseError(
+                    f"Invalid MBAP header {bytes(self._response[:MBAP_LENGTH])!r}"
+                )
+            self._receive_exactly(MBAP_LENGTH, length - 1)
+            if response_id == transaction_id:
+                return length - 1
+            # a late response to a request that timed out, skip it
+
+    def _receive_exactly(self, offset, size):
+        view = self._response_view[offset:offset + size]
+        while size:
+            received = self._sock.recv_into(view, size)
+            if not received:
+                raise ConnectionResetError("Connection closed by the device")
+            view = view[received:]
+            size -= received
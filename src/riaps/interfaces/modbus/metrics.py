@@ -0,0 +1,196 @@
+import threading
+import time
+
+from modbus_tk import exceptions as modbus_exceptions
+import modbus_tk.defines as cst
+
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+from riaps.interfaces.modbus.adaptive_timeout import is_timeout
+
+BIT_FUNCTIONS = (cst.READ_COILS, cst.READ_DISCRETE_INPUTS, cst.WRITE_MULTIPLE_COILS)
+FRAME_OVERHEAD = {"TCP": 7, "RTU": 3}  # MBAP header, or slave id + CRC
+
+
+class LatencyHistogram:
+    """
+    Log-linear histogram of durations in microseconds (HDR style). Each power of two is
+    split into 2**(significant_bits - 1) buckets, so recorded values are kept with a relative
+    error below 2**(1 - significant_bits) whatever their magnitude, in a handful of counters.
+    """
+
+    def __init__(self, significant_bits=None):
+        self.significant_bits = (
+            significant_bits
+            if significant_bits is not None
+            else ModbusSystem.Metrics.SignificantBits
+        )
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        shift = value.bit_length() - self.significant_bits
+        if shift <= 0:
+            return value
+        return (value >> shift) << shift
+
+    def record(self, seconds):
+        value = int(seconds * 1e6)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(bucket, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "min_us": self.min,
+            "mean_us": self.total / self.count if self.count else None,
+            "p50_us": self.percentile(50),
+            "p90_us": self.percentile(90),
+            "p99_us": self.percentile(99),
+            "max_us": self.max,
+        }
+
+
+def frame_sizes(function_code, length, protocol="TCP"):
+    """Estimated (request, response) bytes on the wire of a successful transaction."""
+    data_bytes = (length + 7) // 8 if function_code in BIT_FUNCTIONS else 2 * length
+    if function_code in (cst.READ_COILS, cst.READ_DISCRETE_INPUTS,
+                         cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS):
+        request, response = 5, 2 + data_bytes
+    elif function_code in (cst.WRITE_MULTIPLE_COILS, cst.WRITE_MULTIPLE_REGISTERS):
+        request, response = 6 + data_bytes, 5
+    elif function_code == cst.READ_WRITE_MULTIPLE_REGISTERS:
+        request, response = 10 + data_bytes, 2 + data_bytes
+    elif function_code == cst.MASK_WRITE_REGISTER:
+        request, response = 7, 7
+    else:
+        request, response = 5, 5
+    overhead = FRAME_OVERHEAD.get(protocol, FRAME_OVERHEAD["RTU"])
+    return request + overhead, response + overhead
+
+
+class CommandMetrics:
+    __slots__ = ("latency", "successes", "exception_responses", "timeouts", "errors",
+                 "bytes_sent", "bytes_received")
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.successes = 0
+        self.exception_responses = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def as_dict(self):
+        return {
+            "latency": self.latency.as_dict(),
+            "successes": self.successes,
+            "exception_responses": self.exception_responses,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+        }
+
+
+class PollMetrics:
+    __slots__ = ("interval", "duration", "overruns", "missed_deadlines")
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.duration = LatencyHistogram()
+        self.overruns = 0
+        self.missed_deadlines = 0
+
+    def as_dict(self):
+        duration = self.duration.as_dict()
+        return {
+            "interval_s": self.interval,
+            "duration": duration,
+            # fraction of the interval the poll cycle takes, > 1 means overruns
+            "p99_utilization": (
+                duration["p99_us"] / 1e6 / self.interval
+                if duration["p99_us"] is not None
+                else None
+            ),
+            "overruns": self.overruns,
+            "missed_deadlines": self.missed_deadlines,
+        }
+
+
+class DeviceMetrics:
+    """Latency histograms and counters of one device, per command and for the whole device."""
+
+    def __init__(self, device_name, protocol="TCP"):
+        self.device_name = device_name
+        self.protocol = "TCP" if protocol == "TCP" else "RTU"
+        self.started = time.time()
+        self.device = CommandMetrics()
+        self.commands = {}
+        self.polls = {}
+        self._lock = threading.Lock()
+
+    def record(self, command_name, function_code, length, duration, error=None):
+        with self._lock:
+            command = self.commands.get(command_name)
+            if command is None:
+                command = self.commands[command_name] = CommandMetrics()
+            for metrics in (command, self.device):
+                metrics.latency.record(duration)
+                if error is None:
+                    metrics.successes += 1
+                elif isinstance(error, modbus_exceptions.ModbusError):
+                    metrics.exception_responses += 1
+                elif is_timeout(error):
+                    metrics.timeouts += 1
+                else:
+                    metrics.errors += 1
+            if error is None or isinstance(error, modbus_exceptions.ModbusError):
+                sent, received = frame_sizes(function_code, length, self.protocol)
+                if error is not None:
+                    received = 2 + FRAME_OVERHEAD[self.protocol]
+                for metrics in (command, self.device):
+                    metrics.bytes_sent += sent
+                    metrics.bytes_received += received
+
+    def record_poll(self, interval, duration, missed=0):
+        with self._lock:
+            poll = self.polls.get(interval)
+            if poll is None:
+                poll = self.polls[interval] = PollMetrics(interval)
+            poll.duration.record(duration)
+            if missed:
+                poll.overruns += 1
+                poll.missed_deadlines += missed
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "device_name": self.device_name,
+                "uptime_s": time.time() - self.started,
+                "device": self.device.as_dict(),
+                "commands": {
+                    name: command.as_dict() for name, command in self.commands.items()
+                },
+                "polls": [poll.as_dict() for poll in self.polls.values()],
+            }
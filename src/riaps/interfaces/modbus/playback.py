@@ -0,0 +1,258 @@
+"""
+Time-varying register values for the simulators. The playback section of a device
+configuration maps parameters to a signal, and a PlaybackEngine writes the signal's value
+to the registers of the parameter's *_READ command at a fixed rate, encoded with the
+command's data_format and scale_factor the way the master decodes them:
+
+    playback:
+      FREQ: {signal: sine, offset: 60, amplitude: 0.05, period: 10}
+      P: {signal: ramp, start: 0, stop: 1500, period: 60}
+      Q: {signal: noise, mean: 300, std: 5}
+      STATUS: {signal: step, values: [0, 1, 3], period: 20}
+      V: {signal: table, file: voltage.csv, rate: 10}
+
+Signals of the same kind are computed for all channels at once, with NumPy if installed.
+"""
+import csv
+import logging
+import math
+import pathlib
+import random
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, the signals are computed channel by channel without it
+    numpy = None
+
+from riaps.interfaces.modbus.commands import compile_command_table
+
+# struct format character -> NumPy dtype character and size
+NUMPY_TYPES = {"h": "i2", "H": "u2", "i": "i4", "I": "u4", "l": "i4", "L": "u4",
+               "q": "i8", "Q": "u8", "f": "f4", "d": "f8"}
+VECTOR_SIGNALS = ("sine", "ramp", "noise")
+
+
+def load_table(path, column=None):
+    """Samples of a table signal: a .npy file, or a column (default the first) of a CSV file."""
+    path = pathlib.Path(path)
+    if path.suffix == ".npy":
+        if numpy is None:
+            raise ImportError(f"NumPy is needed to read {path}")
+        return [float(value) for value in numpy.load(path).ravel()]
+    with open(path, newline="") as file:
+        rows = list(csv.reader(file))
+    index = 0
+    if column is not None:
+        index = rows[0].index(column)
+        rows = rows[1:]
+    samples = []
+    for row in rows:
+        try:
+            samples.append(float(row[index]))
+        except (ValueError, IndexError):
+            continue  # header or empty line
+    return samples
+
+
+class Channel:
+    """One parameter driven by a signal, with how its value becomes registers."""
+
+    __slots__ = ("name", "spec", "settings", "write", "scale", "dtype", "is_integer", "samples")
+
+    def __init__(self, name, spec, settings, write, base_directory=None):
+        self.name = name
+        self.spec = spec
+        self.settings = settings
+        self.write = write
+        self.scale = spec.scale_factor or 1
+        data_format = spec.data_format or ">H"
+        byte_order = "<" if data_format[0] == "<" else ">"
+        type_character = data_format.lstrip("<>!=@")
+        self.dtype = byte_order + NUMPY_TYPES[type_character]
+        self.is_integer = type_character not in "fd"
+        self.samples = None
+        if settings["signal"] == "table":
+            path = pathlib.Path(settings["file"])
+            if base_directory is not None and not path.is_absolute():
+                path = pathlib.Path(base_directory) / path
+            self.samples = load_table(path, settings.get("column"))
+
+    def registers(self, value):
+        raw = value / self.scale
+        if self.is_integer:
+            size = int(self.dtype[2:]) * 8
+            low, high = (-(1 << (size - 1)), (1 << (size - 1)) - 1) if self.dtype[1] == "i" else (0, (1 << size) - 1)
+            raw = min(max(int(round(raw)), low), high)
+        return self.spec.encode([raw]) if self.spec.codec else [raw & 0xFFFF]
+
+
+class PlaybackEngine:
+    """
+    Writes the values of the signals of its channels every 1/rate seconds, from a background
+    thread started by start(), or whenever tick(t) is called.
+    """
+
+    def __init__(self, rate=10.0, use_numpy=None, seed=None, logger=None):
+        self.rate = rate
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.channels = []
+        self.ticks = 0
+        self.overruns = 0
+        self._random = random.Random(seed)
+        self._rng = numpy.random.default_rng(seed) if self.use_numpy else None
+        self._groups = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_device(self, device_config, write, base_directory=None):
+        """
+        Add a channel for every parameter of the playback section of device_config. write is
+        called with (function_code, start, registers) to update the simulated registers.
+        """
+        commands = compile_command_table(device_config).reads
+        for parameter, settings in (device_config.get("playback") or {}).items():
+            spec = commands.get(parameter)
+            reason = None
+            if spec is None:
+                reason = f"no {parameter}_READ command"
+            elif spec.bit_position is not None:
+                reason = "bit parameters are not supported"
+            elif not settings or settings.get("signal") not in VECTOR_SIGNALS + ("step", "table"):
+                reason = f"unknown signal {settings and settings.get('signal')}"
+            elif spec.codec is not None and len(spec.codec.unpack(bytes(spec.codec.size))) != 1:
+                reason = f"data_format {spec.data_format} holds more than one value"
+            elif spec.codec is None and spec.length != 1:
+                reason = "a data_format is needed for more than one register"
+            else:
+                try:
+                    self.channels.append(Channel(parameter, spec, settings, write, base_directory))
+                except KeyError:
+                    reason = f"data_format {spec.data_format} is not supported"
+            if reason:
+                self.logger.warning(f"PlaybackEngine | add_device | {device_config.get('Name')} {parameter} skipped: {reason}")
+        self._groups = None
+
+    def _compile(self):
+        """Channels indices and parameter vectors by signal, and channel indices by encoding."""
+        groups = {}
+        for index, channel in enumerate(self.channels):
+            groups.setdefault(channel.settings["signal"], []).append(index)
+        self._groups = {}
+        for signal, indices in groups.items():
+            settings = [self.channels[index].settings for index in indices]
+            if signal == "sine":
+                columns = {"offset": 0.0, "amplitude": 1.0, "period": 1.0, "phase": 0.0}
+            elif signal == "ramp":
+                columns = {"start": 0.0, "stop": 1.0, "period": 1.0}
+            elif signal == "noise":
+                columns = {"mean": 0.0, "std": 1.0}
+            else:
+                columns = {}
+            vectors = {
+                name: [float(setting.get(name, default)) for setting in settings]
+                for name, default in columns.items()
+            }
+            if self.use_numpy:
+                indices = numpy.array(indices)
+                vectors = {name: numpy.array(vector) for name, vector in vectors.items()}
+            self._groups[signal] = (indices, vectors)
+        self._encodings = {}
+        if self.use_numpy:
+            encodings = {}
+            for index, channel in enumerate(self.channels):
+                encodings.setdefault(channel.dtype, []).append(index)
+            for dtype, indices in encodings.items():
+                self._encodings[dtype] = (
+                    numpy.array(indices),
+                    numpy.array([self.channels[index].scale for index in indices]),
+                )
+
+    def values(self, t):
+        """The value of every channel at t seconds, in channel order."""
+        if self._groups is None:
+            self._compile()
+        values = numpy.zeros(len(self.channels)) if self.use_numpy else [0.0] * len(self.channels)
+        for signal, (indices, v) in self._groups.items():
+            if signal == "sine":
+                if self.use_numpy:
+                    values[indices] = v["offset"] + v["amplitude"] * numpy.sin(2 * math.pi * t / v["period"] + v["phase"])
+                else:
+                    for i, index in enumerate(indices):
+                        values[index] = v["offset"][i] + v["amplitude"][i] * math.sin(
+                            2 * math.pi * t / v["period"][i] + v["phase"][i]
+                        )
+            elif signal == "ramp":
+                if self.use_numpy:
+                    fraction = numpy.mod(t / v["period"], 1.0)
+                    values[indices] = v["start"] + (v["stop"] - v["start"]) * fraction
+                else:
+                    for i, index in enumerate(indices):
+                        fraction = (t / v["period"][i]) % 1.0
+                        values[index] = v["start"][i] + (v["stop"][i] - v["start"][i]) * fraction
+            elif signal == "noise":
+                if self.use_numpy:
+                    values[indices] = self._rng.normal(v["mean"], v["std"])
+                else:
+                    for i, index in enumerate(indices):
+                        values[index] = self._random.gauss(v["mean"][i], v["std"][i])
+            else:
+                for index in indices:
+                    channel = self.channels[index]
+                    if signal == "step":
+                        levels = channel.settings["values"]
+                        values[index] = levels[int(t / channel.settings.get("period", 1.0)) % len(levels)]
+                    else:
+                        samples = channel.samples
+                        values[index] = samples[int(t * channel.settings.get("rate", 1.0)) % len(samples)]
+        return values
+
+    def tick(self, t):
+        values = self.values(t)
+        channels = self.channels
+        if self.use_numpy:
+            for dtype, (indices, scales) in self._encodings.items():
+                raw = values[indices] / scales
+                if dtype[1] in "iu":
+                    limits = numpy.iinfo(dtype)
+                    raw = numpy.clip(numpy.rint(raw), limits.min, limits.max)
+                registers = raw.astype(dtype).view(">u2").reshape(len(indices), -1).tolist()
+                for index, channel_registers in zip(indices.tolist(), registers):
+                    channel = channels[index]
+                    channel.write(channel.spec.function_code, channel.spec.start, channel_registers)
+        else:
+            for channel, value in zip(channels, values):
+                channel.write(channel.spec.function_code, channel.spec.start, channel.registers(value))
+        self.ticks += 1
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="PlaybackEngine", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        period = 1.0 / self.rate
+        started = time.monotonic()
+        deadline = started
+        while not self._stop.is_set():
+            try:
+                self.tick(deadline - started)
+            except Exception as ex:
+                self.logger.error(f"PlaybackEngine | run | Exception: {ex!r}")
+                return
+            deadline += period
+            now = time.monotonic()
+            if now > deadline:
+                # skip the ticks that were missed instead of bursting through them
+                missed = int((now - deadline) / period) + 1
+                self.overruns += 1
+                deadline += missed * period
+            self._stop.wait(deadline - now)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
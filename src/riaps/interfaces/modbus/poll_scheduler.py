@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import math
+import time
+
+
+class PollGroup:
+    """Parameters that are polled together at the same interval."""
+
+    def __init__(self, interval, parameters):
+        self.interval = interval
+        self.parameters = list(parameters)
+        self.read_plan = None
+        self.deadline = None
+        self.cycles = 0
+        self.overruns = 0
+        self.missed_deadlines = 0
+        self.last_duration = 0.0
+
+    def __repr__(self):
+        return f"PollGroup(interval={self.interval}, parameters={self.parameters})"
+
+
+def load_poll_groups(device_config):
+    """
+    Build the poll groups from the device configuration. poll is either a list of parameters,
+    all polled every Poll_Interval_Seconds, or a mapping of parameter to its settings where
+    'interval' overrides Poll_Interval_Seconds for that parameter:
+
+        poll:
+          FREQ:
+            interval: 0.1
+          STATUS:
+            interval: 60
+          P:
+    """
+    default_interval = device_config.get("Poll_Interval_Seconds")
+    poll_config = device_config.get("poll") or []
+
+    intervals = {}
+    for parameter in poll_config:
+        settings = poll_config[parameter] if isinstance(poll_config, dict) else None
+        interval = (settings or {}).get("interval", default_interval)
+        intervals.setdefault(interval, []).append(parameter)
+
+    return [
+        PollGroup(interval, parameters)
+        for interval, parameters in sorted(
+            intervals.items(), key=lambda item: math.inf if item[0] is None else item[0]
+        )
+    ]
+
+
+class PollScheduler:
+    """
+    Earliest deadline first scheduling of poll groups. Deadlines are absolute: a group's
+    next deadline is its previous deadline plus its interval, so the poll period does not
+    drift by the time each cycle takes. When a cycle runs past the next deadline the
+    missed deadlines are skipped and reported as an overrun.
+    """
+
+    def __init__(self, groups, clock=time.monotonic, start=None):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count()
+        start = self.clock() if start is None else start
+        for group in groups:
+            group.deadline = start + group.interval
+            heapq.heappush(self._heap, (group.deadline, next(self._counter), group))
+
+    def __len__(self):
+        return len(self._heap)
+
+    def next_deadline(self):
+        return self._heap[0][0] if self._heap else None
+
+    def time_to_next_deadline(self):
+        if not self._heap:
+            return None
+        return max(0.0, self._heap[0][0] - self.clock())
+
+    def pop_due(self, now=None):
+        now = self.clock() if now is None else now
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def reschedule(self, group, finished=None):
+        """
+        Schedule the next cycle of a group that was popped by pop_due. Returns the number of
+        deadlines that were missed because the cycle finished late, 0 if it was on time.
+        """
+        finished = self.clock() if finished is None else finished
+        group.cycles += 1
+        missed = 0
+        next_deadline = group.deadline + group.interval
+        if finished > next_deadline:
+            missed = int((finished - group.deadline) // group.interval)
+            next_deadline = group.deadline + (missed + 1) * group.interval
+            group.overruns += 1
+            group.missed_deadlines += missed
+        group.deadline = next_deadline
+        heapq.heappush(self._heap, (group.deadline, next(self._counter), group))
+        return missed
@@ -0,0 +1,162 @@
+# Modbus PDU encoding and decoding for the function codes used by this library.
+# Requests and results follow modbus_tk's Master.execute so that transports built on
+# these helpers return exactly what modbus_tk would.
+import struct
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+
+# Transaction id, protocol id, length, unit id
+MBAP = struct.Struct(">HHHB")
+MBAP_LENGTH = MBAP.size
+MODBUS_PROTOCOL_ID = 0
+
+READ_BITS_FUNCTIONS = (cst.READ_COILS, cst.READ_DISCRETE_INPUTS)
+READ_REGISTERS_FUNCTIONS = (cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS)
+
+
+class Request:
+    """An encoded request PDU and what is needed to decode its response."""
+
+    __slots__ = ("function_code", "pdu", "data_format", "is_read", "nb_of_digits")
+
+    def __init__(self, function_code, pdu, data_format, is_read=False, nb_of_digits=0):
+        self.function_code = function_code
+        self.pdu = pdu
+        self.data_format = data_format
+        self.is_read = is_read
+        self.nb_of_digits = nb_of_digits
+
+
+def _pack_registers(values):
+    return b"".join(struct.pack(">H" if value >= 0 else ">h", value) for value in values)
+
+
+def build_request(
+    function_code,
+    starting_address,
+    quantity_of_x=0,
+    output_value=0,
+    data_format="",
+    write_starting_address_fc23=0,
+    and_mask=-1,
+    or_mask=-1,
+):
+    """Encode a request PDU, see modbus_tk.modbus.Master.execute for the arguments."""
+    if function_code in READ_BITS_FUNCTIONS:
+        pdu = struct.pack(">BHH", function_code, starting_address, quantity_of_x)
+        byte_count = (quantity_of_x + 7) // 8
+        return Request(
+            function_code,
+            pdu,
+            data_format or ">" + byte_count * "B",
+            is_read=True,
+            nb_of_digits=quantity_of_x,
+        )
+
+    if function_code in READ_REGISTERS_FUNCTIONS:
+        pdu = struct.pack(">BHH", function_code, starting_address, quantity_of_x)
+        return Request(
+            function_code, pdu, data_format or ">" + quantity_of_x * "H", is_read=True
+        )
+
+    if function_code == cst.WRITE_SINGLE_COIL:
+        value = 0xFF00 if output_value != 0 else 0
+        pdu = struct.pack(">BHH", function_code, starting_address, value)
+        return Request(function_code, pdu, data_format or ">HH")
+
+    if function_code == cst.WRITE_SINGLE_REGISTER:
+        fmt = ">BH" + ("H" if output_value >= 0 else "h")
+        pdu = struct.pack(fmt, function_code, starting_address, output_value)
+        return Request(function_code, pdu, data_format or ">HH")
+
+    if function_code == cst.MASK_WRITE_REGISTER:
+        if not 0 <= and_mask <= 0xFFFF or not 0 <= or_mask <= 0xFFFF:
+            raise modbus_exceptions.ModbusInvalidRequestError(
+                "and_mask and or_mask must be in the range [0,65535]"
+            )
+        pdu = struct.pack(">BHHH", function_code, starting_address, and_mask, or_mask)
+        return Request(function_code, pdu, data_format or ">HHH")
+
+    if function_code == cst.WRITE_MULTIPLE_COILS:
+        byte_count = (len(output_value) + 7) // 8
+        packed = bytearray(byte_count)
+        for i, value in enumerate(output_value):
+            if value > 0:
+                packed[i // 8] |= 1 << (i % 8)
+        pdu = struct.pack(
+            ">BHHB", function_code, starting_address, len(output_value), byte_count
+        )
+        return Request(function_code, pdu + bytes(packed), ">HH")
+
+    if function_code == cst.WRITE_MULTIPLE_REGISTERS:
+        if output_value and data_format:
+            values = struct.pack(data_format, *output_value)
+        else:
+            values = _pack_registers(output_value)
+        pdu = struct.pack(
+            ">BHHB", function_code, starting_address, len(values) // 2, len(values)
+        )
+        # the response is always the starting address and the number of registers written
+        return Request(function_code, pdu + values, ">HH")
+
+    if function_code == cst.READ_WRITE_MULTIPLE_REGISTERS:
+        pdu = struct.pack(
+            ">BHHHHB",
+            function_code,
+            starting_address,
+            quantity_of_x,
+            write_starting_address_fc23,
+            len(output_value),
+            2 * len(output_value),
+        )
+        return Request(
+            function_code,
+            pdu + _pack_registers(output_value),
+            data_format or ">" + quantity_of_x * "H",
+            is_read=True,
+        )
+
+    raise modbus_exceptions.ModbusFunctionNotSupportedError(
+        f"The {function_code} function code is not supported. "
+    )
+
+
+def parse_response(request: Request, response_pdu):
+    """Decode a response PDU into the tuple modbus_tk's execute would return."""
+    if len(response_pdu) < 2:
+        raise modbus_exceptions.ModbusInvalidResponseError(
+            f"Response PDU is too short: {len(response_pdu)} bytes"
+        )
+    return_code, byte_2 = response_pdu[0], response_pdu[1]
+    if return_code > 0x80:
+        raise modbus_exceptions.ModbusError(byte_2)
+    if return_code != request.function_code:
+        raise modbus_exceptions.ModbusInvalidResponseError(
+            f"Response function code {return_code} does not match the request {request.function_code}"
+        )
+
+    if request.is_read:
+        data = response_pdu[2:]
+        if byte_2 != len(data):
+            raise modbus_exceptions.ModbusInvalidResponseError(
+                f"Byte count is {byte_2} while actual number of bytes is {len(data)}. "
+            )
+    else:
+        data = response_pdu[1:]
+
+    result = struct.unpack(request.data_format, data)
+    if request.nb_of_digits:
+        digits = []
+        for byte_value in result:
+            for _ in range(8):
+                if len(digits) >= request.nb_of_digits:
+                    break
+                digits.append(byte_value & 1)
+                byte_value >>= 1
+        result = tuple(digits)
+    return result
+
+
+def build_mbap(transaction_id, unit_id, pdu_length):
+    return MBAP.pack(transaction_id, MODBUS_PROTOCOL_ID, pdu_length + 1, unit_id)
@@ -0,0 +1,101 @@
+import modbus_tk.defines as cst
+
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+
+# Only register reads can be coalesced, coils and discrete inputs are bit packed.
+BLOCK_READ_FUNCTIONS = (cst.READ_HOLDING_REGISTERS, cst.READ_INPUT_REGISTERS)
+
+
+class ReadBlock:
+    """A single block read that covers one or more *_READ commands."""
+
+    def __init__(self, slave_id, function_code, start, length=0):
+        self.slave_id = slave_id
+        self.function_code = function_code
+        self.start = start
+        self.length = length
+        # (index in the requested parameter list, parameter, offset into the block)
+        self.members = []
+
+    @property
+    def end(self):
+        return self.start + self.length
+
+    @property
+    def name(self):
+        return f"BLOCK_{self.function_code}_{self.start}_{self.length}"
+
+    def add(self, index, parameter, start, length):
+        self.length = max(self.end, start + length) - self.start
+        self.members.append((index, parameter, start - self.start))
+
+    def __repr__(self):
+        parameters = [member[1] for member in self.members]
+        return (
+            f"ReadBlock(slave={self.slave_id}, function={self.function_code}, "
+            f"start={self.start}, length={self.length}, parameters={parameters})"
+        )
+
+
+class ReadPlan:
+    """Block reads plus the parameters that have to be read on their own."""
+
+    def __init__(self, parameters, blocks, singles):
+        self.parameters = list(parameters)
+        self.blocks = blocks
+        # (index in the requested parameter list, parameter)
+        self.singles = singles
+
+    @property
+    def transactions(self):
+        return len(self.blocks) + len(self.singles)
+
+    def split(self, block):
+        """Read the members of block one by one from now on, e.g. after the slave rejected it."""
+        self.blocks.remove(block)
+        self.singles.extend((index, parameter) for index, parameter, _ in block.members)
+        self.singles.sort()
+
+    def __repr__(self):
+        return (
+            f"ReadPlan(parameters={len(self.parameters)}, "
+            f"transactions={self.transactions}, blocks={self.blocks}, singles={self.singles})"
+        )
+
+
+def compile_read_plan(read_commands, slave_id, parameters, max_gap=None, max_length=None):
+    """
+    Group the *_READ commands (read_commands, {parameter: CommandSpec}) of the given
+    parameters by function code and merge adjacent (or, with max_gap > 0, nearby) register
+    ranges into block reads of at most max_length registers.
+    """
+    if max_gap is None:
+        max_gap = ModbusSystem.ReadPlan.MaxRegisterGap
+    if max_length is None:
+        max_length = ModbusSystem.ReadPlan.MaxBlockRegisters
+
+    groups = {}
+    singles = []
+    for index, parameter in enumerate(parameters):
+        spec = read_commands.get(parameter)
+        if spec is None or spec.function_code not in BLOCK_READ_FUNCTIONS or spec.length > max_length:
+            singles.append((index, parameter))
+            continue
+        key = (slave_id, spec.function_code)
+        groups.setdefault(key, []).append((spec.start, spec.length, index, parameter))
+
+    blocks = []
+    for (block_slave_id, function_code), entries in groups.items():
+        entries.sort()
+        block = None
+        for start, length, index, parameter in entries:
+            if (
+                block is None
+                or start > block.end + max_gap
+                or max(block.end, start + length) - block.start > max_length
+            ):
+                block = ReadBlock(block_slave_id, function_code, start)
+                blocks.append(block)
+            block.add(index, parameter, start, length)
+
+    return ReadPlan(parameters, blocks, singles)
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import modbus_tk.defines as cst
+
+# the register table read or written by each function code
+TABLES = {
+    cst.READ_COILS: "coils",
+    cst.WRITE_SINGLE_COIL: "coils",
+    cst.WRITE_MULTIPLE_COILS: "coils",
+    cst.READ_DISCRETE_INPUTS: "discrete_inputs",
+    cst.READ_HOLDING_REGISTERS: "holding_registers",
+    cst.WRITE_SINGLE_REGISTER: "holding_registers",
+    cst.WRITE_MULTIPLE_REGISTERS: "holding_registers",
+    cst.READ_WRITE_MULTIPLE_REGISTERS: "holding_registers",
+    cst.MASK_WRITE_REGISTER: "holding_registers",
+    cst.READ_INPUT_REGISTERS: "input_registers",
+}
+
+
+class RegisterCache:
+    """
+    Shadow image of the registers most recently read from (or written to) a device, each
+    stamped with the time it was read. Reads that accept a max_age are answered from it.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def update(self, slave_id, function_code, start, registers, now=None):
+        table = TABLES.get(function_code)
+        if table is None:
+            return
+        now = self.clock() if now is None else now
+        with self._lock:
+            image = self._tables.setdefault((slave_id, table), {})
+            for address, register in enumerate(registers, start):
+                image[address] = (register, now)
+
+    def invalidate(self, slave_id, function_code, start, length):
+        table = TABLES.get(function_code)
+        with self._lock:
+            image = self._tables.get((slave_id, table))
+            if image:
+                for address in range(start, start + length):
+                    image.pop(address, None)
+
+    def get(self, slave_id, function_code, start, length, max_age, now=None):
+        """The cached registers if all of them were read less than max_age seconds ago, else None."""
+        now = self.clock() if now is None else now
+        with self._lock:
+            image = self._tables.get((slave_id, TABLES.get(function_code)))
+            registers = []
+            for address in range(start, start + length):
+                entry = image.get(address) if image else None
+                if entry is None or now - entry[1] > max_age:
+                    self.misses += 1
+                    return None
+                registers.append(entry[0])
+            self.hits += 1
+            return registers
+
+    def peek(self, slave_id, function_code, start, length):
+        """The cached registers whatever their age, None if one is missing. Not counted in the stats."""
+        with self._lock:
+            image = self._tables.get((slave_id, TABLES.get(function_code)))
+            if not image:
+                return None
+            entries = [image.get(address) for address in range(start, start + length)]
+        if None in entries:
+            return None
+        return [entry[0] for entry in entries]
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "registers": sum(len(image) for image in self._tables.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
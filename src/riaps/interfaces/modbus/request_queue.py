@@ -0,0 +1,147 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from riaps.interfaces.modbus.connection_pool import Priority, current_priority, request_priority
+from riaps.interfaces.modbus.metrics import LatencyHistogram
+
+PRIORITY_NAMES = {Priority.COMMAND: "command", Priority.POLL: "poll"}
+
+
+class Request:
+    __slots__ = ("priority", "function", "args", "merge_key", "enqueued", "done", "ran", "result",
+                 "error", "waiters")
+
+    def __init__(self, priority, function, args, merge_key):
+        self.priority = priority
+        self.function = function
+        self.args = args
+        self.merge_key = merge_key
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.ran = False
+        self.result = None
+        self.error = None
+        self.waiters = 1
+
+
+class RequestQueue:
+    """
+    All Modbus transactions of one device go through this queue and are executed one at a
+    time by its worker thread, highest priority (lowest number) first and in submission
+    order within a priority. A read submitted while an identical read is still queued is
+    merged into it: both callers get the result of one transaction.
+    """
+
+    def __init__(self, name, logger=None):
+        self.name = name
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self._condition = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._pending = {}
+        self._stopped = False
+
+        self.submitted = 0
+        self.executed = 0
+        self.merged = 0
+        self.max_depth = 0
+        self.wait_time = {}
+
+        self._worker = threading.Thread(target=self._run, name=f"{name}-requests", daemon=True)
+        self._worker.start()
+
+    def in_worker(self):
+        return threading.current_thread() is self._worker
+
+    @property
+    def depth(self):
+        return len(self._heap)
+
+    def call(self, function, *args, priority=None, merge_key=None, stopped_result=None):
+        """Execute function(*args) on the worker thread and return its result."""
+        priority = current_priority() if priority is None else priority
+        with self._condition:
+            if self._stopped:
+                return stopped_result
+            self.submitted += 1
+            request = self._pending.get(merge_key) if merge_key is not None else None
+            if request is not None:
+                self.merged += 1
+                request.waiters += 1
+                if priority < request.priority:
+                    # the earlier entry is skipped once this one has run
+                    request.priority = priority
+                    heapq.heappush(self._heap, (priority, next(self._counter), request))
+            else:
+                request = Request(priority, function, args, merge_key)
+                if merge_key is not None:
+                    self._pending[merge_key] = request
+                heapq.heappush(self._heap, (priority, next(self._counter), request))
+                self.max_depth = max(self.max_depth, len(self._heap))
+                self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        if not request.ran:
+            return stopped_result
+        return request.result
+
+    def _next_request(self):
+        with self._condition:
+            while True:
+                while self._heap:
+                    priority, _, request = heapq.heappop(self._heap)
+                    if request.done.is_set() or priority != request.priority:
+                        continue
+                    if request.merge_key is not None:
+                        self._pending.pop(request.merge_key, None)
+                    histogram = self.wait_time.get(priority)
+                    if histogram is None:
+                        histogram = self.wait_time[priority] = LatencyHistogram()
+                    histogram.record(time.perf_counter() - request.enqueued)
+                    return request
+                if self._stopped:
+                    return None
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            request = self._next_request()
+            if request is None:
+                return
+            try:
+                # a shared connection serves the request with the priority it was queued with
+                with request_priority(request.priority):
+                    request.result = request.function(*request.args)
+            except Exception as ex:
+                self.logger.error(f"RequestQueue | {self.name} | Exception: {ex!r}")
+                request.error = ex
+            request.ran = True
+            self.executed += 1
+            request.done.set()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            for _, _, request in self._heap:
+                request.done.set()
+            self._heap.clear()
+            self._pending.clear()
+            self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            return {
+                "depth": len(self._heap),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "executed": self.executed,
+                "merged": self.merged,
+                "wait_time": {
+                    PRIORITY_NAMES.get(priority, priority): histogram.as_dict()
+                    for priority, histogram in self.wait_time.items()
+                },
+            }
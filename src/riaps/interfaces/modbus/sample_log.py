@@ -0,0 +1,245 @@
+import bisect
+import collections
+import json
+import math
+import mmap
+import os
+import pathlib
+import struct
+import threading
+
+MAGIC = b"RMSL"
+VERSION = 1
+# magic, version, record size, capacity, record count, first and last timestamp
+HEADER = struct.Struct("<4sHHIIdd")
+HEADER_SIZE = 32
+# timestamp, scaled value, parameter id, value index, flags, register count, registers
+RECORD = struct.Struct("<ddHBBH2x4H")
+MAX_RECORD_REGISTERS = 4
+# the value index is one byte
+MAX_RECORD_VALUES = 256
+FLAG_ERROR = 1
+SEGMENT_GLOB = "segment-*.bin"
+PARAMETERS_FILE = "parameters.json"
+
+Sample = collections.namedtuple(
+    "Sample", ["timestamp", "parameter", "index", "value", "registers", "error"]
+)
+
+
+def segment_path(directory, number):
+    return pathlib.Path(directory) / f"segment-{number:08d}.bin"
+
+
+def segment_number(path):
+    return int(path.stem.split("-")[1])
+
+
+class SampleLog:
+    """
+    Append-only binary log of polled samples, written to fixed size memory-mapped segment
+    files in directory. Each record holds the poll timestamp, the parameter id, the scaled
+    value and up to MAX_RECORD_REGISTERS raw registers; a parameter with several values
+    gets one record per value. A full segment is closed and a new one started, the oldest
+    segments are deleted beyond max_segments. Parameter ids are kept in parameters.json.
+    """
+
+    def __init__(self, directory, segment_records=65536, max_segments=16):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self._lock = threading.Lock()
+        self.parameters = load_parameters(self.directory)
+        self._parameter_ids = {name: number for number, name in enumerate(self.parameters)}
+        numbers = [segment_number(path) for path in self.directory.glob(SEGMENT_GLOB)]
+        # never append to a segment of an earlier run, its last records may be torn
+        self._segment_number = max(numbers, default=0)
+        self._file = None
+        self._map = None
+        self._count = 0
+        self._first = None
+
+    def parameter_id(self, parameter):
+        number = self._parameter_ids.get(parameter)
+        if number is None:
+            number = self._parameter_ids[parameter] = len(self.parameters)
+            self.parameters.append(parameter)
+            temporary = self.directory / f"{PARAMETERS_FILE}.tmp"
+            temporary.write_text(json.dumps(self.parameters))
+            os.replace(temporary, self.directory / PARAMETERS_FILE)
+        return number
+
+    def _open_segment(self):
+        self._segment_number += 1
+        size = HEADER_SIZE + RECORD.size * self.segment_records
+        self._file = open(segment_path(self.directory, self._segment_number), "w+b")
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._count = 0
+        self._first = None
+        self._write_header(0.0)
+        for path in sorted(self.directory.glob(SEGMENT_GLOB), key=segment_number)[: -self.max_segments]:
+            path.unlink(missing_ok=True)
+
+    def _close_segment(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+        self._map = None
+        self._file = None
+
+    def _write_header(self, last):
+        HEADER.pack_into(
+            self._map, 0, MAGIC, VERSION, RECORD.size, self.segment_records,
+            self._count, self._first or 0.0, last,
+        )
+
+    def append(self, timestamp, parameter, values=None, registers=(), error=False):
+        """
+        Log the values of one parameter, or an error record (value NaN) if error is set.
+        Raises ValueError, before writing any record, for more than MAX_RECORD_VALUES values
+        or registers that are not 16 bit.
+        """
+        number = self.parameter_id(parameter)
+        raw = list(registers[:MAX_RECORD_REGISTERS])
+        raw += [0] * (MAX_RECORD_REGISTERS - len(raw))
+        if not all(0 <= register <= 0xFFFF for register in raw):
+            raise ValueError(f"registers {raw} are not 16 bit")
+        flags = FLAG_ERROR if error else 0
+        values = [math.nan] if error or not values else [float(value) for value in values]
+        if len(values) > MAX_RECORD_VALUES:
+            raise ValueError(f"{len(values)} values, a record holds index {MAX_RECORD_VALUES - 1} at most")
+        with self._lock:
+            for index, value in enumerate(values):
+                if self._map is None or self._count == self.segment_records:
+                    self._close_segment()
+                    self._open_segment()
+                RECORD.pack_into(
+                    self._map, HEADER_SIZE + self._count * RECORD.size,
+                    timestamp, value, number, index, flags, min(len(registers), 0xFFFF), *raw,
+                )
+                if self._first is None:
+                    self._first = timestamp
+                self._count += 1
+                self._write_header(timestamp)
+
+    def flush(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+def load_parameters(directory):
+    path = pathlib.Path(directory) / PARAMETERS_FILE
+    if not path.exists():
+        return []
+    return json.loads(path.read_text())
+
+
+class Segment:
+    """Read-only view of one segment file, its records are sorted by timestamp."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, _, self.count, self.first, self.last = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self._map.close()
+            raise ValueError(f"{path} is not a version {VERSION} sample log segment")
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, position):
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        return RECORD.unpack_from(self._map, HEADER_SIZE + position * RECORD.size)
+
+    def timestamp(self, position):
+        return struct.unpack_from("<d", self._map, HEADER_SIZE + position * RECORD.size)[0]
+
+    def position(self, timestamp):
+        """Position of the first record taken at or after timestamp."""
+        return bisect.bisect_left(_Timestamps(self), timestamp)
+
+    def close(self):
+        self._map.close()
+
+
+class _Timestamps:
+    def __init__(self, segment):
+        self.segment = segment
+
+    def __len__(self):
+        return len(self.segment)
+
+    def __getitem__(self, position):
+        return self.segment.timestamp(position)
+
+
+class SampleLogReader:
+    """
+    Reads a SampleLog directory, also while it is being written. The segment headers hold
+    their first and last timestamps, so a time range only touches the segments that overlap
+    it and is located in them by binary search.
+    """
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+
+    @property
+    def parameters(self):
+        return load_parameters(self.directory)
+
+    def segments(self):
+        for path in sorted(self.directory.glob(SEGMENT_GLOB), key=segment_number):
+            try:
+                segment = Segment(path)
+            except (OSError, ValueError):
+                # rotated away, or not written yet
+                continue
+            yield segment
+
+    def read(self, start=None, end=None, parameters=None):
+        """Yield the Samples with start <= timestamp < end, optionally only of some parameters."""
+        names = self.parameters
+        wanted = None
+        if parameters is not None:
+            wanted = {number for number, name in enumerate(names) if name in parameters}
+        for segment in self.segments():
+            try:
+                if not segment.count:
+                    continue
+                if (start is not None and segment.last < start) or (end is not None and segment.first >= end):
+                    continue
+                position = segment.position(start) if start is not None else 0
+                for position in range(position, segment.count):
+                    timestamp, value, number, index, flags, register_count, *raw = segment[position]
+                    if end is not None and timestamp >= end:
+                        break
+                    if wanted is not None and number not in wanted:
+                        continue
+                    yield Sample(
+                        timestamp,
+                        names[number] if number < len(names) else number,
+                        index,
+                        value,
+                        raw[: min(register_count, MAX_RECORD_REGISTERS)],
+                        bool(flags & FLAG_ERROR),
+                    )
+            finally:
+                segment.close()
+
+    def slice(self, start=None, end=None, parameters=None):
+        return list(self.read(start, end, parameters))
+
+    def __iter__(self):
+        return self.read()
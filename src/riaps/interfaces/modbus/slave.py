@@ -1,10 +1,30 @@
+import time
+
 from modbus_tk import modbus_tcp, defines
 import yaml
 
+from riaps.interfaces.modbus.playback import PlaybackEngine
+from riaps.interfaces.modbus.traffic import READ_BLOCK_TYPES, TrafficReplay
+
+
+class DelayedTcpServer(modbus_tcp.TcpServer):
+    """A TcpServer that answers a request after response_delay(request) seconds, if set."""
+
+    response_delay = None
+
+    def _handle(self, request):
+        delay = self.response_delay(request) if self.response_delay else None
+        if delay:
+            time.sleep(delay)
+        return super()._handle(request)
+
 
 class Slave:
     def __init__(self):
         self.slaves = {}
+        self.blocks = {}
+        self.replay = None
+        self.playback = None
 
     def load_cfg(self, config_path):
         try:
@@ -37,14 +57,62 @@ class Slave:
         self.init_values(slave_id, reg_cfg)
 
     def setup_server(self, port, address):
-        self.server = modbus_tcp.TcpServer(port, address)
+        self.server = DelayedTcpServer(port, address)
 
     def start(self):
         self.server.start()
 
     def stop(self):
+        self.stop_playback()
+        self.stop_replay()
         self.server.stop()
 
+    def start_replay(self, path, speed=1.0, delays=True, loop=False):
+        """
+        Replay the register values and response delays of a recording made with
+        traffic.TrafficRecorder, speed times faster than real time.
+        """
+        self.stop_replay()
+        self.replay = TrafficReplay(self.server, self.find_block, path, speed=speed, delays=delays, loop=loop)
+        self.replay.start()
+        return self.replay
+
+    def stop_replay(self):
+        if self.replay is not None:
+            self.replay.stop()
+            self.replay = None
+
+    def start_playback(self, device_config, rate=10.0, base_directory=None):
+        """
+        Update the registers of the playback section of a master-side device configuration
+        (see playback.py) rate times per second.
+        """
+        self.stop_playback()
+        slave_id = device_config["SlaveID"]
+
+        def write(function_code, start, registers):
+            block = self.find_block(slave_id, READ_BLOCK_TYPES[function_code], start, len(registers))
+            if block is not None:
+                slave, block_name = block
+                slave.set_values(block_name, start, registers)
+
+        self.playback = PlaybackEngine(rate=rate)
+        self.playback.add_device(device_config, write, base_directory=base_directory)
+        self.playback.start()
+        return self.playback
+
+    def stop_playback(self):
+        if self.playback is not None:
+            self.playback.stop()
+            self.playback = None
+
+    def find_block(self, slave_id, block_type, address, size):
+        """(modbus_tk slave, block name) of the block that holds size values at address, or None."""
+        for name, (type_, starting_address, block_size) in self.blocks.get(slave_id, {}).items():
+            if type_ == block_type and starting_address <= address and address + size <= starting_address + block_size:
+                return self.slaves[slave_id], name
+        return None
+
     def add_slave(self, slave_id):
         self.slaves[slave_id] = self.server.add_slave(slave_id)
 
@@ -59,6 +127,7 @@ class Slave:
             starting_address=starting_address,
             size=size,
         )
+        self.blocks.setdefault(slave_id, {})[block_name] = (getattr(defines, block_type), starting_address, size)
 
     def init_values(self, slave_id, reg_cfg):
         slave = self.slaves[slave_id]
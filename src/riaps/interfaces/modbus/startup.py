@@ -0,0 +1,78 @@
+import concurrent.futures
+import logging
+import time
+
+from riaps.interfaces.modbus.ModbusInterface import ModbusInterface
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+
+
+def start_interfaces(device_config_paths, logger=None, deadline=None, max_workers=None):
+    """
+    Create the ModbusInterface of every device and probe and connect them concurrently,
+    with one probe per TCP endpoint or serial device whose result all of its devices share.
+    Returns the interfaces by device name once all of them started or deadline seconds
+    passed. Devices still starting at the deadline finish in the background, their
+    interface's started event is set when they do. Unreachable devices come online later
+    through their ConnectionHealth monitor.
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    deadline = ModbusSystem.Startup.DeadlineSeconds if deadline is None else deadline
+    max_workers = max_workers or ModbusSystem.Startup.MaxWorkers
+
+    interfaces = {
+        device_name: ModbusInterface(path_to_file=path, logger=logger, auto_start=False)
+        for device_name, path in device_config_paths.items()
+    }
+    if not interfaces:
+        return interfaces
+
+    endpoints = {}
+    for device_name, interface in interfaces.items():
+        endpoints.setdefault(interface.endpoint(), []).append(device_name)
+
+    def start_endpoint(device_names):
+        online = interfaces[device_names[0]].is_online()
+        failed = {}
+        for device_name in device_names:
+            try:
+                interfaces[device_name].start(online=online)
+            except Exception as ex:
+                failed[device_name] = ex
+        return failed
+
+    started = time.monotonic()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(max_workers, len(endpoints)), thread_name_prefix="modbus-startup"
+    )
+    futures = {executor.submit(start_endpoint, device_names): device_names for device_names in endpoints.values()}
+    done, pending = concurrent.futures.wait(futures, timeout=deadline)
+    # the pending starts keep running, do not wait for them
+    executor.shutdown(wait=False)
+
+    failed = {}
+    for future in done:
+        if future.exception():
+            failed.update(dict.fromkeys(futures[future], future.exception()))
+        else:
+            failed.update(future.result())
+    finished = [device_name for future in done for device_name in futures[future]]
+    online = [
+        device_name
+        for device_name in finished
+        if device_name not in failed and interfaces[device_name].online["status"]
+    ]
+    offline = sorted(set(finished) - set(online))
+    logger.info(
+        f"start_interfaces | {len(online)} of {len(interfaces)} devices online "
+        f"after {time.monotonic() - started:.2f} s"
+    )
+    if offline:
+        logger.warning(f"start_interfaces | offline, retried in the background: {offline}")
+    if pending:
+        logger.warning(
+            f"start_interfaces | still starting after the {deadline} s deadline: "
+            f"{sorted(device_name for future in pending for device_name in futures[future])}"
+        )
+    for device_name, ex in failed.items():
+        logger.error(f"start_interfaces | {device_name} failed to start: {ex!r}")
+    return interfaces
@@ -0,0 +1,121 @@
+import array
+import bisect
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, array views are used without it
+    numpy = None
+
+
+class RingBuffer:
+    """
+    Fixed capacity time series of one parameter: a timestamp and width values per sample.
+
+    Every sample is written twice, at pos and at pos + capacity, so the last n samples are
+    always contiguous in storage and window() returns views into it without copying:
+    numpy arrays when numpy is installed, memoryviews of array.array otherwise. The views
+    are overwritten as new samples arrive, copy them to keep them.
+    """
+
+    def __init__(self, capacity, width=None, use_numpy=None):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self.width = None
+        self.use_numpy = numpy is not None if use_numpy is None else use_numpy
+        self.count = 0
+        self._pos = 0
+        self._timestamps = None
+        self._values = None
+        if width is not None:
+            self._allocate(width)
+
+    def _allocate(self, width):
+        self.width = width
+        size = 2 * self.capacity
+        if self.use_numpy:
+            self._timestamps = numpy.zeros(size)
+            self._values = numpy.zeros((size, width))
+        else:
+            self._timestamps = array.array("d", bytes(8 * size))
+            self._values = array.array("d", bytes(8 * size * width))
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, timestamp, values):
+        if self.width is None:
+            self._allocate(len(values))
+        elif len(values) != self.width:
+            raise ValueError(f"expected {self.width} values, got {len(values)}")
+        pos = self._pos
+        mirror = pos + self.capacity
+        self._timestamps[pos] = self._timestamps[mirror] = timestamp
+        if self.use_numpy:
+            self._values[pos] = self._values[mirror] = values
+        else:
+            width = self.width
+            self._values[pos * width:(pos + 1) * width] = array.array("d", values)
+            self._values[mirror * width:(mirror + 1) * width] = self._values[
+                pos * width:(pos + 1) * width
+            ]
+        self._pos = (pos + 1) % self.capacity
+        self.count += 1
+
+    def window(self, samples=None, since=None):
+        """
+        (timestamps, values) of the last samples, or of the samples taken at or after since.
+        values holds width values per sample: an (n, width) array with numpy, a flat
+        memoryview of n * width values without.
+        """
+        available = len(self)
+        n = available if samples is None else max(0, min(samples, available))
+        end = self._pos + self.capacity
+        start = end - n
+        if self._timestamps is None:
+            return self._empty()
+        timestamps = self._view(self._timestamps, start, end)
+        if since is not None:
+            if self.use_numpy:
+                skip = int(numpy.searchsorted(timestamps, since))
+            else:
+                skip = bisect.bisect_left(timestamps, since)
+            start += skip
+            timestamps = timestamps[skip:]
+        if self.use_numpy:
+            return timestamps, self._values[start:end]
+        return timestamps, self._view(self._values, start * self.width, end * self.width)
+
+    def last(self):
+        """(timestamp, values) of the newest sample, None if the buffer is empty."""
+        if not self.count:
+            return None
+        timestamps, values = self.window(1)
+        return timestamps[0], list(values[0] if self.use_numpy else values)
+
+    def _view(self, storage, start, end):
+        if self.use_numpy:
+            return storage[start:end]
+        return memoryview(storage)[start:end]
+
+    def _empty(self):
+        if self.use_numpy:
+            return numpy.zeros(0), numpy.zeros((0, 0))
+        return memoryview(array.array("d")), memoryview(array.array("d"))
+
+
+def load_history_buffers(device_config, default_capacity=None):
+    """
+    Ring buffers for the polled parameters that keep a history, by parameter. History_Samples
+    sets the capacity for every polled parameter, the 'history' setting of a parameter in
+    the poll mapping overrides it (0 disables the history of that parameter).
+    """
+    poll_config = device_config.get("poll") or []
+    capacity = device_config.get("History_Samples", default_capacity)
+    buffers = {}
+    for parameter in poll_config:
+        settings = poll_config[parameter] if isinstance(poll_config, dict) else None
+        parameter_capacity = (settings or {}).get("history", capacity)
+        if parameter_capacity:
+            buffers[parameter] = RingBuffer(parameter_capacity)
+    return buffers
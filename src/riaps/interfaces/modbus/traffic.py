@@ -0,0 +1,203 @@
+import collections
+import math
+import struct
+import threading
+import time
+
+from modbus_tk import hooks, modbus_tcp
+import modbus_tk.defines as cst
+
+MAGIC = b"RMTR"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+# send timestamp, latency in seconds (NaN without a response), slave id, request and response PDU sizes
+RECORD = struct.Struct("<dfBHH")
+
+TrafficRecord = collections.namedtuple(
+    "TrafficRecord", ["timestamp", "latency", "slave_id", "request", "response"]
+)
+
+# the block type a read response is replayed into
+READ_BLOCK_TYPES = {
+    cst.READ_COILS: cst.COILS,
+    cst.READ_DISCRETE_INPUTS: cst.DISCRETE_INPUTS,
+    cst.READ_HOLDING_REGISTERS: cst.HOLDING_REGISTERS,
+    cst.READ_INPUT_REGISTERS: cst.ANALOG_INPUTS,
+    cst.READ_WRITE_MULTIPLE_REGISTERS: cst.HOLDING_REGISTERS,
+}
+
+
+def split_frame(master, frame):
+    """(slave id, PDU) of a TCP or RTU frame."""
+    if isinstance(master, modbus_tcp.TcpMaster):
+        return frame[6], bytes(frame[7:])
+    return frame[0], bytes(frame[1:-2])
+
+
+class TrafficRecorder:
+    """
+    Records the requests and responses exchanged by a modbus_tk master, with their send
+    time and latency, to a compact binary file. It uses the modbus.Master hooks, so it
+    sees the traffic of every device on a shared connection; slave_id filters it.
+    """
+
+    def __init__(self, path, master, slave_id=None):
+        self.path = path
+        self.master = master
+        self.slave_id = slave_id
+        self.records = 0
+        self._lock = threading.Lock()
+        self._pending = None
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        hooks.install_hook("modbus.Master.before_send", self._before_send)
+        hooks.install_hook("modbus.Master.after_recv", self._after_recv)
+
+    def _before_send(self, args):
+        master, request = args
+        if master is not self.master:
+            return None
+        slave_id, pdu = split_frame(master, request)
+        with self._lock:
+            if self._pending is not None:
+                # the previous request got no response
+                self._write(*self._pending, math.nan, b"")
+            self._pending = None
+            if self.slave_id is None or slave_id == self.slave_id:
+                self._pending = (time.time(), time.perf_counter(), slave_id, pdu)
+        return None
+
+    def _after_recv(self, args):
+        master, response = args
+        if master is not self.master:
+            return None
+        with self._lock:
+            if self._pending is not None:
+                timestamp, sent, slave_id, pdu = self._pending
+                self._pending = None
+                self._write(timestamp, sent, slave_id, pdu, time.perf_counter() - sent,
+                            split_frame(master, response)[1])
+        return None
+
+    def _write(self, timestamp, sent, slave_id, request, latency, response):
+        if self._file is None:
+            return
+        self._file.write(RECORD.pack(timestamp, latency, slave_id, len(request), len(response)))
+        self._file.write(request)
+        self._file.write(response)
+        self.records += 1
+
+    def close(self):
+        hooks.uninstall_hook("modbus.Master.before_send", self._before_send)
+        hooks.uninstall_hook("modbus.Master.after_recv", self._after_recv)
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_traffic(path):
+    """Yield the TrafficRecords of a file written by TrafficRecorder."""
+    with open(path, "rb") as file:
+        magic, version = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} traffic recording")
+        while True:
+            head = file.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            timestamp, latency, slave_id, request_size, response_size = RECORD.unpack(head)
+            request = file.read(request_size)
+            response = file.read(response_size)
+            if len(response) < response_size:
+                # torn last record
+                return
+            yield TrafficRecord(timestamp, latency, slave_id, request, response)
+
+
+def response_values(request, response):
+    """
+    (block type, address, values) that a recorded read response shows the device held,
+    None for writes and exception responses.
+    """
+    if len(request) < 5 or not response or response[0] != request[0]:
+        return None
+    function_code = request[0]
+    block_type = READ_BLOCK_TYPES.get(function_code)
+    if block_type is None:
+        return None
+    address, quantity = struct.unpack(">HH", request[1:5])
+    data = response[2:2 + response[1]]
+    if block_type in (cst.COILS, cst.DISCRETE_INPUTS):
+        values = [(data[i // 8] >> (i % 8)) & 1 for i in range(min(quantity, 8 * len(data)))]
+    else:
+        values = list(struct.unpack(f">{len(data) // 2}H", data))
+    return block_type, address, values
+
+
+class TrafficReplay(threading.Thread):
+    """
+    Replays a traffic recording into a modbus_tk server: at the time each recorded read
+    response was received (divided by speed) its values are set in the blocks of the
+    server. With delays, and a server with a response_delay attribute (slave.DelayedTcpServer),
+    the server answers each request after the latency recorded for the same slave, function
+    and address. Delays are not scaled by speed.
+    """
+
+    def __init__(self, server, find_block, path, speed=1.0, delays=True, loop=False):
+        super().__init__(daemon=True)
+        self.server = server
+        self.find_block = find_block
+        self.records = list(read_traffic(path))
+        self.speed = speed
+        self.delays = delays
+        self.loop = loop
+        self.latencies = {}
+        self.replayed = 0
+        self.stop_event = threading.Event()
+
+    def start(self):
+        if self.delays and hasattr(self.server, "response_delay"):
+            # not a modbus_tk hook, those are called holding a lock shared by all masters and servers
+            self.server.response_delay = self.response_delay
+        super().start()
+
+    def response_delay(self, request):
+        """The recorded latency of the request, a TCP frame."""
+        if len(request) < 10:
+            return None
+        return self.latencies.get((request[6], request[7], struct.unpack(">H", request[8:10])[0]))
+
+    def run(self):
+        if not self.records:
+            return
+        first = self.records[0].timestamp
+        while True:
+            started = time.monotonic()
+            for record in self.records:
+                latency = 0.0 if math.isnan(record.latency) else record.latency
+                due = started + (record.timestamp + latency - first) / self.speed
+                if self.stop_event.wait(max(0.0, due - time.monotonic())):
+                    return
+                self.apply(record)
+            if not self.loop:
+                return
+
+    def apply(self, record):
+        if len(record.request) >= 3 and not math.isnan(record.latency):
+            key = (record.slave_id, record.request[0], struct.unpack(">H", record.request[1:3])[0])
+            self.latencies[key] = record.latency
+        values = response_values(record.request, record.response)
+        if values is None:
+            return
+        block_type, address, values = values
+        block = self.find_block(record.slave_id, block_type, address, len(values))
+        if block is not None:
+            slave, block_name = block
+            slave.set_values(block_name, address, values)
+        self.replayed += 1
+
+    def stop(self):
+        self.stop_event.set()
+        if getattr(self.server, "response_delay", None) == self.response_delay:
+            self.server.response_delay = None
@@ -0,0 +1,199 @@
+"""
+Microbenchmarks for the ModbusInterface hot paths, run against the local slave.Slave
+simulator. Results are written as JSON so they can be compared across versions:
+
+    python tests/bench/bench_interface.py --output before.json
+    python tests/bench/bench_interface.py --output after.json --baseline before.json
+
+All times are in microseconds.
+"""
+import argparse
+import datetime as dt
+import json
+import logging
+import pathlib
+import platform
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import yaml
+
+import riaps.interfaces.modbus.slave as slave
+from riaps.interfaces.modbus.ModbusInterface import ModbusInterface
+from riaps.interfaces.modbus.commands import compile_command_table
+from riaps.interfaces.modbus.config import load_config_file, validate_configuration
+from riaps.interfaces.modbus.config_cache import ConfigCache
+
+HERE = pathlib.Path(__file__).parent
+SIM_DIR = HERE.parent / "sim"
+CONFIG_DIR = HERE.parent.parent / "example" / "Minimal" / "cfg"
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    n = len(samples)
+
+    def percentile(p):
+        return samples[min(n - 1, int(p / 100.0 * n))]
+
+    return {
+        "n": n,
+        "min": samples[0],
+        "mean": statistics.fmean(samples),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": samples[-1],
+    }
+
+
+def measure(function, iterations, warmup=10):
+    for _ in range(warmup):
+        function()
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        function()
+        samples.append((time.perf_counter_ns() - start) / 1000.0)
+    return summarize(samples)
+
+
+def start_simulator(port):
+    server = slave.Slave()
+    sim_config = server.load_cfg(SIM_DIR / "cfg.yaml")
+    sim_config["DEVICE"]["TCP"]["Port"] = port
+    server.setup_from_cfg(sim_config)
+    server.start()
+    address = sim_config["DEVICE"]["TCP"]["Address"]
+    for _ in range(20):
+        try:
+            with socket.create_connection((address, port), timeout=0.1):
+                return server
+        except OSError:
+            time.sleep(0.1)
+    server.stop()
+    raise RuntimeError(f"Simulator did not start on {address}:{port}")
+
+
+def bench_device(path_to_file, iterations):
+    interface = ModbusInterface(path_to_file, logger=logging.getLogger("bench"))
+    results = {}
+    try:
+        results["read_modbus"] = measure(lambda: interface.read_modbus("LFRD"), iterations)
+        results["write_modbus"] = measure(
+            lambda: interface.write_modbus("LFRD", [100]), iterations
+        )
+        plan = interface.compile_read_plan(["CMD", "LFRD", "RFRD"])
+        results["read_plan"] = measure(lambda: interface.read_plan(plan), iterations)
+
+        read_spec = interface.read_commands["LFRD"]
+        write_spec = interface.write_commands["LFRD"]
+        results["scale_response"] = measure(
+            lambda: interface.scale_spec_response([100], read_spec), iterations * 10
+        )
+        results["encode_write_values"] = measure(
+            lambda: interface.encode_write_values(write_spec, [100]), iterations * 10
+        )
+    finally:
+        interface.close()
+    return results
+
+
+def bench_config(path_to_file, iterations):
+    device_config = load_config_file(path_to_file)
+    source = pathlib.Path(path_to_file).read_bytes()
+    with tempfile.TemporaryDirectory() as directory:
+        config_cache = ConfigCache(directory)
+        config_cache.store(path_to_file, source, device_config, compile_command_table(device_config))
+        cached = measure(lambda: config_cache.load(path_to_file, source), iterations, warmup=1)
+    return {
+        "config_cache_load": cached,
+        "load_config_file": measure(lambda: load_config_file(path_to_file), iterations, warmup=1),
+        "validate_configuration": measure(
+            lambda: validate_configuration(device_config), iterations * 10
+        ),
+        "compile_command_table": measure(
+            lambda: compile_command_table(device_config), iterations * 10
+        ),
+    }
+
+
+def compare(results, baseline):
+    """Ratio of the p50 of each benchmark to the baseline, > 1 is slower."""
+    ratios = {}
+    for group, benchmarks in results["benchmarks"].items():
+        for name, stats in benchmarks.items():
+            base = baseline["benchmarks"].get(group, {}).get(name)
+            if base and base["p50"]:
+                ratios[f"{group}.{name}"] = stats["p50"] / base["p50"]
+    return ratios
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=5020)
+    parser.add_argument("--config", default=str(CONFIG_DIR / "GEN1-Banshee.yaml"),
+                        help="device configuration used for the config benchmarks")
+    parser.add_argument("--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--baseline", help="results of a previous run to compare against")
+    args = parser.parse_args(argv)
+
+    device_config = load_config_file(SIM_DIR / "registers.yaml")
+    device_config["TCP"]["Port"] = args.port
+
+    server = start_simulator(args.port)
+    try:
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as file:
+            yaml.safe_dump(device_config, file)
+        device_results = bench_device(file.name, args.iterations)
+        device_config["TCP"]["Lean_Transport"] = True
+        pathlib.Path(file.name).write_text(yaml.safe_dump(device_config))
+        lean_results = bench_device(file.name, args.iterations)
+    finally:
+        pathlib.Path(file.name).unlink(missing_ok=True)
+        server.stop()
+
+    results = {
+        "timestamp": dt.datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "versions": {
+            package: metadata.version(package)
+            for package in ("riaps-interfaces-modbus", "modbus_tk")
+            if _installed(package)
+        },
+        "iterations": args.iterations,
+        "units": "us",
+        "benchmarks": {
+            "device": device_results,
+            "device_lean_tcp": lean_results,
+            "config": bench_config(args.config, max(1, args.iterations // 10)),
+        },
+    }
+    if args.baseline:
+        with open(args.baseline) as file:
+            results["baseline_ratio_p50"] = compare(results, json.load(file))
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+def _installed(package):
+    try:
+        metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    main()
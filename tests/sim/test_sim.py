@@ -1,9 +1,20 @@
+import asyncio
 import pathlib
 import pytest
 import socket
 import time
+import yaml
+from modbus_tk import exceptions as modbus_exceptions
+from riaps.interfaces.modbus.async_simulator import AsyncSimulator, SimulatedDevice
+from riaps.interfaces.modbus.commands import CommandSpec
+from riaps.interfaces.modbus.connection_pool import PooledMaster
+from riaps.interfaces.modbus.ModbusSystemSettings import ModbusSystem
+import riaps.interfaces.modbus.AsyncModbusInterface as AsyncModbusInterface
+import riaps.interfaces.modbus.ModbusIOLoop as ModbusIOLoop
 import riaps.interfaces.modbus.ModbusInterface as ModbusInterface
 import riaps.interfaces.modbus.slave as slave
+import riaps.interfaces.modbus.startup as startup
+import riaps.interfaces.modbus.traffic as traffic
 
 
 @pytest.fixture(scope="session")
@@ -57,6 +68,422 @@ def test_sim(device_sim, modbus_interface):
         print(f"param: {param} value: {result['values']}")
 
 
+def test_read_plan(device_sim, modbus_interface):
+    params = ["CMD", "LFRD", "RFRD"]
+    plan = modbus_interface.compile_read_plan(params, max_gap=2)
+    assert plan.transactions == 2
+    results = modbus_interface.read_plan(plan)
+    for param, result in zip(params, results):
+        assert result == modbus_interface.read_modbus(parameter=param)
+
+
+def test_rejected_block_is_split(device_sim, modbus_interface, monkeypatch):
+    execute = modbus_interface.master.execute
+    block_reads = []
+
+    def reject_blocks(slave_id, function_code, starting_address, quantity_of_x=0, **kwargs):
+        if quantity_of_x > 1:
+            block_reads.append(starting_address)
+            raise modbus_exceptions.ModbusError(2)
+        return execute(slave_id, function_code, starting_address, quantity_of_x=quantity_of_x, **kwargs)
+
+    monkeypatch.setattr(modbus_interface.master, "execute", reject_blocks)
+    params = ["CMD", "LFRD", "RFRD"]
+    plan = modbus_interface.compile_read_plan(params, max_gap=2)
+    for _ in range(3):
+        results = modbus_interface.read_plan(plan)
+        assert all("errors" not in result for result in results)
+    assert block_reads == [8602]
+    assert [block.start for block in plan.blocks] == [8501]
+    assert plan.singles == [(1, "LFRD"), (2, "RFRD")]
+
+
+def test_register_cache(device_sim, modbus_interface):
+    modbus_interface.write_modbus(parameter="LFRD", values=[-5])
+    # answered from the value just written
+    assert modbus_interface.read_modbus(parameter="LFRD", max_age=10)["values"] == [-5]
+    assert modbus_interface.register_cache.hits == 1
+    device_sim.slaves[1].set_values("hr0-10000", 8602, [7])
+    assert modbus_interface.read_modbus(parameter="LFRD", max_age=10)["values"] == [-5]
+    assert modbus_interface.read_modbus(parameter="LFRD")["values"] == [7]
+    assert modbus_interface.read_modbus(parameter="LFRD", max_age=10)["values"] == [7]
+
+
+def test_write_bits(device_sim, modbus_interface):
+    modbus_interface.write_modbus(parameter="CMD", values=[0x0F00])
+    results = modbus_interface.write_bits({"RUN": 1, "FAULT_RESET": 1})
+    assert [result["values"] for result in results] == [[1], [1]]
+    assert modbus_interface.read_modbus(parameter="CMD")["values"] == [0x0F82]
+    # one read and one write for both bits
+    assert modbus_interface.get_metrics()["commands"]["RUN_WRITE"]["successes"] == 2
+
+    modbus_interface.mask_write = True
+    modbus_interface.write_bits({"RUN": 0, "FAULT_RESET": 1})
+    assert modbus_interface.read_modbus(parameter="CMD")["values"] == [0x0F80]
+    assert modbus_interface.write_modbus(parameter="FAULT_RESET", values=[0])["values"] == [0]
+    assert modbus_interface.read_modbus(parameter="CMD")["values"] == [0x0F00]
+
+    # bit 0 is a bit too, not the whole register
+    modbus_interface.mask_write = False
+    assert modbus_interface.write_modbus(parameter="SWITCH_ON", values=[1])["values"] == [1]
+    assert modbus_interface.read_modbus(parameter="CMD")["values"] == [0x0F01]
+    assert modbus_interface.write_many([("SWITCH_ON", [0])])[0]["values"] == [0]
+    assert modbus_interface.read_modbus(parameter="CMD")["values"] == [0x0F00]
+
+
+def test_read_write_many(device_sim, modbus_interface):
+    results = modbus_interface.write_many(
+        {"SPEED_REF": [150.0], "RAMP": [3, 4], "LFRD": [12], "RUN": [1], "UNKNOWN": [1]}
+    )
+    assert results[0]["values"] == [150.0]
+    assert results[1]["values"] == [3, 4]
+    assert results[4]["errors"]
+    # SPEED_REF and RAMP are adjacent and written together
+    assert "SPEED_REF_WRITE+RAMP_WRITE" in modbus_interface.get_metrics()["commands"]
+
+    results = modbus_interface.read_many(["RAMP", "SPEED_REF", "LFRD", "UNKNOWN"])
+    assert list(results) == ["RAMP", "SPEED_REF", "LFRD", "UNKNOWN"]
+    assert results["SPEED_REF"]["values"] == [150.0]
+    assert results["RAMP"]["values"] == [3, 4]
+    assert results["LFRD"]["values"] == [12]
+    assert results["UNKNOWN"]["errors"]
+
+    # in message order, repeated parameters included
+    results = modbus_interface.write_many(
+        [("FAULT_RESET", [1]), ("FAULT_RESET", [0]), ("RAMP", [5, 6]), ("SPEED_REF", [1.0])]
+    )
+    assert [result["values"] for result in results] == [[1], [0], [5, 6], [1.0]]
+    assert modbus_interface.read_modbus(parameter="CMD")["values"][0] & 0x80 == 0
+    # RAMP comes first in the message, so it is not merged with SPEED_REF
+    assert "RAMP_WRITE" in modbus_interface.get_metrics()["commands"]
+
+
+def test_merged_write_rejects_what_a_single_write_rejects(device_sim, modbus_interface):
+    for index, parameter in enumerate(["WORD_A", "WORD_B"]):
+        modbus_interface.write_commands[parameter] = CommandSpec(
+            f"{parameter}_WRITE", parameter, {"function": "WRITE_MULTIPLE_REGISTERS", "start": 8800 + index, "length": 1}
+        )
+    results = modbus_interface.write_many([("WORD_A", [-1]), ("WORD_B", [2])])
+    assert [result["values"] for result in results] == [[-1], [2]]
+    assert device_sim.slaves[1].get_values("hr0-10000", 8800, 2) == (0xFFFF, 2)
+
+    results = modbus_interface.write_many([("WORD_A", [70000]), ("WORD_B", [3])])
+    assert results[0]["errors"]
+    assert modbus_interface.write_modbus("WORD_A", [70000])["errors"]
+    assert results[1]["values"] == [3]
+    assert device_sim.slaves[1].get_values("hr0-10000", 8800, 2) == (0xFFFF, 3)
+
+
+def test_async_read_write(device_sim, testslogger):
+    here = pathlib.Path(__file__).parent
+    path_to_file = here / "registers.yaml"
+
+    async def read_write():
+        interface = AsyncModbusInterface.AsyncModbusInterface(
+            path_to_file, logger=testslogger
+        )
+        interface.master.max_outstanding = 4
+        try:
+            result = await interface.write_modbus(parameter="LFRD", values=[-3])
+            assert result["values"] == [-3]
+            results = await asyncio.gather(
+                *(interface.read_modbus(parameter="LFRD") for _ in range(20))
+            )
+            assert all(result["values"] == [-3] for result in results)
+        finally:
+            await interface.close()
+
+    asyncio.run(read_write())
+
+
+def test_async_write_bits(device_sim, testslogger):
+    here = pathlib.Path(__file__).parent
+
+    async def write_bits():
+        interface = AsyncModbusInterface.AsyncModbusInterface(here / "registers.yaml", logger=testslogger)
+        interface.master.max_outstanding = 4
+        try:
+            await interface.write_modbus(parameter="CMD", values=[0x0F00])
+            # concurrent read-modify-writes of one register keep each other's bits
+            results = await asyncio.gather(
+                *(interface.write_modbus(parameter, [1]) for parameter in ("RUN", "FAULT_RESET", "SWITCH_ON"))
+            )
+            assert [result["values"] for result in results] == [[1], [1], [1]]
+            assert (await interface.read_modbus(parameter="CMD"))["values"] == [0x0F83]
+
+            async def reject_reads(slave, function_code, *args, **kwargs):
+                raise modbus_exceptions.ModbusError(2)
+
+            interface.master.execute = reject_reads
+            result = await interface.write_modbus(parameter="RUN", values=[0])
+            assert "values" not in result
+            assert result["errors"]
+        finally:
+            await interface.close()
+
+    asyncio.run(write_bits())
+
+
+def test_async_bad_frame_fails_pending_requests(testslogger):
+    async def bad_frame():
+        async def answer(reader, writer):
+            await reader.read(12)
+            # an MBAP length of 0
+            writer.write(bytes([0, 1, 0, 0, 0, 0, 1]))
+            await writer.drain()
+
+        server = await asyncio.start_server(answer, "127.0.0.1", 5063)
+        connection = AsyncModbusInterface.AsyncTcpConnection("127.0.0.1", 5063, timeout=5, logger=testslogger)
+        try:
+            start = time.monotonic()
+            with pytest.raises(ConnectionResetError):
+                await connection.execute(1, 3, 8602, 1)
+            assert time.monotonic() - start < 1
+            assert not connection.is_connected
+        finally:
+            await connection.close()
+            server.close()
+            await server.wait_closed()
+
+    asyncio.run(bad_frame())
+
+
+def test_async_interface_methods(device_sim, testslogger):
+    here = pathlib.Path(__file__).parent
+    interface = AsyncModbusInterface.AsyncModbusInterface(here / "registers.yaml", logger=testslogger)
+    # the blocking entry points of ModbusInterface are not inherited
+    for name in ("start", "get_health", "read_many", "write_many", "write_bits", "enable_request_queue"):
+        assert not hasattr(interface, name)
+    for name in ("is_online", "connect", "read_modbus", "read_block", "read_plan", "write_modbus",
+                 "execute_modbus_command", "execute_command_spec", "close"):
+        assert asyncio.iscoroutinefunction(getattr(interface, name)), name
+
+    async def read():
+        try:
+            plan = interface.compile_read_plan(["CMD", "LFRD", "RFRD"], max_gap=2)
+            results = await interface.read_plan(plan)
+            assert all("errors" not in result for result in results)
+        finally:
+            await interface.close()
+
+    asyncio.run(read())
+    metrics = interface.get_metrics()
+    assert metrics["commands"]
+    assert metrics["timeout"]["samples"] == 2
+
+
+class EventPort:
+    """Stands in for a riaps inside port, the plug records what is sent on it."""
+
+    def __init__(self):
+        self.sent = []
+
+    def setupPlug(self, owner):
+        return self
+
+    def send_pyobj(self, msg):
+        self.sent.append(msg)
+
+
+def test_io_loop(device_sim, testslogger, tmp_path):
+    here = pathlib.Path(__file__).parent
+    device_config = yaml.safe_load((here / "registers.yaml").read_text())
+    device_config_paths = {}
+    for device_name, interval in (("fast", 0.05), ("slow", 0.2)):
+        device_config.update(Name=device_name, poll={"CMD": {"interval": interval}})
+        device_config_paths[device_name] = tmp_path / f"{device_name}.yaml"
+        device_config_paths[device_name].write_text(yaml.safe_dump(device_config))
+
+    event_port = EventPort()
+    io_loop = ModbusIOLoop.ModbusIOLoop(
+        device_config_paths, logger=testslogger, event_port=event_port
+    )
+    io_loop.start()
+    time.sleep(0.5)
+    response = io_loop.handle_command(
+        {"to_device": "slow", "operation": "READ", "parameters": ["CMD"],
+         "values": [None], "msgcounter": 1}
+    )
+    io_loop.stop()
+    io_loop.join()
+
+    assert response["return_status"] == ["OK"]
+    polls = [msg["device_name"] for msg in event_port.sent]
+    assert polls.count("fast") > 2 * polls.count("slow") > 0
+
+
+def test_traffic_record_and_replay(device_sim, testslogger, tmp_path):
+    here = pathlib.Path(__file__).parent
+    device_config = yaml.safe_load((here / "registers.yaml").read_text())
+    device_config["Traffic_Record_File"] = str(tmp_path / "traffic.bin")
+    path_to_file = tmp_path / "device.yaml"
+    path_to_file.write_text(yaml.safe_dump(device_config))
+
+    interface = ModbusInterface.ModbusInterface(path_to_file, logger=testslogger)
+    interface.write_modbus(parameter="LFRD", values=[21])
+    assert interface.read_modbus(parameter="LFRD")["values"] == [21]
+    interface.close()
+
+    records = list(traffic.read_traffic(tmp_path / "traffic.bin"))
+    assert [record.request[0] for record in records] == [6, 3]
+    assert all(record.latency > 0 for record in records)
+
+    # the recorded value comes back when replayed
+    device_sim.slaves[1].set_values("hr0-10000", 8602, [0])
+    replay = device_sim.start_replay(tmp_path / "traffic.bin", speed=100)
+    replay.join(timeout=5)
+    assert replay.replayed == 1
+    assert device_sim.slaves[1].get_values("hr0-10000", 8602, 1) == (21,)
+    assert device_sim.server.response_delay is not None
+    device_sim.stop_replay()
+    assert device_sim.server.response_delay is None
+
+    # stopping a replay leaves a playback running
+    playback = device_sim.start_playback({"SlaveID": 1, "playback": {"LFRD": {"signal": "step", "values": [4]}}})
+    device_sim.stop_replay()
+    assert device_sim.playback is playback
+    device_sim.stop_playback()
+    assert playback._thread is None
+
+
+def test_start_interfaces(device_sim, testslogger, tmp_path, monkeypatch):
+    here = pathlib.Path(__file__).parent
+    device_config = yaml.safe_load((here / "registers.yaml").read_text())
+    device_config_paths = {"online": here / "registers.yaml"}
+    device_config.update(Name="online2")
+    device_config_paths["online2"] = tmp_path / "online2.yaml"
+    device_config_paths["online2"].write_text(yaml.safe_dump(device_config))
+    for index in range(8):
+        device_config.update(Name=f"offline{index}")
+        device_config["TCP"]["Port"] = 5100 + index
+        device_config_paths[f"offline{index}"] = tmp_path / f"offline{index}.yaml"
+        device_config_paths[f"offline{index}"].write_text(yaml.safe_dump(device_config))
+
+    is_online = ModbusInterface.ModbusInterface.is_online
+    probes = []
+
+    def slow_probe(interface, use_pool=True):
+        probes.append(interface.endpoint())
+        if interface.device_name.startswith("offline"):
+            # like a probe that runs into its 1 s connect timeout
+            time.sleep(1)
+            return {"status": False, "error": "timed out"}
+        return is_online(interface, use_pool)
+
+    monkeypatch.setattr(ModbusInterface.ModbusInterface, "is_online", slow_probe)
+    start = time.monotonic()
+    interfaces = startup.start_interfaces(device_config_paths, logger=testslogger, deadline=0.5)
+    assert time.monotonic() - start < 0.9
+    try:
+        assert interfaces["online"].started.is_set()
+        assert interfaces["online"].read_modbus(parameter="CMD")["values"] is not None
+        assert interfaces["online2"].read_modbus(parameter="CMD")["values"] is not None
+        assert not interfaces["offline0"].started.is_set()
+        # the probes ran concurrently
+        for device_name in device_config_paths:
+            assert interfaces[device_name].started.wait(timeout=1)
+        assert interfaces["offline0"].health.is_down
+        # one probe per endpoint
+        assert sorted(probes) == sorted(set(probes)) and len(probes) == 9
+    finally:
+        for interface in interfaces.values():
+            interface.close()
+
+
+def test_start_without_master(device_sim, testslogger, monkeypatch):
+    here = pathlib.Path(__file__).parent
+
+    def no_master(interface, device_config):
+        raise OSError("no connection left")
+
+    monkeypatch.setattr(ModbusInterface.ModbusInterface, "setup_master", no_master)
+    interface = ModbusInterface.ModbusInterface(here / "registers.yaml", logger=testslogger)
+    try:
+        assert interface.started.is_set()
+        assert interface.online == {"status": False, "error": "no connection left"}
+        # the health monitor sets the master up once setup_master works again
+        assert interface.health.is_down
+    finally:
+        interface.close()
+
+
+def test_gateway_keeps_healthy_slave_connected(testslogger, tmp_path, monkeypatch):
+    here = pathlib.Path(__file__).parent
+    device_config = yaml.safe_load((here / "registers.yaml").read_text())
+    device_config["TCP"]["Port"] = 5066
+    simulator = AsyncSimulator()
+    # the gateway only reaches slave 1, it answers exception 0x0B for slave 2
+    simulator.add_device("127.0.0.1", 5066, SimulatedDevice.from_config(device_config))
+    simulator.start_in_thread()
+    paths = []
+    for slave_id in (1, 2):
+        device_config.update(Name=f"slave{slave_id}", SlaveID=slave_id)
+        paths.append(tmp_path / f"slave{slave_id}.yaml")
+        paths[-1].write_text(yaml.safe_dump(device_config))
+
+    resets = []
+    reset = PooledMaster.reset
+    monkeypatch.setattr(PooledMaster, "reset", lambda master: resets.append(master) or reset(master))
+    monkeypatch.setattr(ModbusSystem.Health, "BackoffInitialSeconds", 0.2)
+    healthy, dead = (ModbusInterface.ModbusInterface(path, logger=testslogger) for path in paths)
+    try:
+        assert "errors" not in healthy.read_modbus(parameter="CMD")
+        # the startup probes and the shared socket
+        connections = simulator.connections
+        deadline = time.monotonic() + 2
+        while time.monotonic() < deadline:
+            assert "errors" not in healthy.read_modbus(parameter="CMD")
+            assert dead.read_modbus(parameter="CMD")["errors"]
+            time.sleep(0.05)
+        assert dead.health.is_down
+        assert dead.health.reconnect_attempts >= 2
+        assert dead.health.backoff > 0.2
+        # the socket both slaves share was never dropped
+        assert resets == []
+        assert simulator.connections == connections
+
+        # a connection that failed is reopened by the next probe
+        healthy._record_failure(ConnectionResetError())
+        assert healthy.probe()["status"] is True
+        assert resets == [healthy.master]
+    finally:
+        healthy.close()
+        dead.close()
+        simulator.stop()
+
+
+def test_adaptive_timeout(device_sim, testslogger, tmp_path):
+    here = pathlib.Path(__file__).parent
+    device_config = yaml.safe_load((here / "registers.yaml").read_text())
+    device_config.update(Timeout_Floor_Milliseconds=100)
+    # its own socket, the late response must not reach other interfaces
+    device_config["TCP"]["Shared"] = False
+    path_to_file = tmp_path / "device.yaml"
+    path_to_file.write_text(yaml.safe_dump(device_config))
+
+    interface = ModbusInterface.ModbusInterface(path_to_file, logger=testslogger)
+    try:
+        assert interface.master.get_timeout() == 2.0
+        for _ in range(20):
+            assert "errors" not in interface.read_modbus(parameter="LFRD")
+        assert interface.get_metrics()["timeout"]["timeout"] == 100
+        # a gateway's answer for an unreachable slave is no round trip of the device
+        interface._record_round_trip(time.perf_counter() - 1.0, modbus_exceptions.ModbusError(11))
+        assert interface.get_metrics()["timeout"]["samples"] == 20
+
+        device_sim.server.response_delay = lambda request: 0.5
+        start = time.monotonic()
+        assert "errors" in interface.read_modbus(parameter="LFRD")
+        assert time.monotonic() - start < 0.4
+        assert interface.master.get_timeout() == 0.1
+        metrics = interface.get_metrics()["timeout"]
+        assert metrics["timeouts"] == 1
+        assert metrics["timeout"] == 200
+    finally:
+        device_sim.server.response_delay = None
+        interface.close()
+
+
 # def test_read_write(modbus_interface):
 #     print("test_read_write")
 #     # Read current value
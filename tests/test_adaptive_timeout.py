@@ -0,0 +1,56 @@
+import socket
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+import pytest
+import serial
+
+from riaps.interfaces.modbus.adaptive_timeout import AdaptiveTimeout, ResponseTimeout, is_timeout
+from riaps.interfaces.modbus.connection_pool import RtuMaster
+
+
+def test_estimate_and_backoff():
+    timeout = AdaptiveTimeout(floor=0.05, ceiling=2.0)
+    assert timeout.timeout == 2.0
+
+    # first sample: smoothed 0.1, deviation 0.05
+    timeout.observe(0.1)
+    assert timeout.timeout == pytest.approx(0.3)
+    for _ in range(50):
+        timeout.observe(0.1)
+    # the deviation decays, the floor holds the timeout up
+    assert timeout.timeout == pytest.approx(0.1, abs=0.01)
+    timeout.observe(0.001)
+    assert timeout.timeout > 0.1
+
+    timeout = AdaptiveTimeout(floor=0.05, ceiling=1.0)
+    for _ in range(50):
+        timeout.observe(0.001)
+    assert timeout.timeout == 0.05
+    timeout.backoff()
+    timeout.backoff()
+    assert timeout.timeout == pytest.approx(0.2)
+    for _ in range(5):
+        timeout.backoff()
+    assert timeout.timeout == 1.0
+    timeout.observe(0.001)
+    assert timeout.timeout == 0.05
+    assert timeout.as_dict()["timeouts"] == 7
+    assert timeout.as_dict()["timeout"] == pytest.approx(50)
+
+
+def test_is_timeout():
+    assert is_timeout(socket.timeout())
+    assert is_timeout(ResponseTimeout("No response"))
+    assert not is_timeout(modbus_exceptions.ModbusInvalidResponseError("Invalid CRC in response"))
+    assert not is_timeout(ConnectionResetError())
+
+
+def test_rtu_master_timeout():
+    port = serial.serial_for_url("loop://", baudrate=19200)
+    # a slave that never answers
+    port.write = lambda data: len(data)
+    master = RtuMaster(port)
+    master.set_timeout(0.01)
+    with pytest.raises(ResponseTimeout):
+        master.execute(1, cst.READ_HOLDING_REGISTERS, 0, 1)
@@ -0,0 +1,97 @@
+import asyncio
+import gc
+import logging
+import pathlib
+
+import modbus_tk.defines as cst
+from modbus_tk import modbus_tcp
+import pytest
+import yaml
+
+from riaps.interfaces.modbus.async_simulator import AsyncSimulator, SimulatedDevice
+
+REGISTERS = pathlib.Path(__file__).parent / "sim" / "registers.yaml"
+
+
+def test_simulated_device():
+    device = SimulatedDevice.from_config(yaml.safe_load(REGISTERS.read_text()))
+    assert device.handle(bytes([cst.WRITE_SINGLE_REGISTER, 0x21, 0x35, 0x0F, 0x00])) == bytes(
+        [cst.WRITE_SINGLE_REGISTER, 0x21, 0x35, 0x0F, 0x00]
+    )
+    assert device.get_values("holding_registers", 8501, 1) == [0x0F00]
+    # FC22 sets bit 1
+    device.handle(bytes([cst.MASK_WRITE_REGISTER, 0x21, 0x35, 0xFF, 0xFD, 0x00, 0x02]))
+    assert device.get_values("holding_registers", 8501, 1) == [0x0F02]
+    # beyond the configured registers, unsupported function
+    assert device.handle(bytes([cst.READ_HOLDING_REGISTERS, 0xFF, 0x00, 0x00, 0x01])) == bytes([0x83, 2])
+    assert device.handle(bytes([cst.READ_EXCEPTION_STATUS])) == bytes([0x87, 1])
+
+
+def test_serve_config_directory(tmp_path):
+    device_config = yaml.safe_load(REGISTERS.read_text())
+    for slave_id in range(1, 41):
+        device_config.update(Name=f"drive{slave_id}", SlaveID=slave_id)
+        device_config["TCP"]["Port"] = 5040 + slave_id % 2
+        (tmp_path / f"drive{slave_id}.yaml").write_text(yaml.safe_dump(device_config))
+    (tmp_path / "devices.yaml").write_text(yaml.safe_dump({"names": ["drive1"]}))
+
+    simulator = AsyncSimulator.from_config_directory(tmp_path, address="127.0.0.1")
+    simulator.start_in_thread()
+    try:
+        masters = [modbus_tcp.TcpMaster("127.0.0.1", port) for port in (5040, 5041)]
+        for slave_id in range(1, 41):
+            master = masters[slave_id % 2]
+            master.execute(slave_id, cst.WRITE_SINGLE_REGISTER, 8602, output_value=slave_id)
+            assert master.execute(slave_id, cst.READ_HOLDING_REGISTERS, 8602, 1) == (slave_id,)
+        for master in masters:
+            master.close()
+        stats = simulator.get_stats()
+    finally:
+        simulator.stop()
+    assert stats["devices"] == 40
+    assert stats["endpoints"] == 2
+    assert stats["requests"] == 80
+    assert stats["latency"]["count"] == 80
+
+
+def test_start_in_thread_raises_start_errors():
+    device = SimulatedDevice.from_config(yaml.safe_load(REGISTERS.read_text()))
+    simulator = AsyncSimulator()
+    simulator.add_device("127.0.0.1", 5062, device)
+    simulator.start_in_thread()
+    try:
+        # the port is taken
+        other = AsyncSimulator()
+        other.add_device("127.0.0.1", 5062, device)
+        with pytest.raises(OSError):
+            other.start_in_thread()
+        assert not other._thread.is_alive()
+    finally:
+        simulator.stop()
+
+    async def never_listens():
+        await asyncio.sleep(60)
+
+    simulator = AsyncSimulator()
+    simulator.start = never_listens
+    with pytest.raises(TimeoutError):
+        simulator.start_in_thread(timeout=0.2)
+    assert not simulator._thread.is_alive()
+
+
+def test_stop_closes_open_connections(caplog):
+    simulator = AsyncSimulator()
+    simulator.add_device("127.0.0.1", 5064, SimulatedDevice.from_config(yaml.safe_load(REGISTERS.read_text())))
+    simulator.start_in_thread()
+    masters = [modbus_tcp.TcpMaster("127.0.0.1", 5064) for _ in range(3)]
+    try:
+        for master in masters:
+            master.execute(1, cst.READ_HOLDING_REGISTERS, 8602, 1)
+        with caplog.at_level(logging.ERROR, logger="asyncio"):
+            simulator.stop()
+            gc.collect()
+        assert simulator.open_connections == 0
+        assert not caplog.records
+    finally:
+        for master in masters:
+            master.close()
@@ -0,0 +1,19 @@
+import importlib.util
+import pathlib
+
+BENCH = pathlib.Path(__file__).parent / "bench" / "bench_interface.py"
+REGISTERS = pathlib.Path(__file__).parent / "sim" / "registers.yaml"
+
+
+def load_bench():
+    spec = importlib.util.spec_from_file_location("bench_interface", BENCH)
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench
+
+
+def test_bench_config_runs():
+    results = load_bench().bench_config(REGISTERS, 2)
+    assert set(results) == {
+        "config_cache_load", "load_config_file", "validate_configuration", "compile_command_table",
+    }
@@ -0,0 +1,50 @@
+import pathlib
+import struct
+
+import modbus_tk.defines as cst
+import pytest
+
+from riaps.interfaces.modbus.commands import compile_command_table
+from riaps.interfaces.modbus.config import load_config_file
+
+here = pathlib.Path(__file__).parent
+
+
+@pytest.fixture(scope="module")
+def commands():
+    return compile_command_table(load_config_file(here / "sim" / "registers.yaml"))
+
+
+def test_command_table(commands):
+    assert set(commands.reads) == {"CMD", "LFRD", "RFRD", "SPEED_REF", "RAMP"}
+    assert set(commands.writes) == {"CMD", "LFRD", "RUN", "SWITCH_ON", "FAULT_RESET", "SPEED_REF", "RAMP"}
+    spec = commands["LFRD_READ"]
+    assert spec is commands.reads["LFRD"]
+    assert spec.function_code == cst.READ_HOLDING_REGISTERS
+    assert (spec.start, spec.length) == (8602, 1)
+    assert commands.writes["LFRD"].function_code == cst.WRITE_SINGLE_REGISTER
+
+
+def test_decode(commands):
+    assert commands.reads["CMD"].decode([65535]) == [65535]
+    assert commands.reads["LFRD"].decode([65535]) == [-1]
+
+
+def test_encode(commands):
+    assert commands.reads["LFRD"].encode([-1]) == [65535]
+    assert commands.writes["LFRD"].encode([-1]) == [65535]
+    assert commands.writes["CMD"].encode([-32768, 65535]) == [0x8000, 0xFFFF]
+
+
+@pytest.mark.parametrize("value", [70000, -32769, 1.5])
+def test_encode_rejects_what_modbus_tk_rejects(commands, value):
+    # modbus_tk packs a register without data_format as >H, or >h when negative
+    with pytest.raises(struct.error):
+        commands.writes["CMD"].encode([value])
+
+
+def test_invalid_function():
+    with pytest.raises(AttributeError):
+        compile_command_table(
+            {"X_READ": {"function": "NOT_A_FUNCTION", "start": 0, "length": 1}}
+        )
@@ -0,0 +1,64 @@
+import pathlib
+import pickle
+
+from riaps.interfaces.modbus import config_cache as config_cache_module
+from riaps.interfaces.modbus.commands import compile_command_table
+from riaps.interfaces.modbus.config import parse_config
+from riaps.interfaces.modbus.config_cache import ConfigCache, cache_key
+
+REGISTERS = pathlib.Path(__file__).parent / "sim" / "registers.yaml"
+
+
+def test_compiled_config_round_trip(tmp_path):
+    source = REGISTERS.read_bytes()
+    config_cache = ConfigCache(tmp_path / "cache")
+    assert config_cache.load(REGISTERS, source) is None
+
+    device_config = parse_config(source)
+    commands = compile_command_table(device_config)
+    config_cache.store(REGISTERS, source, device_config, commands)
+    cached_config, cached_commands = config_cache.load(REGISTERS, source)
+    assert cached_config == device_config
+    spec = cached_commands.reads["SPEED_REF"]
+    assert spec.decode(spec.encode([-1500])) == [-1500]
+    # parameters share their spec with the command table
+    assert cached_commands["SPEED_REF_READ"] is spec
+
+    # any change to the file is a miss
+    assert config_cache.load(REGISTERS, source + b"\n") is None
+    assert cache_key(source) != cache_key(source + b"\n")
+
+
+def test_schema_change_is_a_miss(tmp_path, monkeypatch):
+    source = REGISTERS.read_bytes()
+    config_cache = ConfigCache(tmp_path / "cache")
+    config_cache.store(REGISTERS, source, {}, None)
+    assert config_cache.load(REGISTERS, source) == ({}, None)
+    monkeypatch.setattr(config_cache_module, "schema_digest", lambda: "changed")
+    assert config_cache.load(REGISTERS, source) is None
+
+
+def test_store_replaces_older_entries_of_the_file(tmp_path):
+    source = REGISTERS.read_bytes()
+    other = tmp_path / "other.yaml"
+    config_cache = ConfigCache(tmp_path / "cache")
+    config_cache.store(REGISTERS, source, {"version": 1}, None)
+    config_cache.store(other, source, {"other": 1}, None)
+    config_cache.store(REGISTERS, source + b"\n", {"version": 2}, None)
+    assert len(list((tmp_path / "cache").iterdir())) == 2
+    assert config_cache.load(REGISTERS, source) is None
+    assert config_cache.load(REGISTERS, source + b"\n") == ({"version": 2}, None)
+    assert config_cache.load(other, source) == ({"other": 1}, None)
+
+
+def test_unreadable_or_shared_cache_is_ignored(tmp_path):
+    source = REGISTERS.read_bytes()
+    config_cache = ConfigCache(tmp_path / "cache")
+    config_cache.store(REGISTERS, source, {}, None)
+    config_cache.path(REGISTERS, cache_key(source)).write_bytes(b"torn")
+    assert config_cache.load(REGISTERS, source) is None
+
+    config_cache.path(REGISTERS, cache_key(source)).write_bytes(pickle.dumps({"device_config": {}, "commands": None}))
+    assert config_cache.load(REGISTERS, source) == ({}, None)
+    (tmp_path / "cache").chmod(0o777)
+    assert config_cache.load(REGISTERS, source) is None
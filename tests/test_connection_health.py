@@ -0,0 +1,78 @@
+import time
+
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus.connection_health import ConnectionHealth, ConnectionState
+
+
+def test_state_transitions():
+    health = ConnectionHealth(
+        "device", probe=lambda: {"status": False, "error": "offline"}, failure_threshold=2
+    )
+    try:
+        health.record_failure(ConnectionResetError())
+        assert health.state == ConnectionState.DEGRADED
+        health.record_success()
+        assert health.state == ConnectionState.CONNECTED
+
+        # an exception response means the device is there
+        health.record_failure(modbus_exceptions.ModbusError(2))
+        assert health.state == ConnectionState.CONNECTED
+        # but not a gateway answering for a slave that does not respond
+        health.record_failure(modbus_exceptions.ModbusError(11))
+        assert health.state == ConnectionState.DEGRADED
+        health.record_success()
+
+        health.record_failure(ConnectionResetError())
+        health.record_failure(ConnectionResetError())
+        assert health.state == ConnectionState.DOWN
+        assert not health.allow_request()
+        assert "device is down" in health.down_error()
+    finally:
+        health.stop()
+
+
+def test_background_reconnect():
+    online = {"status": False, "error": "offline"}
+    reconnected = []
+    health = ConnectionHealth(
+        "device",
+        probe=lambda: online,
+        on_reconnect=lambda: reconnected.append(True),
+        backoff_initial=0.01,
+        backoff_max=0.02,
+    )
+    try:
+        health.mark_down("offline")
+        time.sleep(0.1)
+        assert health.state == ConnectionState.DOWN
+        assert health.reconnect_attempts > 1
+        online = {"status": True, "error": None}
+        deadline = time.monotonic() + 2
+        while health.state != ConnectionState.CONNECTED and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert health.state == ConnectionState.CONNECTED
+        assert reconnected == [True]
+    finally:
+        health.stop()
+
+
+def test_backoff_grows_until_a_request_succeeds():
+    health = ConnectionHealth(
+        "device",
+        probe=lambda: {"status": True, "error": None},
+        backoff_initial=0.01,
+        backoff_max=1.0,
+    )
+    try:
+        for backoff in (0.02, 0.04):
+            # the probe passes, the next request fails again
+            health.mark_down("no answer")
+            deadline = time.monotonic() + 2
+            while health.state != ConnectionState.CONNECTED and time.monotonic() < deadline:
+                time.sleep(0.005)
+            assert health.backoff == backoff
+        health.record_success()
+        assert health.backoff == 0.01
+    finally:
+        health.stop()
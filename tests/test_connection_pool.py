@@ -0,0 +1,121 @@
+import threading
+import time
+
+import pytest
+
+from riaps.interfaces.modbus.connection_pool import (
+    ConnectionPool,
+    FairLock,
+    Priority,
+    SharedConnection,
+    request_priority,
+)
+
+
+def test_fair_lock_round_robin():
+    lock = FairLock()
+    order = []
+
+    def worker(key):
+        lock.acquire(key)
+        order.append(key)
+        lock.release()
+
+    lock.acquire("holder")
+    threads = []
+    for key in ["A", "A", "A", "B", "C"]:
+        thread = threading.Thread(target=worker, args=(key,))
+        thread.start()
+        threads.append(thread)
+        while lock.waiting < len(threads):
+            time.sleep(0.001)
+    lock.release()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ["A", "B", "C", "A", "A"]
+
+
+def test_fair_lock_priority():
+    lock = FairLock()
+    order = []
+
+    def worker(key, priority):
+        lock.acquire(key, priority)
+        order.append(key)
+        lock.release()
+
+    lock.acquire("holder")
+    threads = []
+    for key, priority in [("poll1", Priority.POLL), ("poll2", Priority.POLL),
+                          ("command", Priority.COMMAND)]:
+        thread = threading.Thread(target=worker, args=(key, priority))
+        thread.start()
+        threads.append(thread)
+        while lock.waiting < len(threads):
+            time.sleep(0.001)
+    lock.release()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ["command", "poll1", "poll2"]
+
+
+class FakeMaster:
+    _is_opened = True
+
+    def __init__(self):
+        self.frames = []
+
+    def get_timeout(self):
+        return 1.0
+
+    def execute(self, slave, function_code, *args, **kwargs):
+        self.frames.append((time.perf_counter(), slave))
+        return (0,)
+
+
+def test_shared_bus_frame_gap():
+    master = FakeMaster()
+    bus = SharedConnection("/dev/ttyS1", master, frame_gap=0.005)
+    for slave in (1, 2, 3):
+        with request_priority(Priority.COMMAND):
+            bus.execute(slave, 3, 0, 1)
+    starts = [start for start, _ in master.frames]
+    assert all(b - a >= 0.005 for a, b in zip(starts, starts[1:]))
+    assert bus.get_stats()["endpoint"] == "/dev/ttyS1"
+
+
+def test_pool_shares_serial_bus():
+    pool = ConnectionPool()
+    comm_config = {"device": "loop://", "baudrate": 9600, "bytesize": 8, "parity": "N",
+                   "stopbits": 1, "xonxoff": False}
+    first = pool.acquire_rtu(comm_config)
+    second = pool.acquire_rtu(dict(comm_config))
+    assert first.connection is second.connection
+    # 3.5 characters of 11 bits at 9600 baud
+    assert first.connection.frame_gap == pytest.approx(3.5 * 11 / 9600)
+    with pytest.raises(ValueError):
+        pool.acquire_rtu(dict(comm_config, baudrate=19200))
+    first.close()
+    second.close()
+    assert pool.get_stats()["connections"] == 0
+
+
+def test_pool_shares_endpoint():
+    pool = ConnectionPool()
+    first = pool.acquire_tcp("127.0.0.1", 15020)
+    second = pool.acquire_tcp("127.0.0.1", 15020)
+    other = pool.acquire_tcp("127.0.0.1", 15021)
+    assert first.connection is second.connection
+    assert first.connection is not other.connection
+    assert pool.get_stats()["connections"] == 2
+
+    first.close()
+    first.close()
+    assert pool.get_stats()["connections"] == 2
+    second.close()
+    other.close()
+    stats = pool.get_stats()
+    assert stats["connections"] == 0
+    assert stats["connections_closed"] == 2
@@ -0,0 +1,54 @@
+from riaps.interfaces.modbus.deadband import DeadbandFilter, load_deadband_filters
+
+
+def result(*values):
+    return {"command": "X_READ", "values": list(values)}
+
+
+def test_absolute_deadband():
+    deadband_filter = DeadbandFilter(deadband=0.5)
+    assert deadband_filter.should_report(result(60.0), now=0)
+    assert not deadband_filter.should_report(result(60.4), now=1)
+    # measured against the last reported value, not the last polled one
+    assert deadband_filter.should_report(result(60.6), now=2)
+    assert deadband_filter.suppressed == 1
+
+
+def test_percent_deadband():
+    deadband_filter = DeadbandFilter(deadband_percent=10)
+    assert deadband_filter.should_report(result(100), now=0)
+    assert not deadband_filter.should_report(result(109), now=1)
+    assert deadband_filter.should_report(result(89), now=2)
+
+
+def test_on_change_and_integrity():
+    deadband_filter = DeadbandFilter(on_change=True, integrity_period=10)
+    assert deadband_filter.should_report(result(5), now=0)
+    assert not deadband_filter.should_report(result(5), now=5)
+    assert deadband_filter.should_report(result(5), now=10)
+    assert deadband_filter.should_report(result(4), now=11)
+
+
+def test_errors_and_range():
+    deadband_filter = DeadbandFilter(minimum=1.0, maximum=2.0)
+    assert deadband_filter.should_report(result(1.5), now=0)
+    assert not deadband_filter.should_report(result(1.7), now=1)
+    assert deadband_filter.should_report(result(2.5), now=2)
+    assert deadband_filter.should_report(result(2.6), now=3)
+    # back in range
+    assert deadband_filter.should_report(result(1.9), now=4)
+    assert not deadband_filter.should_report(result(1.8), now=5)
+    assert deadband_filter.should_report({"command": "X_READ", "errors": "timeout"}, now=6)
+    assert deadband_filter.should_report(result(1.8), now=7)
+
+
+def test_load_deadband_filters():
+    assert load_deadband_filters({"poll": ["A"]}) == {}
+    filters = load_deadband_filters(
+        {
+            "Poll_Integrity_Seconds": 30,
+            "poll": {"A": None, "B": {"interval": 1}, "C": {"deadband": 0.1}},
+        }
+    )
+    assert list(filters) == ["C"]
+    assert filters["C"].integrity_period == 30
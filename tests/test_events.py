@@ -0,0 +1,22 @@
+import pickle
+
+from riaps.interfaces.modbus.events import PollBatch, unbatch
+
+
+def test_poll_batch_round_trip():
+    results = [
+        {"device_name": "dev", "command": "FREQ_READ", "values": [60.01], "units": "Hz"},
+        {"device_name": "dev", "command": "P_READ", "values": None, "units": None,
+         "errors": "TimeoutError()"},
+    ]
+    batch = PollBatch("dev")
+    for parameter, modbus_result in zip(["FREQ", "P"], results):
+        batch.add(parameter, modbus_result)
+
+    message = batch.as_message()
+    assert len(batch) == 2
+    assert message["parameters"] == ["FREQ", "P"]
+    assert message["return_status"] == ["OK", "TimeoutError()"]
+    assert list(unbatch(message)) == results
+    # one message instead of one per parameter
+    assert len(pickle.dumps(message)) < sum(len(pickle.dumps(r)) for r in results) * 1.5
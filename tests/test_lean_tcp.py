@@ -0,0 +1,64 @@
+import pathlib
+
+import modbus_tk.defines as cst
+from modbus_tk import exceptions as modbus_exceptions
+from modbus_tk import modbus_tcp
+import pytest
+import yaml
+
+from riaps.interfaces.modbus.async_simulator import AsyncSimulator, SimulatedDevice
+from riaps.interfaces.modbus.lean_tcp import LeanTcpMaster
+
+REGISTERS = pathlib.Path(__file__).parent / "sim" / "registers.yaml"
+PORT = 5061
+
+
+@pytest.fixture
+def simulator():
+    simulator = AsyncSimulator()
+    simulator.add_device("127.0.0.1", PORT, SimulatedDevice.from_config(yaml.safe_load(REGISTERS.read_text())))
+    simulator.start_in_thread()
+    yield simulator
+    simulator.stop()
+
+
+def test_same_results_as_modbus_tk(simulator):
+    lean = LeanTcpMaster("127.0.0.1", PORT)
+    reference = modbus_tcp.TcpMaster("127.0.0.1", PORT)
+    requests = [
+        (cst.WRITE_SINGLE_REGISTER, 8602, 0, -3),
+        (cst.READ_HOLDING_REGISTERS, 8602, 1),
+        (cst.WRITE_MULTIPLE_REGISTERS, 8600, 0, [1, -2, 3]),
+        (cst.READ_HOLDING_REGISTERS, 8600, 3),
+        (cst.READ_HOLDING_REGISTERS, 8600, 2, 0, ">i"),
+        (cst.WRITE_MULTIPLE_REGISTERS, 8600, 0, [1.5], ">f"),
+        (cst.READ_HOLDING_REGISTERS, 8600, 2, 0, ">f"),
+        (cst.READ_WRITE_MULTIPLE_REGISTERS, 8600, 2, [7, 8], "", -1, 8601),
+    ]
+    try:
+        for request in requests:
+            assert lean.execute(1, *request) == reference.execute(1, *request)
+        # not one of the preallocated frames
+        assert lean.execute(1, cst.MASK_WRITE_REGISTER, 8601, and_mask=0xFFFD, or_mask=2) == reference.execute(
+            1, cst.MASK_WRITE_REGISTER, 8601, and_mask=0xFFFD, or_mask=2
+        )
+        with pytest.raises(modbus_exceptions.ModbusError) as error:
+            lean.execute(1, cst.READ_HOLDING_REGISTERS, 0xFF00, 1)
+        assert error.value.get_exception_code() == 2
+        assert lean._is_opened
+    finally:
+        lean.close()
+        reference.close()
+    assert not lean._is_opened
+
+
+def test_skips_late_responses(simulator):
+    lean = LeanTcpMaster("127.0.0.1", PORT)
+    try:
+        lean.execute(1, cst.WRITE_SINGLE_REGISTER, 8602, output_value=5)
+        # a response the master stopped waiting for is still in the socket
+        lean._sock.sendall(bytes([0, 99, 0, 0, 0, 6, 1, 3, 0x21, 0x9A, 0, 1]))
+        lean._transaction_id = 99
+        assert lean.execute(1, cst.READ_HOLDING_REGISTERS, 8602, 1) == (5,)
+    finally:
+        lean.close()
@@ -0,0 +1,50 @@
+import socket
+
+from modbus_tk import exceptions as modbus_exceptions
+import modbus_tk.defines as cst
+
+from riaps.interfaces.modbus.adaptive_timeout import ResponseTimeout
+from riaps.interfaces.modbus.metrics import DeviceMetrics, LatencyHistogram, frame_sizes
+
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram(significant_bits=4)
+    for microseconds in range(1, 1001):
+        histogram.record(microseconds / 1e6)
+    stats = histogram.as_dict()
+    assert stats["count"] == 1000
+    assert stats["min_us"] == 1 and stats["max_us"] == 1000
+    # buckets keep 4 significant bits, an error below 1/8
+    assert abs(stats["p50_us"] - 500) <= 500 / 8
+    assert abs(stats["p99_us"] - 990) <= 990 / 8
+    assert len(histogram.counts) < 100
+
+
+def test_frame_sizes():
+    # read 10 holding registers over TCP: 7 byte MBAP + 5 byte request, 2 + 20 byte response
+    assert frame_sizes(cst.READ_HOLDING_REGISTERS, 10) == (12, 29)
+    assert frame_sizes(cst.READ_COILS, 10, "RTU") == (8, 7)
+    assert frame_sizes(cst.WRITE_MULTIPLE_REGISTERS, 2, "RTU") == (13, 8)
+
+
+def test_device_metrics_counters():
+    metrics = DeviceMetrics("dev")
+    metrics.record("A_READ", cst.READ_HOLDING_REGISTERS, 1, 0.001)
+    metrics.record("A_READ", cst.READ_HOLDING_REGISTERS, 1, 0.002,
+                   modbus_exceptions.ModbusError(2))
+    metrics.record("B_READ", cst.READ_HOLDING_REGISTERS, 1, 1.0, socket.timeout())
+    metrics.record("B_READ", cst.READ_HOLDING_REGISTERS, 1, 0.001, ConnectionResetError())
+    # a serial slave that does not answer
+    metrics.record("C_READ", cst.READ_HOLDING_REGISTERS, 1, 0.1, ResponseTimeout("No response"))
+    metrics.record_poll(1.0, 0.5)
+    metrics.record_poll(1.0, 1.5, missed=1)
+
+    stats = metrics.get_stats()
+    assert stats["device"]["successes"] == 1
+    assert stats["device"]["exception_responses"] == 1
+    assert stats["device"]["timeouts"] == 2
+    assert stats["device"]["errors"] == 1
+    assert stats["commands"]["A_READ"]["bytes_received"] == 11 + 9
+    assert stats["commands"]["B_READ"]["bytes_sent"] == 0
+    assert stats["polls"][0]["overruns"] == 1
+    assert stats["polls"][0]["duration"]["count"] == 2
@@ -0,0 +1,62 @@
+import math
+import pathlib
+
+import pytest
+import yaml
+
+from riaps.interfaces.modbus.async_simulator import SimulatedDevice
+from riaps.interfaces.modbus.playback import PlaybackEngine
+
+REGISTERS = pathlib.Path(__file__).parent / "sim" / "registers.yaml"
+
+
+def device_config(tmp_path):
+    config = yaml.safe_load(REGISTERS.read_text())
+    (tmp_path / "table.csv").write_text("t,rpm\n0,5\n1,-7\n")
+    config["playback"] = {
+        "LFRD": {"signal": "sine", "offset": 100, "amplitude": 50, "period": 4},
+        "RFRD": {"signal": "table", "file": "table.csv", "column": "rpm", "rate": 1},
+        "SPEED_REF": {"signal": "ramp", "start": -10, "stop": 10, "period": 2},
+        "CMD": {"signal": "step", "values": [1, 2, 70000], "period": 1},
+        "RAMP": {"signal": "sine"},  # two values per command, skipped
+    }
+    return config
+
+
+@pytest.mark.parametrize("use_numpy", [False, True])
+def test_tick_encodes_like_the_master_decodes(tmp_path, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    config = device_config(tmp_path)
+    device = SimulatedDevice.from_config(config)
+    engine = PlaybackEngine(use_numpy=use_numpy)
+    engine.add_device(config, device.write_registers, base_directory=tmp_path)
+    assert [channel.name for channel in engine.channels] == ["LFRD", "RFRD", "SPEED_REF", "CMD"]
+
+    engine.tick(1.0)
+    assert device.get_values("holding_registers", 8602, 1) == [150]
+    assert device.get_values("holding_registers", 8604, 1) == [(-7) & 0xFFFF]
+    # -10 + 20 * 0.5 = 0 rpm, at 0.1 rpm per count
+    assert device.get_values("holding_registers", 8700, 2) == [0, 0]
+    assert device.get_values("holding_registers", 8501, 1) == [2]
+
+    engine.tick(2.5)
+    assert device.get_values("holding_registers", 8602, 1) == [round(100 + 50 * math.sin(2 * math.pi * 2.5 / 4))]
+    # 70000 is clipped to the largest >H value
+    assert device.get_values("holding_registers", 8501, 1) == [0xFFFF]
+    # 5 rpm = 50 counts of the >i register pair
+    engine.tick(3.5)
+    assert device.get_values("holding_registers", 8700, 2) == [0, 50]
+
+
+def test_noise_is_seeded():
+    config = yaml.safe_load(REGISTERS.read_text())
+    config["playback"] = {"LFRD": {"signal": "noise", "mean": 0, "std": 100}}
+    samples = []
+    for _ in range(2):
+        written = []
+        engine = PlaybackEngine(use_numpy=False, seed=1)
+        engine.add_device(config, lambda function_code, start, registers: written.append(registers))
+        engine.tick(0.0)
+        samples.append(written)
+    assert samples[0] == samples[1]
@@ -0,0 +1,50 @@
+from riaps.interfaces.modbus.poll_scheduler import (
+    PollGroup,
+    PollScheduler,
+    load_poll_groups,
+)
+
+
+def test_load_poll_groups():
+    assert load_poll_groups({"poll": None}) == []
+
+    groups = load_poll_groups({"Poll_Interval_Seconds": 1, "poll": ["A", "B"]})
+    assert [(group.interval, group.parameters) for group in groups] == [(1, ["A", "B"])]
+
+    groups = load_poll_groups(
+        {
+            "Poll_Interval_Seconds": 10,
+            "poll": {"FREQ": {"interval": 0.1}, "STATUS": {"interval": 60}, "P": None},
+        }
+    )
+    assert [(group.interval, group.parameters) for group in groups] == [
+        (0.1, ["FREQ"]),
+        (10, ["P"]),
+        (60, ["STATUS"]),
+    ]
+
+
+def test_deadlines_do_not_drift():
+    fast = PollGroup(1.0, ["FREQ"])
+    slow = PollGroup(3.0, ["STATUS"])
+    scheduler = PollScheduler([fast, slow], clock=lambda: 0.0, start=0.0)
+
+    polled = []
+    for now in [1.2, 2.3, 3.1]:
+        for group in scheduler.pop_due(now):
+            polled.append((now, group.parameters[0]))
+            # each cycle takes 0.5 s but the next deadline stays on the 1 s grid
+            assert scheduler.reschedule(group, now + 0.5) == 0
+    assert sorted(polled) == [(1.2, "FREQ"), (2.3, "FREQ"), (3.1, "FREQ"), (3.1, "STATUS")]
+    assert fast.deadline == 4.0
+    assert slow.deadline == 6.0
+
+
+def test_overrun():
+    group = PollGroup(1.0, ["FREQ"])
+    scheduler = PollScheduler([group], clock=lambda: 0.0, start=0.0)
+    assert scheduler.pop_due(1.0) == [group]
+    assert scheduler.reschedule(group, 3.5) == 2
+    assert group.deadline == 4.0
+    assert group.overruns == 1
+    assert scheduler.pop_due(3.9) == []
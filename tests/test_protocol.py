@@ -0,0 +1,48 @@
+import struct
+
+import modbus_tk.defines as cst
+import pytest
+from modbus_tk import exceptions as modbus_exceptions
+
+from riaps.interfaces.modbus import protocol
+
+
+def test_read_registers():
+    request = protocol.build_request(cst.READ_HOLDING_REGISTERS, 8501, quantity_of_x=2)
+    assert request.pdu == struct.pack(">BHH", 3, 8501, 2)
+    response_pdu = struct.pack(">BBHH", 3, 4, 1, 65535)
+    assert protocol.parse_response(request, response_pdu) == (1, 65535)
+
+
+def test_read_registers_data_format():
+    request = protocol.build_request(
+        cst.READ_INPUT_REGISTERS, 0, quantity_of_x=1, data_format=">h"
+    )
+    assert protocol.parse_response(request, struct.pack(">BBH", 4, 2, 65535)) == (-1,)
+
+
+def test_read_coils():
+    request = protocol.build_request(cst.READ_COILS, 0, quantity_of_x=10)
+    response_pdu = struct.pack(">BBBB", 1, 2, 0b00000101, 0b00000010)
+    assert protocol.parse_response(request, response_pdu) == (
+        1, 0, 1, 0, 0, 0, 0, 0, 0, 1,
+    )
+
+
+def test_write_multiple_registers():
+    request = protocol.build_request(
+        cst.WRITE_MULTIPLE_REGISTERS, 10, output_value=[1, -1]
+    )
+    assert request.pdu == struct.pack(">BHHBHh", 16, 10, 2, 4, 1, -1)
+    assert protocol.parse_response(request, struct.pack(">BHH", 16, 10, 2)) == (10, 2)
+
+
+def test_exception_response():
+    request = protocol.build_request(cst.READ_HOLDING_REGISTERS, 0, quantity_of_x=1)
+    with pytest.raises(modbus_exceptions.ModbusError) as e_info:
+        protocol.parse_response(request, bytes([0x83, 2]))
+    assert e_info.value.get_exception_code() == 2
+
+
+def test_mbap():
+    assert protocol.build_mbap(7, 1, 5) == struct.pack(">HHHB", 7, 0, 6, 1)
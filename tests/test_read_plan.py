@@ -0,0 +1,59 @@
+import modbus_tk.defines as cst
+
+from riaps.interfaces.modbus.commands import compile_command_table
+from riaps.interfaces.modbus.read_plan import compile_read_plan
+
+
+def make_read_commands(**parameters):
+    config = {"Name": "TestDevice", "SlaveID": 1}
+    for name, (function, start, length) in parameters.items():
+        config[f"{name}_READ"] = {
+            "function": function,
+            "start": start,
+            "length": length,
+            "data_format": "",
+        }
+    return compile_command_table(config).reads
+
+
+def test_adjacent_reads_are_merged():
+    read_commands = make_read_commands(
+        A=("READ_INPUT_REGISTERS", 0, 1),
+        B=("READ_INPUT_REGISTERS", 1, 2),
+        C=("READ_INPUT_REGISTERS", 3, 1),
+        D=("READ_HOLDING_REGISTERS", 4, 1),
+    )
+    plan = compile_read_plan(read_commands, 1, ["A", "B", "C", "D"])
+    assert plan.transactions == 2
+    blocks = {block.function_code: block for block in plan.blocks}
+    assert blocks[cst.READ_INPUT_REGISTERS].start == 0
+    assert blocks[cst.READ_INPUT_REGISTERS].length == 4
+    assert blocks[cst.READ_HOLDING_REGISTERS].length == 1
+
+
+def test_gap_tolerance():
+    read_commands = make_read_commands(
+        A=("READ_HOLDING_REGISTERS", 10, 1),
+        B=("READ_HOLDING_REGISTERS", 13, 1),
+    )
+    assert compile_read_plan(read_commands, 1, ["A", "B"]).transactions == 2
+    plan = compile_read_plan(read_commands, 1, ["A", "B"], max_gap=2)
+    assert plan.transactions == 1
+    assert plan.blocks[0].length == 4
+    assert [member[2] for member in plan.blocks[0].members] == [0, 3]
+
+
+def test_block_length_limit():
+    read_commands = make_read_commands(
+        **{f"P{i}": ("READ_INPUT_REGISTERS", i * 2, 2) for i in range(100)}
+    )
+    plan = compile_read_plan(read_commands, 1, [f"P{i}" for i in range(100)])
+    assert plan.transactions == 2
+    assert all(block.length <= 125 for block in plan.blocks)
+
+
+def test_unmergeable_reads_are_singles():
+    read_commands = make_read_commands(A=("READ_COILS", 0, 1))
+    plan = compile_read_plan(read_commands, 1, ["A", "MISSING"])
+    assert plan.blocks == []
+    assert plan.singles == [(0, "A"), (1, "MISSING")]
@@ -0,0 +1,24 @@
+import modbus_tk.defines as cst
+
+from riaps.interfaces.modbus.register_cache import RegisterCache
+
+
+def test_max_age():
+    cache = RegisterCache()
+    cache.update(1, cst.READ_HOLDING_REGISTERS, 100, [1, 2, 3], now=10.0)
+    assert cache.get(1, cst.READ_HOLDING_REGISTERS, 101, 2, max_age=1.0, now=10.5) == [2, 3]
+    assert cache.get(1, cst.READ_HOLDING_REGISTERS, 101, 2, max_age=1.0, now=11.5) is None
+    # partially cached
+    assert cache.get(1, cst.READ_HOLDING_REGISTERS, 102, 2, max_age=1.0, now=10.5) is None
+    # other slave, other table
+    assert cache.get(2, cst.READ_HOLDING_REGISTERS, 100, 1, max_age=1.0, now=10.5) is None
+    assert cache.get(1, cst.READ_INPUT_REGISTERS, 100, 1, max_age=1.0, now=10.5) is None
+    assert cache.get_stats() == {"registers": 3, "hits": 1, "misses": 4}
+
+
+def test_writes_share_the_holding_registers():
+    cache = RegisterCache()
+    cache.update(1, cst.WRITE_MULTIPLE_REGISTERS, 5, [7, 8], now=0.0)
+    assert cache.get(1, cst.READ_HOLDING_REGISTERS, 5, 2, max_age=1.0, now=0.0) == [7, 8]
+    cache.invalidate(1, cst.WRITE_SINGLE_REGISTER, 6, 1)
+    assert cache.get(1, cst.READ_HOLDING_REGISTERS, 5, 2, max_age=1.0, now=0.0) is None
@@ -0,0 +1,59 @@
+import threading
+import time
+
+from riaps.interfaces.modbus.connection_pool import Priority, current_priority
+from riaps.interfaces.modbus.request_queue import RequestQueue
+
+
+def test_priority_and_merge():
+    queue = RequestQueue("dev")
+    started = threading.Event()
+    release = threading.Event()
+    executed = []
+
+    def blocker():
+        started.set()
+        release.wait()
+
+    def work(name):
+        executed.append((name, current_priority()))
+        return name
+
+    results = {}
+
+    def submit(name, priority, merge_key=None):
+        results.setdefault(name, []).append(
+            queue.call(work, name, priority=priority, merge_key=merge_key)
+        )
+
+    threads = [threading.Thread(target=queue.call, args=(blocker,))]
+    threads[0].start()
+    started.wait()
+    for name, priority, merge_key in [("poll", Priority.POLL, "A"),
+                                      ("poll2", Priority.POLL, None),
+                                      ("poll", Priority.COMMAND, "A"),
+                                      ("write", Priority.COMMAND, None)]:
+        thread = threading.Thread(target=submit, args=(name, priority, merge_key))
+        thread.start()
+        threads.append(thread)
+        while queue.submitted < len(threads):
+            time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(timeout=5)
+    queue.stop()
+
+    # the merged read was raised to command priority and ran once for both callers
+    assert executed == [("poll", Priority.COMMAND), ("write", Priority.COMMAND),
+                        ("poll2", Priority.POLL)]
+    assert results["poll"] == ["poll", "poll"]
+    stats = queue.get_stats()
+    assert stats["merged"] == 1
+    assert stats["executed"] == 4
+    assert stats["wait_time"]["command"]["count"] == 2
+
+
+def test_stopped_queue():
+    queue = RequestQueue("dev")
+    queue.stop()
+    assert queue.call(lambda: 1, stopped_result="stopped") == "stopped"
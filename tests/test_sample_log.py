@@ -0,0 +1,53 @@
+import math
+
+import pytest
+
+from riaps.interfaces.modbus.sample_log import SampleLog, SampleLogReader
+
+
+def test_append_and_read_time_range(tmp_path):
+    sample_log = SampleLog(tmp_path, segment_records=4, max_segments=3)
+    for i in range(10):
+        sample_log.append(float(i), "FREQ" if i % 2 else "P", [i * 0.5], registers=[i, 0xFFFF])
+    sample_log.append(10.0, "RAMP", [3, 4], registers=[3, 4])
+    sample_log.append(11.0, "P", error=True)
+    reader = SampleLogReader(tmp_path)
+    # 13 records in segments of 4, the oldest segment was deleted
+    assert len(list(tmp_path.glob("segment-*.bin"))) == 3
+    samples = reader.slice()
+    assert samples[0].timestamp == 4.0
+    assert reader.slice(6.0, 8.0) == [
+        (6.0, "P", 0, 3.0, [6, 0xFFFF], False),
+        (7.0, "FREQ", 0, 3.5, [7, 0xFFFF], False),
+    ]
+    assert [sample.timestamp for sample in reader.read(5.0, 9.0, parameters=["FREQ"])] == [5.0, 7.0]
+    ramp = reader.slice(10.0, 11.0)
+    assert [(sample.index, sample.value) for sample in ramp] == [(0, 3.0), (1, 4.0)]
+    error = reader.slice(11.0)[0]
+    assert error.error and math.isnan(error.value)
+    sample_log.close()
+
+
+def test_new_run_starts_a_new_segment(tmp_path):
+    sample_log = SampleLog(tmp_path, segment_records=8)
+    sample_log.append(1.0, "P", [1])
+    sample_log.close()
+    sample_log = SampleLog(tmp_path, segment_records=8)
+    sample_log.append(2.0, "Q", [2])
+    sample_log.close()
+    assert len(list(tmp_path.glob("segment-*.bin"))) == 2
+    assert [(sample.parameter, sample.value) for sample in SampleLogReader(tmp_path)] == [("P", 1.0), ("Q", 2.0)]
+
+
+def test_rejects_what_a_record_cannot_hold(tmp_path):
+    sample_log = SampleLog(tmp_path, segment_records=1024)
+    with pytest.raises(ValueError):
+        sample_log.append(1.0, "P", list(range(257)))
+    with pytest.raises(ValueError):
+        sample_log.append(1.0, "P", [1.0], registers=[0x10000])
+    sample_log.append(2.0, "P", list(range(256)))
+    sample_log.close()
+    samples = SampleLogReader(tmp_path).slice()
+    # nothing was written for the rejected samples
+    assert [sample.timestamp for sample in samples] == [2.0] * 256
+    assert samples[-1].index == 255
@@ -0,0 +1,47 @@
+import pytest
+
+from riaps.interfaces.modbus.timeseries import RingBuffer, load_history_buffers
+
+
+def test_window_wraps_without_copying():
+    ring_buffer = RingBuffer(3, use_numpy=False)
+    assert len(ring_buffer.window()[0]) == 0
+    for i in range(5):
+        ring_buffer.append(float(i), [i * 10])
+    assert len(ring_buffer) == 3
+    timestamps, values = ring_buffer.window()
+    assert list(timestamps) == [2.0, 3.0, 4.0]
+    assert list(values) == [20.0, 30.0, 40.0]
+    assert isinstance(values, memoryview)
+    assert list(ring_buffer.window(2)[1]) == [30.0, 40.0]
+    assert list(ring_buffer.window(since=3.0)[0]) == [3.0, 4.0]
+    assert ring_buffer.last() == (4.0, [40.0])
+
+
+def test_multi_value_samples():
+    ring_buffer = RingBuffer(2, use_numpy=False)
+    ring_buffer.append(1.0, [1, 2])
+    ring_buffer.append(2.0, [3, 4])
+    ring_buffer.append(3.0, [5, 6])
+    assert list(ring_buffer.window()[1]) == [3.0, 4.0, 5.0, 6.0]
+    assert ring_buffer.last() == (3.0, [5.0, 6.0])
+    with pytest.raises(ValueError):
+        ring_buffer.append(4.0, [1])
+
+
+def test_numpy_window():
+    numpy = pytest.importorskip("numpy")
+    ring_buffer = RingBuffer(3, use_numpy=True)
+    for i in range(4):
+        ring_buffer.append(float(i), [i, -i])
+    timestamps, values = ring_buffer.window()
+    assert values.shape == (3, 2)
+    assert numpy.shares_memory(values, ring_buffer._values)
+    assert ring_buffer.last() == (3.0, [3.0, -3.0])
+
+
+def test_load_history_buffers():
+    device_config = {"History_Samples": 10, "poll": {"FREQ": {"history": 100}, "P": None, "Q": {"history": 0}}}
+    buffers = load_history_buffers(device_config)
+    assert {name: buffer.capacity for name, buffer in buffers.items()} == {"FREQ": 100, "P": 10}
+    assert load_history_buffers({"poll": ["P"]}, 0) == {}